@@ -0,0 +1,188 @@
+import math
+import time
+
+import faiss
+import numpy as np
+
+# --------- 向量索引类型 ---------
+#   flat   精确检索，逐条计算 L2 距离
+#   ivf    IVF-Flat：先用 k-means 把向量分到 nlist 个桶，查询时只扫描最近的 nprobe 个桶
+#   hnsw   HNSW 图索引，无需训练，查询时 efSearch 控制候选队列长度
+#   ivfpq  IVF-PQ：桶内向量再做乘积量化，每个向量只占 pq_m 字节，适合百万级以上的语料
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'ivfpq')
+# --------- 向量存储精度 ---------
+# flat / ivf / hnsw 的原始向量可以用标量量化存储：fp16 每维 2 字节，int8 每维 1 字节（按维度的取值范围线性量化）。
+# pca_dim 不为空时先用在语料上训练的 PCA 降维，再建上述索引
+STORAGE_TYPES = {
+    'float32': None,
+    'fp16': faiss.ScalarQuantizer.QT_fp16,
+    'int8': faiss.ScalarQuantizer.QT_8bit,
+}
+# faiss 建议每个聚类中心至少有 39 个训练样本
+MIN_POINTS_PER_CENTROID = 39
+
+
+def default_nlist(num_vectors):
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def _default_pq_m(dim):
+    # 每个子向量 8 维；pq_m 必须整除向量维度
+    for pq_m in range(max(dim // 8, 1), 0, -1):
+        if dim % pq_m == 0:
+            return pq_m
+    return 1
+
+
+def make_index(index_type, dim, num_vectors, nlist=None, hnsw_m=32, ef_construction=40, pq_m=None, pq_bits=8,
+               storage='float32', pca_dim=None):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"未知的向量索引类型: {index_type}")
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"未知的向量存储精度: {storage}")
+    if index_type == 'ivfpq' and storage != 'float32':
+        raise ValueError("ivfpq 已对向量做乘积量化，不能再指定标量量化")
+    # PCA 至少需要与输出维度一样多的训练样本
+    if pca_dim and pca_dim < dim and num_vectors >= pca_dim:
+        return faiss.IndexPreTransform(faiss.PCAMatrix(dim, pca_dim),
+                                       make_index(index_type, pca_dim, num_vectors, nlist, hnsw_m, ef_construction,
+                                                  pq_m, pq_bits, storage))
+    # 向量太少时聚类与量化都训练不出来，退回精确检索
+    if index_type == 'ivfpq' and num_vectors < MIN_POINTS_PER_CENTROID * 2 ** pq_bits:
+        index_type = 'ivf'
+    if index_type == 'ivf' and num_vectors < MIN_POINTS_PER_CENTROID:
+        index_type = 'flat'
+    qtype = STORAGE_TYPES[storage]
+
+    if index_type == 'flat':
+        return faiss.IndexFlatL2(dim) if qtype is None else faiss.IndexScalarQuantizer(dim, qtype)
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, hnsw_m) if qtype is None else faiss.IndexHNSWSQ(dim, qtype, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+        return index
+    nlist = min(nlist or default_nlist(num_vectors), max(1, num_vectors // MIN_POINTS_PER_CENTROID))
+    quantizer = faiss.IndexFlatL2(dim)
+    if index_type == 'ivf':
+        if qtype is None:
+            return faiss.IndexIVFFlat(quantizer, dim, nlist)
+        return faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype)
+    return faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m or _default_pq_m(dim), pq_bits)
+
+
+# 需要训练的索引只用抽样出的 train_size 个向量训练，语料很大时训练时间与语料规模无关
+def train_index(index, embeddings, train_size=100000, seed=0):
+    if index.is_trained:
+        return
+    if len(embeddings) > train_size:
+        rng = np.random.default_rng(seed)
+        embeddings = embeddings[np.sort(rng.choice(len(embeddings), train_size, replace=False))]
+    index.train(np.ascontiguousarray(embeddings, dtype=np.float32))
+
+
+def build_ann_index(embeddings, index_type='flat', train_size=100000, **index_params):
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    index = make_index(index_type, embeddings.shape[1], len(embeddings), **index_params)
+    train_index(index, embeddings, train_size)
+    index.add(embeddings)
+    return index
+
+
+# --------- 按 id 增删向量 ---------
+# IVF 类索引本身按 id 存储与删除向量；其余索引外面包一层 IndexIDMap2，检索结果中的下标即为 add_with_ids 时的 id
+def with_ids(index):
+    if faiss.try_extract_index_ivf(index) is not None:
+        return index
+    return faiss.IndexIDMap2(index)
+
+
+# 返回删除后的索引。HNSW 的图不支持删除节点，此时取出其余向量重建一个新索引（耗时与语料规模相当），
+# 频繁增删的语料应改用 flat / ivf 类索引
+def remove_ids(index, ids):
+    ids = np.asarray(ids, dtype=np.int64)
+    try:
+        index.remove_ids(ids)
+        return index
+    except RuntimeError:
+        if not isinstance(index, faiss.IndexIDMap2):
+            raise
+    inner = faiss.downcast_index(index.index)
+    vectors = inner.reconstruct_n(0, inner.ntotal)
+    all_ids = faiss.vector_to_array(index.id_map)
+    keep = ~np.isin(all_ids, ids)
+    # 复制已训练好的 PCA 等参数，清空向量后重新加入
+    rebuilt = faiss.clone_index(inner)
+    rebuilt.reset()
+    rebuilt = faiss.IndexIDMap2(rebuilt)
+    rebuilt.add_with_ids(vectors[keep], all_ids[keep])
+    return rebuilt
+
+
+# 查询时的检索参数，不修改索引本身，多个线程可以用不同参数检索同一个索引
+def search_parameters(index, nprobe=None, ef_search=None):
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return search_parameters(faiss.downcast_index(index.index), nprobe, ef_search)
+    if isinstance(index, faiss.IndexPreTransform):
+        inner = search_parameters(faiss.downcast_index(index.index), nprobe, ef_search)
+        if inner is None:
+            return None
+        params = faiss.SearchParametersPreTransform()
+        params.index_params = inner
+        # SWIG 不会替 params 保留 inner 的引用
+        params.inner = inner
+        return params
+    if nprobe is not None and faiss.try_extract_index_ivf(index) is not None:
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    if ef_search is not None and isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search)
+    return None
+
+
+def search(index, query_vectors, k, nprobe=None, ef_search=None):
+    params = search_parameters(index, nprobe, ef_search)
+    if params is None:
+        return index.search(query_vectors, k)
+    return index.search(query_vectors, k, params=params)
+
+
+# --------- 多进程共享的精确检索 ---------
+# flat 类索引（IndexFlat / IndexScalarQuantizer）的向量逐条存放在一块连续内存中，以 IO_FLAG_MMAP_IFC 读取时
+# faiss 直接在只读映射的文件上检索，同一台机器上的多个 worker 共用页缓存中的一份数据。
+# 精确检索的 float32 索引转成 fp16 存储，内存减半，检索仍走 faiss 的 SIMD 距离计算
+def shareable_index(index):
+    if isinstance(index, faiss.IndexFlat):
+        shared = faiss.IndexScalarQuantizer(index.d, faiss.ScalarQuantizer.QT_fp16)
+        shared.add(index.reconstruct_n(0, index.ntotal))
+        return shared
+    if isinstance(index, faiss.IndexFlatCodes):
+        return index
+    raise ValueError(f"只有 flat 类索引可以共享映射: {type(index).__name__}")
+
+
+# --------- 召回率、延迟与内存 ---------
+# 按序列化后的大小计算，包括 HNSW 的图、IVF 的聚类中心与 PCA 矩阵等全部开销
+def bytes_per_vector(index):
+    return faiss.serialize_index(index).nbytes / max(index.ntotal, 1)
+
+
+def recall_at_k(found, expected):
+    k = expected.shape[1]
+    hits = sum(len(set(row_found[:k]) & set(row_expected)) for row_found, row_expected in zip(found, expected))
+    return hits / expected.size
+
+
+# configs 为 [(名称, 索引, 检索参数)]，逐条查询计时，召回率以精确检索的结果为准
+def recall_report(embeddings, queries, k, configs, exact=None):
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if exact is None:
+        exact = faiss.IndexFlatL2(embeddings.shape[1])
+        exact.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+    expected = exact.search(queries, k)[1]
+    rows = []
+    for name, index, params in configs:
+        found = np.empty_like(expected)
+        start = time.perf_counter()
+        for i in range(len(queries)):
+            found[i] = search(index, queries[i:i + 1], k, **params)[1][0]
+        latency = (time.perf_counter() - start) / len(queries)
+        rows.append((name, recall_at_k(found, expected), latency))
+    return rows
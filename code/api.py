@@ -4,6 +4,8 @@ from volcengine.auth.SignerV4 import SignerV4
 from volcengine.base.Request import Request
 from volcengine.Credentials import Credentials
 
+from reranker import load_reranker_in_background, rerank
+
 # 初始化知识库服务相关配置
 collection_name = ""
 project_name = ""
@@ -12,6 +14,14 @@ sk = ""
 account_id = ""
 g_knowledge_base_domain = ""
 
+# 知识库自带的重排（rerank_switch）关闭时，可以在本地用交叉编码器限时重排（见 reranker.py）：
+# 检索 rerank_top_n 条，重排后只把前 rerank_keep 条拼进提示词，超过 rerank_budget 秒时未打分的保持原顺序
+local_rerank = False
+rerank_top_n = 20
+rerank_keep = 5
+rerank_budget = 0.3
+reranker_future = None
+
 # 定义系统提示
 base_prompt = """# 任务
 你是一位在线客服，你的首要任务是通过巧妙的话术回复用户的问题，你需要根据「参考资料」来回答接下来的「用户问题」，这些信息在 <context></context> XML tags 之内，你需要根据参考资料给出准确，简洁的回答。
@@ -83,7 +93,7 @@ def search_knowledge():
         "project": "default",
         "name": collection_name,  # 使用定义的 collection_name
         "query": query,  # 使用定义的 query
-        "limit": 10,
+        "limit": rerank_top_n if local_rerank else 10,
         "pre_processing": {
             "need_instruction": True,
             "return_token_usage": True,
@@ -206,11 +216,32 @@ def generate_prompt(rsp_txt):
 
     return base_prompt.format(prompt), image_urls
 
+# 本地重排用的文本：faq 召回时把原问题拼在答案前面
+def get_content_for_rerank(point: dict) -> str:
+    original_question = point.get("original_question")
+    if original_question:
+        return f"问题：{original_question} 答案：{point['content']}"
+    return point["content"]
+
+# 本地重排知识库的检索结果，返回格式相同的 JSON 文本，generate_prompt 不用改动
+def rerank_search_result(rsp_txt, reranker):
+    rsp = json.loads(rsp_txt)
+    if rsp["code"] != 0:
+        return rsp_txt
+    points, scored, status = rerank(query, rsp["data"]["result_list"], reranker, get_content_for_rerank,
+                                    rerank_top_n, rerank_keep, rerank_budget)
+    if status != 'full':
+        print(f"本地重排超过 {rerank_budget} 秒（{status}），只重排了 {scored} 条，其余保持知识库原顺序")
+    rsp["data"]["result_list"] = points
+    return json.dumps(rsp, ensure_ascii=False)
+
 # 主函数，执行搜索知识库和聊天补全
 def search_knowledge_and_chat_completion():
     global query
     # 1.执行search_knowledge
     rsp_txt = search_knowledge()
+    if local_rerank:
+        rsp_txt = rerank_search_result(rsp_txt, reranker_future.result())
     # 2.生成prompt
     prompt, image_urls = generate_prompt(rsp_txt)
     # 拼接message对话, 问题对应role为user，系统对应role为system, 答案对应role为assistant, 内容对应content
@@ -245,6 +276,9 @@ def search_knowledge_and_chat_completion():
     return response_text
 
 if __name__ == "__main__":
+    # 等待输入的同时在后台加载重排模型
+    if local_rerank:
+        reranker_future = load_reranker_in_background()
     conversation_history = []
     while True:
         query = input("请输入你的问题（输入 'exit' 退出）：")
@@ -0,0 +1,257 @@
+import argparse
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+
+from 倒排索引构建 import InvertedIndex, preprocessor
+
+
+# --------- 读取语料与查询 ---------
+def load_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# 从原始语料中有放回地抽样，扩充到指定规模
+def sample_corpus(documents, size, seed=0):
+    rng = random.Random(seed)
+    return [documents[rng.randrange(len(documents))] for _ in range(size)]
+
+
+def time_queries(index, queries, repeat=3, **rank_args):
+    # 预热一次，避免把 jieba 加载词典的时间计入查询延迟；之后查询分词命中缓存，只统计检索本身
+    for query in queries:
+        index.rank(query, **rank_args)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            index.rank(query, **rank_args)
+    return (time.perf_counter() - start) / (repeat * len(queries))
+
+
+# --------- 查询延迟随语料规模的变化 ---------
+def bench_latency(documents, queries, sizes, repeat=3):
+    print(f"{'docs':>10} {'ms/query':>12}")
+    for size in sizes:
+        index = InvertedIndex()
+        index.build_index(sample_corpus(documents, size))
+        latency = time_queries(index, queries, repeat)
+        print(f"{size:>10} {latency * 1000:>12.3f}")
+
+
+# --------- BM25 OR 查询 top-k：穷举与 WAND / MaxScore 剪枝对比 ---------
+def bench_topk(documents, queries, sizes, k=10, repeat=3):
+    modes = [('exhaustive', None), ('wand', 'wand'), ('maxscore', 'maxscore')]
+    print(f"{'docs':>10}" + ''.join(f"{name:>14}" for name, _ in modes) + '   (ms/query)')
+    for size in sizes:
+        index = InvertedIndex()
+        index.build_index(sample_corpus(documents, size))
+        # 先用穷举结果校验一遍剪枝结果
+        for query in queries:
+            index.rank(query, k, scoring='bm25', mode='or', pruning='wand', verify=True)
+            index.rank(query, k, scoring='bm25', mode='or', pruning='maxscore', verify=True)
+        latencies = [time_queries(index, queries, repeat, k=k, scoring='bm25', mode='or', pruning=pruning)
+                     for _, pruning in modes]
+        print(f"{size:>10}" + ''.join(f"{latency * 1000:>14.3f}" for latency in latencies))
+
+
+# --------- 建索引吞吐量随进程数的变化 ---------
+def bench_build(documents, size, worker_counts, shard_size=2000):
+    corpus = sample_corpus(documents, size)
+    # 预热 jieba，避免把加载词典的时间计入串行构建
+    preprocessor.preprocess(corpus[0])
+    print(f"{'workers':>10} {'seconds':>10} {'docs/sec':>12} {'speedup':>10}")
+    start = time.perf_counter()
+    InvertedIndex().build_index(corpus)
+    serial = time.perf_counter() - start
+    print(f"{'serial':>10} {serial:>10.2f} {size / serial:>12.0f} {1:>10.2f}")
+    for workers in worker_counts:
+        start = time.perf_counter()
+        InvertedIndex().build_index_parallel(corpus, workers, shard_size)
+        elapsed = time.perf_counter() - start
+        print(f"{workers:>10} {elapsed:>10.2f} {size / elapsed:>12.0f} {serial / elapsed:>10.2f}")
+
+
+# --------- 逐条查询与批量查询的吞吐量对比 ---------
+def bench_batch(documents, queries, size, worker_counts, k=10, repeat=3):
+    index = InvertedIndex()
+    index.build_index(sample_corpus(documents, size))
+    print(f"{'mode':>14} {'queries/sec':>12}")
+    for name, rank_args in (('tfidf-and', {}), ('bm25-or', {'scoring': 'bm25', 'mode': 'or'})):
+        runs = [('loop', lambda: [index.rank(query, k, **rank_args) for query in queries])]
+        runs += [(f"x{workers}", lambda workers=workers: index.rank_many(queries, k, workers=workers, **rank_args))
+                 for workers in worker_counts]
+        for label, run in runs:
+            # 预热一次，查询分词都已进入缓存，只比较检索本身
+            run()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                run()
+            elapsed = time.perf_counter() - start
+            print(f"{name + ' ' + label:>14} {repeat * len(queries) / elapsed:>12.0f}")
+
+
+# --------- 增量更新与全量重建对比 ---------
+def bench_update(documents, queries, size, batch, repeat=3):
+    corpus = sample_corpus(documents, size)
+    changes = sample_corpus(documents, batch, seed=1)
+    preprocessor.warm_up()
+    index = InvertedIndex()
+    index.build_index(corpus)
+    base_latency = time_queries(index, queries, repeat)
+
+    start = time.perf_counter()
+    # 新增、更新、删除各占三分之一，更新和删除的目标跳过已删除的文档
+    for i, content in enumerate(changes):
+        target = i * 7919 % size
+        if i % 3 == 0:
+            index.add_document(content)
+        elif not index.live_gens[target]:
+            continue
+        elif i % 3 == 1:
+            index.update_document(target, content)
+        else:
+            index.delete_document(target)
+    incremental = time.perf_counter() - start
+    index.wait_for_merges()
+    delta_latency = time_queries(index, queries, repeat)
+    start = time.perf_counter()
+    index.force_merge()
+    merge = time.perf_counter() - start
+    merged_latency = time_queries(index, queries, repeat)
+
+    start = time.perf_counter()
+    InvertedIndex().build_index(corpus + changes)
+    rebuild = time.perf_counter() - start
+    print(f"{batch} 次增删改: {incremental:.2f} s，合并为单段: {merge:.2f} s，全量重建: {rebuild:.2f} s")
+    print(f"查询延迟 (ms): 单段 {base_latency * 1000:.3f}，带增量段 {delta_latency * 1000:.3f}，"
+          f"合并后 {merged_latency * 1000:.3f}")
+
+
+# --------- 保存与不保存词位置的开销对比 ---------
+def bench_positions(documents, queries, size, k=10, repeat=3):
+    corpus = sample_corpus(documents, size)
+    preprocessor.warm_up()
+    print(f"{'mode':>12} {'build s':>10} {'MB':>8} {'or ms':>8} {'phrase ms':>10} {'proximity ms':>13}")
+    for name, store_positions in (('positions', True), ('no-positions', False)):
+        start = time.perf_counter()
+        index = build_compact_layout(corpus, store_positions)
+        build = time.perf_counter() - start
+        # tracemalloc 会拖慢构建，内存单独再建一次统计
+        size_bytes = traced_size(lambda docs: build_compact_layout(docs, store_positions), corpus)[1]
+        row = f"{name:>12} {build:>10.2f} {size_bytes / 2 ** 20:>8.2f}"
+        row += f" {time_queries(index, queries, repeat, k=k, scoring='bm25', mode='or') * 1000:>8.3f}"
+        if store_positions:
+            row += f" {time_queries(index, queries, repeat, k=k, scoring='bm25', mode='phrase') * 1000:>10.3f}"
+            row += f" {time_queries(index, queries, repeat, k=k, scoring='bm25', mode='or', proximity=1.0) * 1000:>13.3f}"
+        else:
+            row += f" {'-':>10} {'-':>13}"
+        print(row)
+
+
+# --------- 分词服务：词典加载耗时与查询缓存的效果 ---------
+def bench_tokenize(queries, repeat=3):
+    start = time.perf_counter()
+    preprocessor.warm_up()
+    print(f"词典加载: {(time.perf_counter() - start) * 1000:.1f} ms")
+    print(f"{'mode':>10} {'us/query':>12}")
+    for name, tokenize in (('uncached', preprocessor.preprocess), ('cached', preprocessor.preprocess_query)):
+        preprocessor.clear_cache()
+        for query in queries:
+            tokenize(query)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for query in queries:
+                tokenize(query)
+        elapsed = (time.perf_counter() - start) / (repeat * len(queries))
+        print(f"{name:>10} {elapsed * 1e6:>12.2f}")
+    start = time.perf_counter()
+    for _ in range(repeat):
+        preprocessor.preprocess_many(queries)
+    elapsed = (time.perf_counter() - start) / (repeat * len(queries))
+    print(f"{'batch':>10} {elapsed * 1e6:>12.2f}")
+
+
+# --------- 新旧倒排表布局的内存占用对比 ---------
+# 旧布局：每个 posting 是一个 {'doc_id', 'positions'} 字典
+def build_legacy_layout(documents):
+    index = defaultdict(list)
+    doc_lengths = defaultdict(int)
+    for doc_id, content in enumerate(documents):
+        terms = preprocessor.preprocess(content)
+        term_positions = defaultdict(list)
+        for position, term in enumerate(terms):
+            term_positions[term].append(position)
+        for term, positions in term_positions.items():
+            index[term].append({'doc_id': doc_id, 'positions': positions})
+        doc_lengths[doc_id] = len(terms)
+    return index, doc_lengths
+
+
+def build_compact_layout(documents, store_positions=True):
+    index = InvertedIndex(store_positions=store_positions)
+    index.build_index(documents)
+    return index
+
+
+def traced_size(build, documents):
+    tracemalloc.start()
+    result = build(documents)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def bench_memory(documents):
+    # 预热 jieba，避免词典加载计入内存占用
+    preprocessor.preprocess(documents[0])
+    legacy, legacy_size = traced_size(build_legacy_layout, documents)
+    num_postings = sum(len(postings) for postings in legacy[0].values())
+    del legacy
+    compact, compact_size = traced_size(build_compact_layout, documents)
+
+    print(f"文档数: {len(documents)}  词项数: {len(compact.index)}  posting 数: {num_postings}")
+    print(f"{'layout':>10} {'total MB':>10} {'bytes/posting':>15}")
+    for name, size in (('legacy', legacy_size), ('compact', compact_size)):
+        print(f"{name:>10} {size / 2 ** 20:>10.2f} {size / num_postings:>15.1f}")
+    print(f"压缩比: {legacy_size / compact_size:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="倒排索引性能测试")
+    parser.add_argument('bench', choices=['latency', 'topk', 'batch', 'build', 'update', 'positions', 'tokenize', 'memory'])
+    parser.add_argument('--data', default='processed_data.txt')
+    parser.add_argument('--queries', default='test_word.txt')
+    parser.add_argument('--sizes', default='1000,2000,4000,8000,16000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--workers', default='1,2,4,8')
+    parser.add_argument('--shard-size', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=1000)
+    args = parser.parse_args()
+
+    documents = load_lines(args.data)
+    if args.bench == 'latency':
+        queries = load_lines(args.queries)
+        sizes = [int(size) for size in args.sizes.split(',')]
+        bench_latency(documents, queries, sizes, args.repeat)
+    elif args.bench == 'topk':
+        queries = load_lines(args.queries)
+        sizes = [int(size) for size in args.sizes.split(',')]
+        bench_topk(documents, queries, sizes, args.k, args.repeat)
+    elif args.bench == 'batch':
+        worker_counts = [int(workers) for workers in args.workers.split(',')]
+        bench_batch(documents, load_lines(args.queries), args.size, worker_counts, args.k, args.repeat)
+    elif args.bench == 'build':
+        worker_counts = [int(workers) for workers in args.workers.split(',')]
+        bench_build(documents, args.size, worker_counts, args.shard_size)
+    elif args.bench == 'update':
+        bench_update(documents, load_lines(args.queries), args.size, args.batch, args.repeat)
+    elif args.bench == 'positions':
+        bench_positions(documents, load_lines(args.queries), args.size, args.k, args.repeat)
+    elif args.bench == 'tokenize':
+        bench_tokenize(load_lines(args.queries), args.repeat)
+    elif args.bench == 'memory':
+        bench_memory(documents)
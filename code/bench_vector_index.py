@@ -0,0 +1,383 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from ann_index import build_ann_index, bytes_per_vector, default_nlist, recall_at_k, recall_report
+
+
+# --------- 测试向量 ---------
+# 没有真实语料时用若干高斯簇模拟句向量的分布
+def synthetic_embeddings(size, dim=384, clusters=256, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(clusters, size=size)
+    return centers[labels] + 0.5 * rng.standard_normal((size, dim)).astype(np.float32)
+
+
+def corpus_texts(path):
+    from 向量构建 import parse_and_merge_blocks, combine_block_text
+    return [combine_block_text(block) for block in parse_and_merge_blocks(path)]
+
+
+# 用真实语料时先编码全部文档块，向量写入磁盘缓存，重复测试不必重新编码
+def corpus_embeddings(path, model_name):
+    from embedding_cache import encode_with_cache, open_cache
+    from encoder import load_model
+    return encode_with_cache(load_model(model_name), corpus_texts(path), open_cache('embedding_cache'), model_name)
+
+
+def split_queries(embeddings, num_queries, seed=1):
+    # 查询向量取语料向量加少量噪声，避免每个查询都恰好命中自己
+    rng = np.random.default_rng(seed)
+    picked = embeddings[rng.choice(len(embeddings), num_queries, replace=False)]
+    return picked + 0.1 * rng.standard_normal(picked.shape).astype(np.float32)
+
+
+# --------- 各类 ANN 索引的召回率与延迟 ---------
+def bench_ann(embeddings, queries, k, nprobes, ef_searches, hnsw_m, train_size):
+    nlist = default_nlist(len(embeddings))
+    print(f"向量数: {len(embeddings)}  维度: {embeddings.shape[1]}  nlist: {nlist}")
+    built = {index_type: build_ann_index(embeddings, index_type, train_size, **params)
+             for index_type, params in (('flat', {}), ('ivf', {'nlist': nlist}),
+                                        ('hnsw', {'hnsw_m': hnsw_m}), ('ivfpq', {'nlist': nlist}))}
+    configs = [('flat', built['flat'], {})]
+    configs += [(f"ivf nprobe={nprobe}", built['ivf'], {'nprobe': nprobe}) for nprobe in nprobes]
+    configs += [(f"hnsw ef={ef}", built['hnsw'], {'ef_search': ef}) for ef in ef_searches]
+    configs += [(f"ivfpq nprobe={nprobe}", built['ivfpq'], {'nprobe': nprobe}) for nprobe in nprobes]
+    print(f"{'index':>20} {f'recall@{k}':>10} {'ms/query':>10}")
+    for name, recall, latency in recall_report(embeddings, queries, k, configs, exact=built['flat']):
+        print(f"{name:>20} {recall:>10.3f} {latency * 1000:>10.3f}")
+
+
+# --------- 标量量化与 PCA 降维：每个向量的内存与召回率损失 ---------
+def bench_storage(embeddings, queries, k, index_type, pca_dims, nprobe, ef_search, train_size):
+    params = {'nprobe': nprobe, 'ef_search': ef_search}
+    configs = []
+    sizes = {}
+    for pca_dim in [None] + pca_dims:
+        for storage in ('float32', 'fp16', 'int8'):
+            name = f"{storage}" + (f" pca{pca_dim}" if pca_dim else '')
+            index = build_ann_index(embeddings, index_type, train_size, storage=storage, pca_dim=pca_dim)
+            sizes[name] = bytes_per_vector(index)
+            configs.append((name, index, params))
+    print(f"向量数: {len(embeddings)}  维度: {embeddings.shape[1]}  索引类型: {index_type}")
+    print(f"{'storage':>16} {'bytes/vec':>10} {f'recall@{k}':>10} {'ms/query':>10}")
+    for name, recall, latency in recall_report(embeddings, queries, k, configs):
+        print(f"{name:>16} {sizes[name]:>10.1f} {recall:>10.3f} {latency * 1000:>10.3f}")
+
+
+# --------- 各编码后端的单次查询延迟与向量偏差 ---------
+# 文档向量统一用 torch fp32 编码，只替换查询端的后端：余弦相似度衡量与 fp32 查询向量的偏差，
+# recall@k 衡量检索结果与 fp32 查询的一致程度
+def bench_encoder(model_name, backends, queries, texts, k=10, repeat=3):
+    from encoder import load_model
+    baseline = load_model(model_name, 'torch')
+    base_vectors = baseline.encode(queries, convert_to_numpy=True)
+    exact = faiss.IndexFlatL2(base_vectors.shape[1])
+    exact.add(baseline.encode(texts, convert_to_numpy=True))
+    expected = exact.search(base_vectors, k)[1]
+    del baseline
+
+    print(f"{'backend':>12} {'load s':>8} {'ms/query':>10} {'mean cos':>10} {'min cos':>10} {f'recall@{k}':>10}")
+    for backend in backends:
+        start = time.perf_counter()
+        model = load_model(model_name, backend)
+        load = time.perf_counter() - start
+        # 预热一次，首次调用会分配内存、初始化线程池
+        model.encode(queries[:1], convert_to_numpy=True)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for query in queries:
+                model.encode([query], convert_to_numpy=True)
+        latency = (time.perf_counter() - start) / (repeat * len(queries))
+
+        vectors = model.encode(queries, convert_to_numpy=True)
+        cosines = (vectors * base_vectors).sum(axis=1) / (
+            np.linalg.norm(vectors, axis=1) * np.linalg.norm(base_vectors, axis=1))
+        recall = recall_at_k(exact.search(vectors, k)[1], expected)
+        print(f"{backend:>12} {load:>8.2f} {latency * 1000:>10.3f} {cosines.mean():>10.5f} {cosines.min():>10.5f}"
+              f" {recall:>10.3f}")
+
+
+# --------- 逐条检索、批量检索与动态微批的吞吐量 ---------
+def bench_batch(model_name, queries, texts, batch_sizes, clients, k=5, repeat=3):
+    from encoder import load_model
+    from 向量构建 import MicroBatcher, build_combined_index, retrieve_combined_blocks, retrieve_many
+    blocks = [{'id': i, 'text': text, 'qas': []} for i, text in enumerate(texts)]
+    model = load_model(model_name)
+    index, _ = build_combined_index(blocks, model_name, model=model)
+
+    def timed(run):
+        run()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        return repeat * len(queries) / (time.perf_counter() - start)
+
+    print(f"{'mode':>16} {'queries/sec':>12}")
+    print(f"{'loop':>16} {timed(lambda: [retrieve_combined_blocks(q, model, index, blocks, k) for q in queries]):>12.1f}")
+    for batch_size in batch_sizes:
+        qps = timed(lambda: retrieve_many(queries, model, index, blocks, k, batch_size))
+        print(f"{f'batch {batch_size}':>16} {qps:>12.1f}")
+    # 模拟 clients 个并发用户各自逐条提交，由微批前端合并
+    for num_clients in clients:
+        for max_wait in (0.005, 0):
+            batcher = MicroBatcher(model, index, blocks, max_wait=max_wait)
+            with ThreadPoolExecutor(num_clients) as pool:
+                qps = timed(lambda: list(pool.map(lambda q: batcher.retrieve(q, k), queries)))
+            batcher.close()
+            label = f"micro x{num_clients} {max_wait * 1000:g}ms"
+            print(f"{label:>16} {qps:>12.1f}   平均批大小 {batcher.requests / batcher.batches:.1f}")
+
+
+# --------- 向量、关键词与混合检索的命中率和延迟 ---------
+# 以语料中每个文档块自带的问题为查询、该文档块为正确答案，统计 hit@k
+def bench_hybrid(model_name, path, k=5, repeat=3):
+    from encoder import load_model
+    from hybrid_retriever import build_lexical_index, retrieve_hybrid
+    from 倒排索引构建 import preprocessor
+    from 向量构建 import build_combined_index, parse_and_merge_blocks, retrieve_combined_blocks
+    blocks = parse_and_merge_blocks(path)
+    model = load_model(model_name)
+    index, _ = build_combined_index(blocks, model_name, model=model)
+    lexical_index = build_lexical_index(blocks)
+    preprocessor.warm_up()
+    pairs = [(qa['question'], i) for i, block in enumerate(blocks) for qa in block['qas']]
+
+    runs = [
+        ('dense', lambda q: [block_id for _, block_id, _, _ in retrieve_combined_blocks(q, model, index, blocks, k)]),
+        ('lexical', lambda q: [doc for doc, _ in lexical_index.rank(q, k, scoring='bm25', mode='or')]),
+    ]
+    for fusion in ('rrf', 'weighted'):
+        runs.append((f"hybrid {fusion}", lambda q, fusion=fusion: [
+            block_id for _, block_id, _, _ in retrieve_hybrid(q, model, index, lexical_index, blocks, k, fusion)]))
+    print(f"查询数: {len(pairs)}  文档块数: {len(blocks)}")
+    print(f"{'mode':>16} {f'hit@{k}':>8} {'ms/query':>10}")
+    for name, run in runs:
+        hits = sum(answer in run(question) for question, answer in pairs)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for question, _ in pairs:
+                run(question)
+        latency = (time.perf_counter() - start) / (repeat * len(pairs))
+        print(f"{name:>16} {hits / len(pairs):>8.3f} {latency * 1000:>10.3f}")
+
+
+# --------- 限时重排 ---------
+# 以语料中各文档块自带的问题为查询，对比只做向量检索与检索 depth 个候选后在不同时间预算下重排的 hit@k，
+# 延迟为检索加重排的总耗时，按 p50 / p99 统计；reranked 为已打分候选的比例，full 为在预算内重排完的查询比例；
+# budget 为 0 表示不限时
+def bench_rerank(model_name, reranker_name, path, k=5, depth=20, budgets=(0.05, 0.1, 0.3, 0), repeat=3):
+    from encoder import load_model
+    from reranker import load_reranker, rerank
+    from 向量构建 import build_combined_index, combine_block_text, parse_and_merge_blocks, retrieve_combined_blocks
+    blocks = parse_and_merge_blocks(path)
+    model = load_model(model_name)
+    reranker = load_reranker(reranker_name)
+    index, _ = build_combined_index(blocks, model_name, model=model)
+    pairs = [(qa['question'], i) for i, block in enumerate(blocks) for qa in block['qas']]
+    # 预热，第一次前向的初始化不计入延迟
+    reranker.predict([(pairs[0][0], combine_block_text(blocks[0]))], show_progress_bar=False)
+
+    def text(result):
+        return combine_block_text({'text': result[2], 'qas': result[3]})
+
+    def reranked(question, budget):
+        results = retrieve_combined_blocks(question, model, index, blocks, depth)
+        results, scored, status = rerank(question, results, reranker, text, depth, k, budget or None)
+        return [block_id for _, block_id, _, _ in results], scored, status == 'full'
+
+    runs = [('dense', lambda q: ([block_id for _, block_id, _, _ in
+                                  retrieve_combined_blocks(q, model, index, blocks, k)], 0, False))]
+    for budget in budgets:
+        runs.append((f"rerank {budget * 1000:.0f}ms" if budget else 'rerank no limit',
+                     lambda q, budget=budget: reranked(q, budget)))
+    print(f"查询数: {len(pairs)}  文档块数: {len(blocks)}  重排候选数: {depth}")
+    print(f"{'mode':>16} {f'hit@{k}':>8} {'reranked':>9} {'full':>6} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, run in runs:
+        hits = scored = full = 0
+        latencies = []
+        for _ in range(repeat):
+            for question, answer in pairs:
+                start = time.perf_counter()
+                found, num_scored, is_full = run(question)
+                latencies.append(time.perf_counter() - start)
+                hits += answer in found
+                scored += num_scored
+                full += is_full
+        total = repeat * len(pairs)
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f"{name:>16} {hits / total:>8.3f} {scored / total / depth:>9.2f} {full / total:>6.2f} "
+              f"{p50:>8.2f} {p99:>8.2f}")
+
+
+# --------- 一次性构建与分块流式构建的峰值内存 ---------
+# 峰值按 tracemalloc 统计（包括 numpy 数组），模型本身的内存不计入
+def bench_stream(model_name, path, chunk_sizes):
+    from encoder import load_model
+    from 向量构建 import build_combined_index, build_combined_index_streaming, iter_blocks, parse_and_merge_blocks
+    model = load_model(model_name)
+
+    def whole():
+        return build_combined_index(parse_and_merge_blocks(path), model_name, cache_dir=None, model=model)
+
+    def streaming(chunk_size):
+        with open(path, 'r', encoding='utf-8') as f:
+            return build_combined_index_streaming(iter_blocks(f), model_name, cache_dir=None, model=model,
+                                                  chunk_size=chunk_size, keep_blocks=False)
+
+    print(f"{'mode':>16} {'seconds':>10} {'peak MB':>10}")
+    runs = [('whole', whole)] + [(f"stream {size}", lambda size=size: streaming(size)) for size in chunk_sizes]
+    for name, run in runs:
+        tracemalloc.start()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:>16} {elapsed:>10.2f} {peak / 2 ** 20:>10.2f}")
+
+
+# --------- 多个 worker 的内存占用 ---------
+# 各 worker 打开同一个检索包、检索并读取全部文档块，全部就绪后读取 /proc/self/smaps_rollup 中的 Pss
+# （共享页按映射它的进程数均摊），减去打开检索包之前的基线。仅适用于 Linux
+def _pss_bytes():
+    with open('/proc/self/smaps_rollup', 'r') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _memory_worker(path, mmap, queries, k, barrier, results):
+    from vector_store import load_bundle
+    before = _pss_bytes()
+    index, blocks, _ = load_bundle(path, mmap=mmap)
+    index.search(queries, k)
+    for _ in blocks:
+        pass
+    barrier.wait()
+    results.put(_pss_bytes() - before)
+    barrier.wait()
+
+
+def bench_shared(embeddings, queries, k, workers):
+    from vector_store import load_bundle, save_bundle
+    blocks = [{"text": f"文档 {i} " + "示例内容" * 20, "qas": [{"question": f"问题 {i}", "answer": f"答案 {i}"}], "id": i}
+              for i in range(len(embeddings))]
+    index = build_ann_index(embeddings, 'flat')
+    root = tempfile.mkdtemp()
+    try:
+        save_bundle(os.path.join(root, 'faiss'), index, blocks, 'bench')
+        save_bundle(os.path.join(root, 'shared'), index, blocks, 'bench', shared=True)
+        formats = [('faiss', os.path.join(root, 'faiss'), False), ('faiss mmap', os.path.join(root, 'faiss'), True),
+                   ('shared fp16', os.path.join(root, 'shared'), True)]
+        context = multiprocessing.get_context('spawn')
+        print(f"向量数: {len(embeddings)}  维度: {embeddings.shape[1]}")
+        print(f"{'format':>12} {'ms/query':>10} {'workers':>8} {'total MB':>10} {'MB/worker':>10}")
+        for name, path, mmap in formats:
+            opened = load_bundle(path, mmap=mmap)[0]
+            start = time.perf_counter()
+            for i in range(len(queries)):
+                opened.search(queries[i:i + 1], k)
+            latency = (time.perf_counter() - start) / len(queries)
+            del opened
+            for num_workers in workers:
+                barrier = context.Barrier(num_workers)
+                results = context.Queue()
+                processes = [context.Process(target=_memory_worker, args=(path, mmap, queries, k, barrier, results))
+                             for _ in range(num_workers)]
+                for process in processes:
+                    process.start()
+                total = sum(results.get() for _ in processes)
+                for process in processes:
+                    process.join()
+                print(f"{name:>12} {latency * 1000:>10.3f} {num_workers:>8} {total / 2 ** 20:>10.1f} "
+                      f"{total / num_workers / 2 ** 20:>10.1f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def load_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_ints(text):
+    return [int(value) for value in text.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="向量索引性能测试")
+    parser.add_argument('bench', choices=['ann', 'storage', 'encoder', 'batch', 'hybrid', 'rerank', 'stream',
+                                          'shared'])
+    parser.add_argument('--data', default=None, help='[TEXT]/[QUESTION]/[ANSWER] 格式的语料，ann 不指定时使用合成向量')
+    parser.add_argument('--model', default='paraphrase-multilingual-MiniLM-L12-v2')
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--query-file', default='question.txt')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--nprobe', default='1,4,16,64')
+    parser.add_argument('--ef-search', default='16,32,64,128')
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--train-size', type=int, default=100000)
+    parser.add_argument('--index-type', default='flat', choices=['flat', 'ivf', 'hnsw'])
+    parser.add_argument('--pca-dims', default='192,96')
+    parser.add_argument('--backends', default='torch,torch-int8,onnx,onnx-int8')
+    parser.add_argument('--batch-sizes', default='8,32,128')
+    parser.add_argument('--clients', default='1,8,32')
+    parser.add_argument('--chunk-sizes', default='256,1024')
+    parser.add_argument('--workers', default='1,4')
+    parser.add_argument('--reranker', default='cross-encoder/mmarco-mMiniLMv2-L12-H384-v1')
+    parser.add_argument('--depth', type=int, default=20)
+    parser.add_argument('--budgets', default='0.05,0.1,0.3,0', help='重排的时间预算（秒），0 表示不限时')
+    args = parser.parse_args()
+
+    if args.bench in ('ann', 'storage', 'shared'):
+        if args.data:
+            embeddings = corpus_embeddings(args.data, args.model)
+        else:
+            embeddings = synthetic_embeddings(args.size, args.dim)
+        queries = split_queries(embeddings, min(args.queries, len(embeddings)))
+    if args.bench == 'storage':
+        # nprobe / efSearch 取各自候选列表中最大的一个，尽量只反映量化本身的损失
+        bench_storage(embeddings, queries, args.k, args.index_type, parse_ints(args.pca_dims),
+                      max(parse_ints(args.nprobe)), max(parse_ints(args.ef_search)), args.train_size)
+    elif args.bench == 'ann':
+        bench_ann(embeddings, queries, args.k, parse_ints(args.nprobe), parse_ints(args.ef_search),
+                  args.hnsw_m, args.train_size)
+    elif args.bench == 'encoder':
+        if not args.data:
+            parser.error('encoder 需要用 --data 指定语料')
+        bench_encoder(args.model, args.backends.split(','), load_lines(args.query_file), corpus_texts(args.data),
+                      args.k, args.repeat)
+    elif args.bench == 'batch':
+        if not args.data:
+            parser.error('batch 需要用 --data 指定语料')
+        bench_batch(args.model, load_lines(args.query_file), corpus_texts(args.data), parse_ints(args.batch_sizes),
+                    parse_ints(args.clients), args.k, args.repeat)
+    elif args.bench == 'hybrid':
+        if not args.data:
+            parser.error('hybrid 需要用 --data 指定语料')
+        bench_hybrid(args.model, args.data, args.k, args.repeat)
+    elif args.bench == 'rerank':
+        if not args.data:
+            parser.error('rerank 需要用 --data 指定语料')
+        bench_rerank(args.model, args.reranker, args.data, args.k, args.depth,
+                     [float(budget) for budget in args.budgets.split(',')], args.repeat)
+    elif args.bench == 'stream':
+        if not args.data:
+            parser.error('stream 需要用 --data 指定语料')
+        bench_stream(args.model, args.data, parse_ints(args.chunk_sizes))
+    elif args.bench == 'shared':
+        bench_shared(embeddings, queries, args.k, parse_ints(args.workers))
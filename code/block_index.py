@@ -0,0 +1,222 @@
+import hashlib
+import os
+import pickle
+import struct
+import threading
+import zlib
+from itertools import islice
+
+import numpy as np
+
+from ann_index import remove_ids
+from embedding_cache import encode_with_cache, open_cache
+from encoder import DEFAULT_MODEL, model_key
+from vector_store import load_bundle, save_bundle
+from 向量构建 import build_combined_index_streaming, combine_block_text
+
+# --------- 稳定的文档块 ID ---------
+# 文档块 ID 取自其文本的 sha1（前 63 位，保证是非负的 int64），与文档块在文件中的位置无关；
+# 同一文本重复出现时按出现顺序依次编号。只改问答时 ID 不变，文本改动则视为删除旧块、新增新块
+def block_key(text, occurrence=0):
+    digest = hashlib.sha1(f"{text}\0{occurrence}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little') & ((1 << 63) - 1)
+
+
+def assign_block_ids(blocks):
+    occurrences = {}
+    for block in blocks:
+        key = block_key(block['text'])
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        yield dict(block, id=key if occurrence == 0 else block_key(block['text'], occurrence))
+
+
+# --------- 增量日志格式 ---------
+# 检索包目录下的 delta.log 记录上次完整保存之后的所有修改，每条记录为 (负载长度, crc32) + pickle 负载：
+#   ('upsert', 文档块列表, 向量矩阵)  ('delete', ID 列表)  ('source_hash', hash)
+# 打开时在完整检索包上依次重放；重放是幂等的，完整保存后、清空日志前中断也不会出错
+RECORD = struct.Struct('<II')
+
+
+# --------- 可增量更新的向量索引 ---------
+# 向量索引以文档块 ID 为向量 id，blocks 为 {ID: 文档块} 字典，二者可以直接传给 retrieve_combined_blocks。
+# 增删改只编码变化的文档块并追加到增量日志，累计修改 max_delta_blocks 个文档块后自动完整保存一次。
+# 修改会原地改动 index（HNSW 删除时会换成新对象），需在没有检索进行时调用，检索时每次都取 self.index；
+# query_cache 不为空时修改后自动调用其 invalidate()
+class BlockIndex:
+    def __init__(self, path, index, blocks, model_name, source_hash='', index_type='flat', index_params=None,
+                 cache_dir='embedding_cache', max_delta_blocks=1000):
+        self.path = path
+        self.index = index
+        self.blocks = blocks
+        self.model_name = model_name
+        self.source_hash = source_hash
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        # 向量缓存推迟到第一次编码时才打开：源文件未变化时 open 不编码，不必载入整个缓存的条目表
+        self.cache_dir = cache_dir
+        self.cache = None
+        self.max_delta_blocks = max_delta_blocks
+        self.delta_blocks = 0
+        self.query_cache = None
+        self._lock = threading.Lock()
+
+    # 从文档块（可以是生成器）分块编码构建，并写出完整的检索包
+    @classmethod
+    def build(cls, path, blocks, model, model_name=DEFAULT_MODEL, backend='torch', source_hash='',
+              index_type='flat', index_params=None, cache_dir='embedding_cache', chunk_size=1024, **kwargs):
+        index, _, kept = build_combined_index_streaming(assign_block_ids(blocks), model_name, cache_dir, model=model,
+                                                        index_type=index_type, index_params=index_params,
+                                                        backend=backend, chunk_size=chunk_size, use_ids=True)
+        store = cls(path, index, {block['id']: block for block in kept}, model_key(model_name, backend),
+                    source_hash, index_type, index_params, cache_dir, **kwargs)
+        store.save()
+        return store
+
+    # model_name 为 encoder.model_key 的结果；包不存在时抛 OSError，与参数不符时抛 ValueError
+    @classmethod
+    def open(cls, path, model_name=None, index_type=None, index_params=None, cache_dir='embedding_cache',
+             **kwargs):
+        # 需要原地增删向量，不能以 mmap 方式只读打开
+        index, blocks, manifest = load_bundle(path, model_name, None, index_type, index_params, mmap=False)
+        if not isinstance(blocks, dict):
+            raise ValueError(f"检索包中的文档块没有稳定 ID，需要重建: {path}")
+        store = cls(path, index, blocks, manifest['model_name'], manifest['source_hash'],
+                    manifest.get('index_type', 'flat'), manifest.get('index_params', {}), cache_dir, **kwargs)
+        store._replay()
+        return store
+
+    def _delta_path(self):
+        return os.path.join(self.path, 'delta.log')
+
+    # --------- 修改 ---------
+    # 新增或修改文档块，只编码 ID 不存在或内容有变化的文档块，返回 (新增数, 修改数)
+    def upsert_blocks(self, blocks, model):
+        return self._upsert(list(assign_block_ids(blocks)), model)
+
+    # 删除指定 ID 的文档块，返回实际删除的个数
+    def delete_blocks(self, block_ids):
+        block_ids = [int(block_id) for block_id in block_ids if int(block_id) in self.blocks]
+        if not block_ids:
+            return 0
+        self._write(('delete', block_ids), len(block_ids))
+        return len(block_ids)
+
+    # 与整个语料对齐：分块写入新增或修改的文档块，再删除语料中已不存在的文档块，返回 (新增数, 修改数, 删除数)
+    def sync(self, blocks, model, source_hash='', chunk_size=1024):
+        seen = set()
+        added = updated = 0
+        blocks = assign_block_ids(blocks)
+        try:
+            while True:
+                chunk = list(islice(blocks, chunk_size))
+                if not chunk:
+                    break
+                seen.update(block['id'] for block in chunk)
+                chunk_added, chunk_updated = self._upsert(chunk, model, flush=False)
+                added += chunk_added
+                updated += chunk_updated
+        finally:
+            # 向量缓存的淘汰、压缩与条目表重写在全部分块完成（或中断）后统一做一次
+            if self.cache is not None:
+                self.cache.flush()
+        deleted = self.delete_blocks([block_id for block_id in self.blocks if block_id not in seen])
+        if source_hash != self.source_hash:
+            self._write(('source_hash', source_hash), 0)
+        return added, updated, deleted
+
+    def _upsert(self, blocks, model, flush=True):
+        changed = [block for block in blocks
+                   if block['id'] not in self.blocks
+                   or combine_block_text(self.blocks[block['id']]) != combine_block_text(block)]
+        if not changed:
+            return 0, 0
+        updated = sum(block['id'] in self.blocks for block in changed)
+        vectors = self._encode(changed, model, flush)
+        if vectors.shape[1] != self.index.d:
+            raise ValueError(f"向量维度 {vectors.shape[1]} 与索引维度 {self.index.d} 不一致")
+        self._write(('upsert', changed, vectors), len(changed))
+        return len(changed) - updated, updated
+
+    def _encode(self, blocks, model, flush=True):
+        texts = [combine_block_text(block) for block in blocks]
+        if self.cache is None and self.cache_dir:
+            self.cache = open_cache(self.cache_dir)
+        if self.cache is not None:
+            return encode_with_cache(model, texts, self.cache, self.model_name, flush=flush)
+        return np.ascontiguousarray(model.encode(texts, convert_to_numpy=True), dtype=np.float32)
+
+    # 先写日志再修改内存中的索引
+    def _write(self, record, num_blocks):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            with open(self._delta_path(), 'ab') as f:
+                f.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(record)
+            self.delta_blocks += num_blocks
+        if self.query_cache is not None:
+            self.query_cache.invalidate()
+        if self.delta_blocks >= self.max_delta_blocks:
+            self.save()
+
+    def _apply(self, record):
+        kind = record[0]
+        if kind == 'upsert':
+            _, blocks, vectors = record
+            ids = np.array([block['id'] for block in blocks], dtype=np.int64)
+            existing = [block_id for block_id in ids if block_id in self.blocks]
+            if existing:
+                self.index = remove_ids(self.index, existing)
+            self.index.add_with_ids(vectors, ids)
+            for block in blocks:
+                self.blocks[block['id']] = block
+        elif kind == 'delete':
+            # 重放时记录中的文档块可能已经不存在
+            block_ids = [block_id for block_id in record[1] if block_id in self.blocks]
+            if block_ids:
+                self.index = remove_ids(self.index, block_ids)
+            for block_id in block_ids:
+                del self.blocks[block_id]
+        elif kind == 'source_hash':
+            self.source_hash = record[1]
+        else:
+            raise ValueError(f"未知的增量日志记录: {kind}")
+
+    def _replay(self):
+        try:
+            with open(self._delta_path(), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, crc = RECORD.unpack_from(data, offset)
+            payload = data[offset + RECORD.size:offset + RECORD.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            record = pickle.loads(payload)
+            self._apply(record)
+            self.delta_blocks += len(record[1]) if record[0] != 'source_hash' else 0
+            offset += RECORD.size + length
+        if offset < len(data):
+            # 写到一半中断的记录直接截掉
+            with open(self._delta_path(), 'r+b') as f:
+                f.truncate(offset)
+
+    # --------- 保存 ---------
+    # 写出完整的检索包并清空增量日志
+    def save(self):
+        with self._lock:
+            save_bundle(self.path, self.index, self.blocks, self.model_name, self.source_hash,
+                        self.index_type, self.index_params)
+            open(self._delta_path(), 'wb').close()
+            self.delta_blocks = 0
+
+    # 文档块 ID 与内容的摘要，用来判断按当前顺序建的关键词索引是否过期
+    def fingerprint(self):
+        digest = hashlib.md5()
+        for block_id, block in self.blocks.items():
+            digest.update(f"{block_id}\0{combine_block_text(block)}\0".encode('utf-8'))
+        return digest.hexdigest()
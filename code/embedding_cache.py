@@ -0,0 +1,483 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# --------- 向量缓存格式 ---------
+# 缓存是一个目录，包含五个文件：
+#   vectors.bin 所有向量首尾相接存放的数据区，只追加写入，淘汰后整体压缩
+#   index.npy   定长条目表 (key, offset, dim, last_used)，key 为 sha1(模型名 + 文本)
+#   index.log   index.npy 之后新增或更新的条目，格式与条目表相同，只追加写入；同一 key 以最后一条为准
+#   meta.json   格式版本、向量精度、LRU 计数器与条目表的版本号（每次重写 index.npy 加一）
+#   lock        进程间的文件锁
+# 文本或模型变化时 key 随之变化，重建索引时只有新增或修改过的文本需要重新编码。
+# 写入向量时对应条目立即追加到 index.log，日志条目数超过条目表时才重写 index.npy，写入量与变化量成正比
+FORMAT_VERSION = 1
+ENTRY = np.dtype([
+    ('key', 'S20'),
+    ('offset', '<u8'),
+    ('dim', '<u4'),
+    ('last_used', '<u8'),
+])
+
+
+def cache_key(model_name, text):
+    return hashlib.sha1(f"{model_name}\0{text}".encode('utf-8')).digest()
+
+
+def _replace_file(path, write):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+# --------- 并发 ---------
+# 同一目录可能同时被多个线程（Streamlit 的多个会话）和多个进程（共用检索包的 worker）使用。
+# 进程内用 open_cache 共用一个实例；所有读写都在进程内的锁和目录下的文件锁之内进行，
+# 每次操作前先读入其他进程追加的条目，条目表被重写（淘汰、压缩）过时整体重新载入，不会沿用失效的偏移
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# max_bytes 为 None 时沿用已打开实例的上限（新打开时为 1GB）
+def open_cache(path, max_bytes=None, dtype='float32'):
+    key = os.path.realpath(path)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = EmbeddingCache(path, max_bytes or 1 << 30, dtype)
+        elif cache.dtype != np.dtype(dtype):
+            raise ValueError(f"向量缓存 {path} 已以 {cache.dtype} 精度打开，与 {dtype} 不一致")
+        elif max_bytes is not None:
+            cache.max_bytes = max_bytes
+        return cache
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# --------- 磁盘向量缓存 ---------
+# dtype 可选 float32 或 float16；超过 max_bytes 时按最近使用时间淘汰，只保留较新的条目。
+# 一般通过 open_cache 获取，同一目录在进程内只有一个实例
+class EmbeddingCache:
+    def __init__(self, path, max_bytes=1 << 30, dtype='float32'):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.entries = {}
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = None
+        self._dirty = False
+        # 命中后更新过 last_used、尚未写入磁盘的条目
+        self._touched = {}
+        self._generation = None
+        self._log_entries = 0
+        self._total_dim = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._lock_handle = open(self._file('lock'), 'a+b')
+        with self._locked():
+            self._sync()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            _lock_file(self._lock_handle)
+            try:
+                yield
+            finally:
+                _unlock_file(self._lock_handle)
+
+    # 与磁盘上的缓存对齐：条目表版本号未变时只读入日志中新增的条目，否则整体重新载入
+    def _sync(self):
+        try:
+            with open(self._file('meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            self._reset()
+            return
+        if meta.get('version') != FORMAT_VERSION or np.dtype(meta.get('dtype')) != self.dtype:
+            # 版本或精度不一致时整个缓存作废；版本号继续递增，其他实例才会发现条目表已被重写
+            self._generation = max(self._generation or 0, meta.get('generation', 0))
+            self._reset()
+            return
+        if meta.get('generation', 0) != self._generation:
+            try:
+                entries = np.load(self._file('index.npy'))
+            except (OSError, ValueError):
+                self._reset()
+                return
+            if entries.dtype != ENTRY:
+                self._reset()
+                return
+            self.entries = {}
+            self._total_dim = 0
+            self._log_entries = 0
+            self._data = None
+            self._generation = meta.get('generation', 0)
+            self._apply(entries)
+        self._read_log()
+        # 写入条目后、写入 meta.json 前中断时，计数器以条目中最大的 last_used 为准
+        self.tick = max(self.tick, meta.get('tick', 0))
+        for key, last_used in self._touched.items():
+            if key in self.entries:
+                self.entries[key][2] = max(self.entries[key][2], last_used)
+
+    def _read_log(self):
+        start = self._log_entries * ENTRY.itemsize
+        try:
+            with open(self._file('index.log'), 'r+b') as f:
+                f.seek(start)
+                log = f.read()
+                if len(log) % ENTRY.itemsize:
+                    # 写到一半中断的条目直接截掉，之后的追加才能对齐
+                    f.truncate(start + len(log) // ENTRY.itemsize * ENTRY.itemsize)
+        except FileNotFoundError:
+            log = b''
+        log = np.frombuffer(log, dtype=ENTRY, count=len(log) // ENTRY.itemsize)
+        self._log_entries += len(log)
+        self._apply(log)
+
+    def _apply(self, entries):
+        if not len(entries):
+            return
+        size = os.path.getsize(self._file('vectors.bin')) if os.path.exists(self._file('vectors.bin')) else 0
+        # 追加向量后、写入条目前中断时，数据区末尾会多出无人引用的向量；反过来越界的条目直接丢弃
+        end = entries['offset'] + entries['dim'].astype(np.uint64) * self.dtype.itemsize
+        entries = entries[end <= size]
+        # 按原始字节取 key：以 S20 读出时末尾的 0 字节会被去掉
+        raw = entries['key'].tobytes()
+        key_size = ENTRY['key'].itemsize
+        for i, (offset, dim, last_used) in enumerate(zip(entries['offset'].tolist(), entries['dim'].tolist(),
+                                                         entries['last_used'].tolist())):
+            key = raw[i * key_size:(i + 1) * key_size]
+            old = self.entries.get(key)
+            self._total_dim += dim - (old[1] if old else 0)
+            self.entries[key] = [offset, dim, last_used]
+            self.tick = max(self.tick, last_used)
+
+    def _reset(self):
+        self.entries = {}
+        self.tick = 0
+        self._total_dim = 0
+        self._touched = {}
+        self._data = None
+        open(self._file('vectors.bin'), 'wb').close()
+        self._rewrite_index()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def nbytes(self):
+        return self._total_dim * self.dtype.itemsize
+
+    def _vectors(self):
+        size = os.path.getsize(self._file('vectors.bin'))
+        if self._data is None or len(self._data) * self.dtype.itemsize != size:
+            self._data = np.memmap(self._file('vectors.bin'), dtype=self.dtype, mode='r') if size else \
+                np.zeros(0, dtype=self.dtype)
+        return self._data
+
+    # 返回与 keys 等长的列表，未命中的位置为 None
+    def get_many(self, keys):
+        with self._locked():
+            self._sync()
+            data = self._vectors()
+            result = []
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    self.misses += 1
+                    result.append(None)
+                    continue
+                self.hits += 1
+                self.tick += 1
+                entry[2] = self._touched[key] = self.tick
+                start = entry[0] // self.dtype.itemsize
+                result.append(np.array(data[start:start + entry[1]], dtype=np.float32))
+            return result
+
+    # 写入向量并返回按缓存精度舍入后的结果，保证命中与未命中时得到的向量完全一致。
+    # 条目随向量一起追加到 index.log，其他实例与进程下次操作时即可读到
+    def put_many(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        with self._locked():
+            self._sync()
+            with open(self._file('vectors.bin'), 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(vectors.tobytes())
+            table = np.zeros(len(vectors), dtype=ENTRY)
+            table['key'] = keys
+            stride = vectors.shape[1] * self.dtype.itemsize
+            table['offset'] = offset + np.arange(len(vectors), dtype=np.uint64) * stride
+            table['dim'] = vectors.shape[1]
+            table['last_used'] = self.tick + 1 + np.arange(len(vectors), dtype=np.uint64)
+            with open(self._file('index.log'), 'ab') as f:
+                f.write(table.tobytes())
+            self._read_log()
+            self._dirty = True
+        return vectors.astype(np.float32)
+
+    # 写出命中后更新的 last_used，并按需淘汰、压缩数据区或重写条目表
+    def flush(self):
+        with self._locked():
+            self._sync()
+            if not self._dirty and not self._touched:
+                return
+            if self.nbytes() > self.max_bytes:
+                self._truncate_log()
+                self._evict()
+                self._rewrite_index()
+            elif os.path.getsize(self._file('vectors.bin')) > 2 * max(self.nbytes(), 1 << 20):
+                # 被覆盖或淘汰的向量超过一半时压缩数据区
+                self._truncate_log()
+                self._compact(list(self.entries))
+                self._rewrite_index()
+            elif self._log_entries + len(self._touched) > len(self.entries):
+                self._rewrite_index()
+            else:
+                self._append_touched()
+            self._dirty = False
+
+    def _evict(self):
+        kept = []
+        total = 0
+        for key, (_, dim, _) in sorted(self.entries.items(), key=lambda item: item[1][2], reverse=True):
+            total += dim * self.dtype.itemsize
+            if total > self.max_bytes:
+                break
+            kept.append(key)
+        self._compact(kept)
+
+    def _compact(self, keys):
+        data = self._vectors()
+        entries = {}
+        offset = 0
+        tmp_path = self._file('vectors.bin.tmp')
+        with open(tmp_path, 'wb') as f:
+            for key in keys:
+                start, dim, last_used = self.entries[key]
+                chunk = data[start // self.dtype.itemsize:start // self.dtype.itemsize + dim]
+                f.write(chunk.tobytes())
+                entries[key] = [offset, dim, last_used]
+                offset += chunk.nbytes
+        # 先关闭旧数据区的映射再替换文件（Windows 下不能替换仍被映射的文件）
+        data = chunk = self._data = None
+        os.replace(tmp_path, self._file('vectors.bin'))
+        self.entries = entries
+        self._total_dim = sum(dim for _, dim, _ in entries.values())
+
+    def _table(self, keys):
+        table = np.zeros(len(keys), dtype=ENTRY)
+        if keys:
+            values = np.array([self.entries[key] for key in keys], dtype=np.uint64)
+            table['key'] = keys
+            table['offset'] = values[:, 0]
+            table['dim'] = values[:, 1]
+            table['last_used'] = values[:, 2]
+        return table
+
+    # 数据区被压缩后日志中的偏移全部失效，必须在替换 vectors.bin 之前清空日志；
+    # 此后中断只会丢失尚未写入条目表的条目（下次重新编码），不会指向错误的向量
+    def _truncate_log(self):
+        open(self._file('index.log'), 'wb').close()
+        self._log_entries = 0
+
+    # 重写条目表并把版本号加一，其他实例下次操作时整体重新载入
+    def _rewrite_index(self):
+        table = self._table(list(self.entries))
+        _replace_file(self._file('index.npy'), lambda f: np.save(f, table))
+        self._truncate_log()
+        self._touched = {}
+        self._generation = (self._generation or 0) + 1
+        self._write_meta()
+
+    def _append_touched(self):
+        table = self._table([key for key in self._touched if key in self.entries])
+        with open(self._file('index.log'), 'ab') as f:
+            f.write(table.tobytes())
+        self._log_entries += len(table)
+        self._touched = {}
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {'version': FORMAT_VERSION, 'dtype': self.dtype.name, 'tick': self.tick,
+                'generation': self._generation}
+        _replace_file(self._file('meta.json'), lambda f: f.write(json.dumps(meta).encode('utf-8')))
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.nbytes()}
+
+
+# 先查缓存，只对未命中的文本调用 model.encode，返回 float32 矩阵。
+# 分块连续调用时传 flush=False，全部完成后再调用一次 cache.flush()
+def encode_with_cache(model, texts, cache, model_name, batch_size=32, flush=True):
+    keys = [cache_key(model_name, text) for text in texts]
+    vectors = cache.get_many(keys)
+    # 同一批里重复的文本只编码一次
+    missing = {}
+    for i, vector in enumerate(vectors):
+        if vector is None:
+            missing.setdefault(keys[i], []).append(i)
+    if missing:
+        first = [indices[0] for indices in missing.values()]
+        encoded = model.encode([texts[i] for i in first], batch_size=batch_size, convert_to_numpy=True)
+        for indices, vector in zip(missing.values(), cache.put_many(list(missing), encoded)):
+            for i in indices:
+                vectors[i] = vector
+    if flush:
+        cache.flush()
+    return np.vstack(vectors).astype(np.float32)
+
+
+# --------- 查询向量缓存 ---------
+# 全角/半角、连续空白不同的查询视为同一个查询，编码时也使用规范化后的文本
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', query)).strip()
+
+
+# 按规范化查询缓存查询向量；result_size 大于 0 时还缓存完整的 top-k 结果。
+# 查询向量与模型绑定，检索结果与向量索引绑定：换了模型或索引（重建）时对应的缓存自动清空，
+# 原地修改索引后需要调用 invalidate()
+class QueryCache:
+    def __init__(self, size=4096, result_size=0):
+        self.size = size
+        self.result_size = result_size
+        self.vectors = OrderedDict()
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.result_hits = 0
+        self.result_misses = 0
+        self._model = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bound_to(ref, obj):
+        return ref is not None and ref() is obj
+
+    def _put(self, cache, size, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    # 返回 1 x dim 的查询向量
+    def encode(self, model, query):
+        query = normalize_query(query)
+        with self._lock:
+            if not self._bound_to(self._model, model):
+                self.vectors.clear()
+                self._model = weakref.ref(model)
+            vector = self.vectors.get(query)
+            if vector is not None:
+                self.vectors.move_to_end(query)
+                self.hits += 1
+                return vector
+            self.misses += 1
+        vector = model.encode([query], convert_to_numpy=True)
+        vector.setflags(write=False)
+        with self._lock:
+            self._put(self.vectors, self.size, query, vector)
+        return vector
+
+    # 批量版本，未命中的查询合并成一次 model.encode，返回 len(queries) x dim 的矩阵
+    def encode_many(self, model, queries, batch_size=32):
+        queries = [normalize_query(query) for query in queries]
+        with self._lock:
+            if not self._bound_to(self._model, model):
+                self.vectors.clear()
+                self._model = weakref.ref(model)
+            found = {}
+            for query in queries:
+                vector = self.vectors.get(query)
+                if vector is not None:
+                    self.vectors.move_to_end(query)
+                    found[query] = vector
+            self.hits += sum(query in found for query in queries)
+            self.misses += sum(query not in found for query in queries)
+        missing = list(dict.fromkeys(query for query in queries if query not in found))
+        if missing:
+            encoded = model.encode(missing, batch_size=batch_size, convert_to_numpy=True)
+            with self._lock:
+                for query, vector in zip(missing, encoded):
+                    vector = vector[None, :]
+                    vector.setflags(write=False)
+                    found[query] = vector
+                    self._put(self.vectors, self.size, query, vector)
+        return np.vstack([found[query] for query in queries])
+
+    # key 里除查询外还应包含 top_k 与检索参数
+    def get_results(self, index, key):
+        if not self.result_size:
+            return None
+        with self._lock:
+            if not self._bound_to(self._index, index):
+                self.results.clear()
+                self._index = weakref.ref(index)
+            results = self.results.get(key)
+            if results is None:
+                self.result_misses += 1
+                return None
+            self.results.move_to_end(key)
+            self.result_hits += 1
+            return results
+
+    def put_results(self, index, key, results):
+        if not self.result_size:
+            return
+        with self._lock:
+            if self._bound_to(self._index, index):
+                self._put(self.results, self.result_size, key, results)
+
+    def invalidate(self):
+        with self._lock:
+            self.results.clear()
+            self._index = None
+
+    def clear(self):
+        with self._lock:
+            self.vectors.clear()
+            self.results.clear()
+            self._model = None
+            self._index = None
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'result_hits': self.result_hits,
+                'result_misses': self.result_misses, 'vectors': len(self.vectors), 'results': len(self.results)}
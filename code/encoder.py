@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MODEL = 'paraphrase-multilingual-MiniLM-L12-v2'
+
+# --------- 编码后端 ---------
+#   torch       PyTorch fp32，默认
+#   torch-int8  PyTorch 动态量化，所有 Linear 层的权重转成 int8，激活在运行时量化
+#   onnx        ONNX Runtime fp32（模型仓库里没有 onnx 文件时自动导出）
+#   onnx-int8   ONNX Runtime 动态量化模型，默认使用模型仓库中 AVX2 指令集的 int8 文件
+BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+ONNX_INT8_FILE = 'onnx/model_quint8_avx2.onnx'
+# 两个 onnx 后端额外依赖 optimum 与 onnxruntime，不在 requirements.txt 中：pip install -r requirements-onnx.txt
+
+
+# 不同后端编码出的向量有细微差别，缓存与检索包按 (模型, 后端) 区分
+def model_key(model_name=DEFAULT_MODEL, backend='torch'):
+    return model_name if backend == 'torch' else f"{model_name}@{backend}"
+
+
+# sentence_transformers 依赖 torch，导入本身就要几秒，推迟到真正加载模型时再导入
+def load_model(model_name=DEFAULT_MODEL, backend='torch', onnx_file=None):
+    if backend not in BACKENDS:
+        raise ValueError(f"未知的编码后端: {backend}")
+    from sentence_transformers import SentenceTransformer
+    if backend == 'torch':
+        return SentenceTransformer(model_name)
+    if backend == 'torch-int8':
+        import torch
+        model = SentenceTransformer(model_name, device='cpu')
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    try:
+        import optimum.onnxruntime
+    except ImportError as e:
+        raise ImportError(f"编码后端 {backend} 需要 optimum 与 onnxruntime，请先 pip install -r requirements-onnx.txt") from e
+    model_kwargs = {'provider': 'CPUExecutionProvider'}
+    if backend == 'onnx-int8' or onnx_file:
+        model_kwargs['file_name'] = onnx_file or ONNX_INT8_FILE
+    return SentenceTransformer(model_name, backend='onnx', model_kwargs=model_kwargs)
+
+
+# 在后台线程加载模型，返回 Future；打开检索包、等待输入的同时加载，第一次检索时再取结果
+def load_model_in_background(model_name=DEFAULT_MODEL, backend='torch', onnx_file=None):
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(load_model, model_name, backend, onnx_file)
+    executor.shutdown(wait=False)
+    return future
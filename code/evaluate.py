@@ -6,6 +6,8 @@ from volcengine.Credentials import Credentials
 import numpy as np
 from collections import Counter
 
+from qa_corpus import is_compiled_corpus, open_corpus
+
 
 # 初始化知识库服务相关配置
 collection_name = ""
@@ -254,6 +256,11 @@ def search_knowledge_and_chat_completion():
 
 
 def read_test_answer(file_path):
+    # 编译好的语料按偏移表直接读取
+    if is_compiled_corpus(file_path):
+        with open_corpus(file_path) as corpus:
+            qa_pairs = list(corpus.iter_qa())
+        return [qa[0] for qa in qa_pairs], [qa[1] for qa in qa_pairs]
     questions = []
     answers = []
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -0,0 +1,148 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ann_index import search
+from 倒排索引构建 import InvertedIndex
+from 向量构建 import combine_block_text
+
+# 关键词检索在这个线程里执行，与当前线程里的查询编码、向量检索同时进行
+_lexical_executor = ThreadPoolExecutor(max_workers=1)
+
+
+# --------- 关键词索引 ---------
+# 倒排索引的 doc_id 与文档块在 blocks 中的下标一一对应，与向量索引共用同一套编号。
+# 向量索引以稳定 ID 为向量 id 时（见 block_index.py），按 doc_id 顺序建一个 ID 列表作为 retrieve_hybrid 的 lexical_ids
+def build_lexical_index(blocks, **index_args):
+    index = InvertedIndex(**index_args)
+    index.build_index([combine_block_text(block) for block in blocks])
+    return index
+
+
+# --------- 随 BlockIndex 增量更新的关键词索引 ---------
+# 关键词索引保存在 path 目录下（见 InvertedIndex.save），另存一张以 doc_id 为下标的 (文档块 ID, 文本摘要) 表
+# block_ids.npz，已删除的文档为 -1。两者都记录 blocks 的指纹（BlockIndex.fingerprint()），指纹不一致时说明
+# 中途被打断，整体重建
+LEXICAL_IDS = np.dtype([('block_id', '<i8'), ('digest', '<u8')])
+
+
+def _text_digest(text):
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8], 'little')
+
+
+def _save_lexical(path, index, table, fingerprint):
+    index.save(path, fingerprint)
+    ids_path = os.path.join(path, 'block_ids.npz')
+    with open(ids_path + '.tmp', 'wb') as f:
+        np.savez(f, ids=table, fingerprint=np.array(fingerprint))
+    os.replace(ids_path + '.tmp', ids_path)
+
+
+# blocks 为 {文档块 ID: 文档块}（BlockIndex.blocks），返回 (关键词索引, lexical_ids)。
+# 文档块有增删改时按文档块 ID 找到对应的 doc_id，经 add / update_document / delete_document 增量修改后保存，
+# 只对变化的文档块重新分词；磁盘上没有可用的索引时整体构建
+def open_lexical_index(path, blocks, fingerprint, **index_args):
+    try:
+        index = InvertedIndex.open(path)
+        with np.load(os.path.join(path, 'block_ids.npz')) as data:
+            table = data['ids']
+            saved = str(data['fingerprint'])
+        if table.dtype != LEXICAL_IDS or saved != index.source_hash or len(table) != index.doc_id_counter:
+            raise ValueError("关键词索引与文档块 ID 表不一致")
+    except (OSError, ValueError, KeyError):
+        texts = [combine_block_text(block) for block in blocks.values()]
+        index = InvertedIndex(**index_args)
+        index.build_index(texts)
+        table = np.array([(block_id, _text_digest(text)) for block_id, text in zip(blocks, texts)],
+                         dtype=LEXICAL_IDS)
+        _save_lexical(path, index, table, fingerprint)
+        return index, table['block_id'].tolist()
+    if index.source_hash != fingerprint:
+        docs = {block_id: doc_id for doc_id, block_id in enumerate(table['block_id'].tolist()) if block_id >= 0}
+        for block_id, doc_id in docs.items():
+            if block_id not in blocks:
+                index.delete_document(doc_id)
+                table['block_id'][doc_id] = -1
+        updates = []
+        added = []
+        for block_id, block in blocks.items():
+            text = combine_block_text(block)
+            digest = _text_digest(text)
+            doc_id = docs.get(block_id)
+            if doc_id is None:
+                added.append((block_id, digest, text))
+            elif int(table['digest'][doc_id]) != digest:
+                updates.append((doc_id, text))
+                table['digest'][doc_id] = digest
+        index.update_documents(updates)
+        # build_index 按 doc_id_counter 依次编号，新增文档接在表的末尾
+        index.build_index([text for _, _, text in added])
+        table = np.concatenate([table, np.array([(block_id, digest) for block_id, digest, _ in added],
+                                                dtype=LEXICAL_IDS)])
+        _save_lexical(path, index, table, fingerprint)
+    return index, table['block_id'].tolist()
+
+
+# --------- 两路检索 ---------
+# 返回 [(文档块下标, 分数)]，按分数从高到低
+def _dense_leg(query, model, index, depth, nprobe, ef_search, cache):
+    query_vec = model.encode([query], convert_to_numpy=True) if cache is None else cache.encode(model, query)
+    distances, indices = search(index, query_vec, depth, nprobe, ef_search)
+    return [(int(idx), 1 / (1 + float(distance))) for distance, idx in zip(distances[0], indices[0]) if idx >= 0]
+
+
+def _lexical_leg(query, lexical_index, depth):
+    # 关键词查询经 jieba 切分后常有子词不在语料中，用 'or' 避免返回空结果
+    return lexical_index.rank(query, depth, scoring='bm25', mode='or')
+
+
+# --------- 融合 ---------
+# 倒数排名融合：每一路按名次贡献 weight / (rrf_k + 名次)，不受两路分数量纲不同的影响
+def reciprocal_rank_fusion(legs, rrf_k=60):
+    fused = {}
+    for results, weight in legs:
+        for rank, (doc, _) in enumerate(results, 1):
+            fused[doc] = fused.get(doc, 0.0) + weight / (rrf_k + rank)
+    return fused
+
+
+# 加权分数融合：每一路的分数先按候选集内的最大最小值归一化到 [0, 1]，没召回的文档记 0
+def weighted_score_fusion(legs):
+    fused = {}
+    for results, weight in legs:
+        if not results:
+            continue
+        scores = [score for _, score in results]
+        low, high = min(scores), max(scores)
+        for doc, score in results:
+            normalized = (score - low) / (high - low) if high > low else 1.0
+            fused[doc] = fused.get(doc, 0.0) + weight * normalized
+    return fused
+
+
+# 两路各取前 depth 个候选，融合后返回前 top_k 个，格式与 retrieve_combined_blocks 相同（分数为融合后的分数）。
+# fusion 可选 'rrf' 或 'weighted'，dense_weight 为向量检索一路的权重，关键词一路为 1 - dense_weight。
+# lexical_ids 不为空时把关键词检索的 doc_id 换成 lexical_ids[doc_id]，与向量索引的 id 对齐
+def retrieve_hybrid(query, model, index, lexical_index, blocks, top_k=5, fusion='rrf', dense_weight=0.5,
+                    depth=50, rrf_k=60, nprobe=None, ef_search=None, cache=None, lexical_ids=None):
+    lexical = _lexical_executor.submit(_lexical_leg, query, lexical_index, depth)
+    dense = _dense_leg(query, model, index, depth, nprobe, ef_search, cache)
+    lexical = lexical.result()
+    if lexical_ids is not None:
+        lexical = [(lexical_ids[doc], score) for doc, score in lexical]
+    legs = [(dense, dense_weight), (lexical, 1 - dense_weight)]
+    if fusion == 'rrf':
+        fused = reciprocal_rank_fusion(legs, rrf_k)
+    elif fusion == 'weighted':
+        fused = weighted_score_fusion(legs)
+    else:
+        raise ValueError(f"未知的融合方式: {fusion}")
+
+    results = []
+    # 分数相同时按下标排序，保证结果稳定
+    for doc, score in sorted(fused.items(), key=lambda item: (-item[1], item[0]))[:top_k]:
+        block = blocks[doc]
+        results.append((score, block["id"], block['text'], block['qas']))
+    return results
@@ -0,0 +1,149 @@
+from collections import defaultdict
+from collections.abc import Mapping
+from functools import lru_cache, partial
+
+import numpy as np
+
+from postings import PostingList, merge_postings
+
+# 被删除文档在文档长度数组中的标记，保存到段文件后重新打开时据此恢复删除状态
+DELETED_LENGTH = 0xFFFFFFFF
+
+
+# --------- 段 ---------
+# 索引由若干段组成，所有段共用同一个 doc_id 空间。同一个 doc_id 可能在多个段里出现
+# （更新前的旧版本与更新后的新版本），live_gens[doc_id] 记录其最新版本所在段的 generation，
+# 为 0 表示已删除，其余段里该文档的 posting 都视为墓碑
+class Segment:
+    def __init__(self, generation, terms=None, num_docs=0):
+        self.generation = generation
+        # 增量段用可追加的 defaultdict，磁盘段是只读的 SegmentTerms
+        self.terms = defaultdict(PostingList) if terms is None else terms
+        self.num_docs = num_docs
+        self.live_docs = num_docs
+        # 封存后不再追加
+        self.sealed = terms is not None
+        self.last_doc = -1
+        # 增量段上次冻结后追加过 posting 的词项，以及冻结出的只读词典
+        self.dirty = set()
+        self._frozen = {}
+
+    def deleted_ratio(self):
+        return 1 - self.live_docs / self.num_docs if self.num_docs else 0.0
+
+    # 给查询快照用的只读段。封存段的倒排表不再修改，直接返回自身；
+    # 增量段只复制上次冻结之后追加过的倒排表，其余沿用上一次冻结的副本
+    def freeze(self):
+        if self.sealed:
+            self._frozen = {}
+            return self
+        if self.dirty:
+            frozen = dict(self._frozen)
+            for term in self.dirty:
+                frozen[term] = self.terms[term].copy()
+            self._frozen = frozen
+            self.dirty = set()
+        segment = Segment(self.generation, self._frozen, self.num_docs)
+        segment.live_docs = self.live_docs
+        segment.last_doc = self.last_doc
+        return segment
+
+
+# --------- 合并策略 ---------
+# 增量段写满 max_delta_docs 个文档后封存；封存段超过 max_segments 个时合并最小的 merge_factor 个，
+# 已删除文档比例超过 max_deleted_ratio 的段单独合并以清除墓碑
+class MergePolicy:
+    def __init__(self, max_delta_docs=1000, max_segments=4, merge_factor=4, max_deleted_ratio=0.2):
+        self.max_delta_docs = max_delta_docs
+        self.max_segments = max_segments
+        self.merge_factor = max(merge_factor, 2)
+        self.max_deleted_ratio = max_deleted_ratio
+
+    def should_seal(self, delta):
+        return delta.num_docs >= self.max_delta_docs
+
+    # 返回需要合并的封存段列表，不需要合并时返回空列表
+    def find_merge(self, segments):
+        sealed = [segment for segment in segments if segment.sealed]
+        if len(sealed) > self.max_segments:
+            return sorted(sealed, key=lambda segment: segment.live_docs)[:self.merge_factor]
+        for segment in sealed:
+            if segment.deleted_ratio() > self.max_deleted_ratio:
+                return [segment]
+        return []
+
+
+# 词项在各段中尚未被删除的 posting，返回 [(倒排表, 保留掩码)]，全部保留时掩码为 None
+def _live_parts(segments, live_gens, term):
+    parts = []
+    for segment in segments:
+        if term not in segment.terms:
+            continue
+        postings = segment.terms[term]
+        if segment.live_docs < segment.num_docs:
+            keep = live_gens[postings.doc_ids()] == segment.generation
+            if not keep.any():
+                continue
+            parts.append((postings, None if keep.all() else keep))
+        else:
+            parts.append((postings, None))
+    return parts
+
+
+def _term_union(segments):
+    terms = set()
+    for segment in segments:
+        terms.update(segment.terms.keys())
+    return terms
+
+
+# 把若干段合并成一个新的封存段，跳过已删除的 posting。
+# live_gens 与 doc_lengths 是合并开始时的快照，合并期间新产生的墓碑由查询时的过滤处理
+def merge_segments(segments, generation, live_gens, doc_lengths):
+    merged = {}
+    for term in sorted(_term_union(segments)):
+        parts = _live_parts(segments, live_gens, term)
+        if len(parts) == 1 and parts[0][1] is None:
+            # 只出现在一个段且没有墓碑时，倒排表可以直接复用
+            merged[term] = parts[0][0]
+        elif parts:
+            merged[term] = merge_postings(parts, doc_lengths)
+    num_docs = int(np.isin(live_gens, [segment.generation for segment in segments]).sum())
+    return Segment(generation, merged, num_docs)
+
+
+def _merge_term(segments, live_gens, doc_lengths, term):
+    parts = _live_parts(segments, live_gens, term)
+    if not parts:
+        return None
+    if len(parts) == 1 and parts[0][1] is None:
+        return parts[0][0]
+    return merge_postings(parts, doc_lengths)
+
+
+# --------- 多段索引的只读视图 ---------
+# 查询时按词项把各段的 posting 合并成一个倒排表并去掉墓碑，结果放在 LRU 缓存里。
+# 视图创建后不再变化，写入或合并完成时索引会换上新的视图
+class LiveTerms(Mapping):
+    def __init__(self, segments, live_gens, doc_lengths, cache_size=1024):
+        self.segments = tuple(segments)
+        self.live_gens = live_gens
+        # 缓存不能引用视图自身，否则形成引用环，关闭索引时 mmap 上的视图无法及时释放
+        self._merged = lru_cache(maxsize=cache_size)(partial(_merge_term, self.segments, live_gens, doc_lengths))
+
+    def __getitem__(self, term):
+        postings = self._merged(term)
+        if postings is None:
+            raise KeyError(term)
+        return postings
+
+    def __contains__(self, term):
+        return self._merged(term) is not None
+
+    def __iter__(self):
+        for term in sorted(_term_union(self.segments)):
+            if _live_parts(self.segments, self.live_gens, term):
+                yield term
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -6,6 +6,8 @@ from volcengine.Credentials import Credentials
 import numpy as np
 from collections import Counter
 
+from qa_corpus import is_compiled_corpus, open_corpus
+
 
 # 初始化知识库服务相关配置
 collection_name = ""
@@ -277,6 +279,12 @@ def search_knowledge_and_chat_completion():
 
 
 def read_test_answer(file_path):
+    # 编译好的语料按偏移表直接读取，与下面按原始文本读出的结构相同：问答逐条，texts 每个文档块一条（含续行的原文）
+    if is_compiled_corpus(file_path):
+        with open_corpus(file_path) as corpus:
+            qa_pairs = list(corpus.iter_qa())
+            texts = [corpus.source_text(i) for i in range(len(corpus))]
+        return [qa[0] for qa in qa_pairs], [qa[1] for qa in qa_pairs], texts
     questions = []
     answers = []
     texts = []
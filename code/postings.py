@@ -0,0 +1,412 @@
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+
+import numpy as np
+
+# 每个块包含的 posting 数，块边界同时作为跳表指针，查询时按块惰性解码
+BLOCK_SIZE = 128
+# 游标走到倒排表末尾后的 doc_id
+END_OF_POSTINGS = 1 << 62
+
+
+# --------- varint 编解码 ---------
+def write_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+# 从 buf 的 start 处顺序读出 count 个 varint，适合短序列（如单个 posting 的位置）
+def read_varints(buf, start, count):
+    values = []
+    pos = start
+    for _ in range(count):
+        value = 0
+        shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(value)
+    return values
+
+
+# 向量化解码一段连续的 varint，返回 int64 数组
+def decode_varints(data):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if not len(raw):
+        return np.zeros(0, dtype=np.int64)
+    if raw.max() < 0x80:
+        return raw.astype(np.int64)
+    ends = np.flatnonzero(raw < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = (np.arange(len(raw)) - np.repeat(starts, ends - starts + 1)) * 7
+    values = (raw & 0x7F).astype(np.int64) << shifts
+    return np.add.reduceat(values, starts)
+
+
+# 向量化编码一组非负整数，返回 (字节串, 每个值的起始字节偏移)
+def encode_varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+    starts = np.cumsum(lengths) - lengths
+    owner = np.repeat(np.arange(len(values)), lengths)
+    group = np.arange(len(owner)) - starts[owner]
+    data = (values[owner] >> (group * 7).astype(np.uint64)) & np.uint64(0x7F)
+    data |= (group < lengths[owner] - 1).astype(np.uint64) << np.uint64(7)
+    return data.astype(np.uint8).tobytes(), starts
+
+
+# --------- 压缩倒排表 ---------
+# doc_id 与位置都做差分 + varint 编码，词频与位置偏移用定长数组，
+# 每满 BLOCK_SIZE 个 posting 记录一次块末 doc_id 和字节偏移
+class PostingList:
+    __slots__ = ('doc_bytes', 'tfs', 'pos_bytes', 'pos_offsets',
+                 'skip_docs', 'skip_offsets', 'last_doc', 'max_tf', 'min_length')
+
+    def __init__(self):
+        self.doc_bytes = bytearray()
+        self.tfs = array('I')
+        self.pos_bytes = bytearray()
+        self.pos_offsets = array('I')
+        # 多数词项的 posting 不满一个块，跳表数组延迟到第一个块写满时才分配
+        self.skip_docs = ()
+        self.skip_offsets = ()
+        self.last_doc = 0
+        # 最大词频与最短文档长度，用于估计该词得分的上界
+        self.max_tf = 0
+        self.min_length = 0
+
+    def __len__(self):
+        return len(self.tfs)
+
+    # 复制一份，之后对原倒排表的追加不影响副本
+    def copy(self):
+        postings = PostingList()
+        postings.doc_bytes = bytearray(self.doc_bytes)
+        postings.tfs = array('I', self.tfs)
+        postings.pos_bytes = bytearray(self.pos_bytes)
+        postings.pos_offsets = array('I', self.pos_offsets)
+        if self.skip_docs:
+            postings.skip_docs = array('I', self.skip_docs)
+            postings.skip_offsets = array('I', self.skip_offsets)
+        postings.last_doc = self.last_doc
+        postings.max_tf = self.max_tf
+        postings.min_length = self.min_length
+        return postings
+
+    # doc_id 必须严格递增追加；store_positions=False 时只记录词频，不保存位置
+    def append(self, doc_id, positions, doc_length, store_positions=True):
+        self._append_doc(doc_id)
+        self.tfs.append(len(positions))
+        self._update_bounds(len(positions), doc_length)
+        if not store_positions:
+            return
+        self.pos_offsets.append(len(self.pos_bytes))
+        previous = 0
+        for position in positions:
+            write_varint(self.pos_bytes, position - previous)
+            previous = position
+
+    # 把另一个倒排表整体接到末尾，other 的 doc_id 统一加上 doc_offset，结果须大于当前 last_doc
+    def extend(self, other, doc_offset=0):
+        if not len(other):
+            return
+        first = len(self.tfs)
+        # 整体平移不改变其余差分，只需重新编码第一个 doc_id 的差分，后面的字节原样拼接
+        head_length = 1
+        while other.doc_bytes[head_length - 1] >= 0x80:
+            head_length += 1
+        head = bytearray()
+        write_varint(head, read_varints(other.doc_bytes, 0, 1)[0] + doc_offset - self.last_doc)
+        # 合并后全局下标为 BLOCK_SIZE 倍数的 posting 是新的块起点，需要补记跳表
+        boundaries = np.arange(-(-max(first, 1) // BLOCK_SIZE) * BLOCK_SIZE, first + len(other), BLOCK_SIZE)
+        if len(boundaries):
+            if not self.skip_docs:
+                self.skip_docs = array('I')
+                self.skip_offsets = array('I')
+            raw = np.frombuffer(other.doc_bytes, dtype=np.uint8)
+            starts = np.flatnonzero(raw < 0x80) + 1 - head_length + len(head) + len(self.doc_bytes)
+            doc_ids = other.doc_ids() + doc_offset
+            local = boundaries - first
+            previous_docs = np.where(local > 0, doc_ids[np.maximum(local - 1, 0)], self.last_doc)
+            offsets = np.where(local > 0, starts[np.maximum(local - 1, 0)], len(self.doc_bytes))
+            self.skip_docs.frombytes(previous_docs.astype(np.uint32).tobytes())
+            self.skip_offsets.frombytes(offsets.astype(np.uint32).tobytes())
+        self.doc_bytes += head
+        self.doc_bytes += other.doc_bytes[head_length:]
+        self.last_doc = other.last_doc + doc_offset
+        self.tfs.frombytes(bytes(other.tfs))
+        self._update_bounds(other.max_tf, other.min_length)
+        if not other.has_positions():
+            return
+        # 每个 posting 的位置各自独立编码，字节可以原样拼接，只需平移偏移量
+        base = len(self.pos_bytes)
+        self.pos_offsets.extend(offset + base for offset in other.pos_offsets)
+        self.pos_bytes += other.pos_bytes
+
+    def _append_doc(self, doc_id):
+        if len(self.tfs) and len(self.tfs) % BLOCK_SIZE == 0:
+            if not self.skip_docs:
+                self.skip_docs = array('I')
+                self.skip_offsets = array('I')
+            self.skip_docs.append(self.last_doc)
+            self.skip_offsets.append(len(self.doc_bytes))
+        write_varint(self.doc_bytes, doc_id - self.last_doc)
+        self.last_doc = doc_id
+
+    def _update_bounds(self, tf, doc_length):
+        self.max_tf = max(self.max_tf, tf)
+        self.min_length = min(self.min_length, doc_length) if self.min_length else doc_length
+
+    # 不保存位置的倒排表没有位置偏移数组
+    def has_positions(self):
+        return len(self.pos_offsets) == len(self.tfs)
+
+    def doc_ids(self):
+        return np.cumsum(decode_varints(self.doc_bytes))
+
+    def tf_array(self):
+        return np.frombuffer(self.tfs, dtype=np.uint32).astype(np.int64)
+
+    def num_blocks(self):
+        return (len(self.tfs) + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    # 只解码第 block 个块，返回该块的 doc_id 数组
+    def block_doc_ids(self, block):
+        start = self.skip_offsets[block - 1] if block else 0
+        end = self.skip_offsets[block] if block < len(self.skip_offsets) else len(self.doc_bytes)
+        base = self.skip_docs[block - 1] if block else 0
+        return np.cumsum(decode_varints(self.doc_bytes[start:end])) + base
+
+    # 查找一组升序 doc_id 的词频，不在倒排表中的记为 0；只解码包含这些 doc_id 的块
+    def lookup(self, doc_ids):
+        tfs = np.zeros(len(doc_ids), dtype=np.int64)
+        if not len(doc_ids) or not len(self):
+            return tfs
+        block_last_docs = np.append(np.array(self.skip_docs, dtype=np.int64), self.last_doc)
+        blocks = np.unique(np.searchsorted(block_last_docs, doc_ids))
+        blocks = blocks[blocks < len(block_last_docs)]
+        if not len(blocks):
+            return tfs
+        if len(blocks) * 4 > len(block_last_docs):
+            # 大部分块都要解码时，整体解码更快
+            block_docs, block_tfs = self.doc_ids(), self.tf_array()
+        else:
+            all_tfs = self.tf_array()
+            block_docs = np.concatenate([self.block_doc_ids(block) for block in blocks])
+            block_tfs = np.concatenate([all_tfs[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE] for block in blocks])
+        positions = np.minimum(np.searchsorted(block_docs, doc_ids), len(block_docs) - 1)
+        hit = block_docs[positions] == doc_ids
+        tfs[hit] = block_tfs[positions[hit]]
+        return tfs
+
+    # 第 i 个 posting 的位置列表
+    def positions(self, i):
+        positions = read_varints(self.pos_bytes, self.pos_offsets[i], self.tfs[i])
+        for j in range(1, len(positions)):
+            positions[j] += positions[j - 1]
+        return positions
+
+    # 向量化取出一组 posting 的位置，返回 (按 posting 顺序拼接的位置数组, 每个 posting 的位置数)
+    def positions_at(self, indices):
+        offsets = np.frombuffer(self.pos_offsets, dtype=np.uint32).astype(np.int64)
+        lengths = np.diff(offsets, append=len(self.pos_bytes))[indices]
+        starts = offsets[indices]
+        gather = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+        totals = np.cumsum(decode_varints(np.frombuffer(self.pos_bytes, dtype=np.uint8)[gather]))
+        # 位置在每个 posting 内部做差分，减去前面各 posting 的累计值还原
+        counts = self.tf_array()[indices]
+        ends = np.cumsum(counts)
+        bases = np.concatenate(([0], totals[ends[:-1] - 1])) if len(counts) else totals[:0]
+        return totals - np.repeat(bases, counts), counts
+
+    # 按块惰性遍历 (doc_id, tf)
+    def __iter__(self):
+        for block in range(self.num_blocks()):
+            offset = block * BLOCK_SIZE
+            for i, doc_id in enumerate(self.block_doc_ids(block).tolist()):
+                yield doc_id, self.tfs[offset + i]
+
+
+# --------- 合并倒排表 ---------
+# parts 为 [(倒排表, 保留掩码)]，掩码为 None 表示全部保留；各部分保留下来的 doc_id 互不相同，
+# 但不要求按顺序排列。合并后重新编码，doc_lengths 用于计算最短文档长度
+def merge_postings(parts, doc_lengths):
+    doc_ids, tfs, pos_starts, pos_lengths, pos_chunks = [], [], [], [], []
+    base = 0
+    store_positions = all(postings.has_positions() for postings, keep in parts)
+    for postings, keep in parts:
+        if store_positions:
+            offsets = np.frombuffer(postings.pos_offsets, dtype=np.uint32).astype(np.int64)
+        else:
+            offsets = np.zeros(len(postings), dtype=np.int64)
+        lengths = np.diff(offsets, append=len(postings.pos_bytes))
+        part_docs, part_tfs, starts = postings.doc_ids(), postings.tf_array(), offsets + base
+        if keep is not None:
+            part_docs, part_tfs, starts, lengths = part_docs[keep], part_tfs[keep], starts[keep], lengths[keep]
+        doc_ids.append(part_docs)
+        tfs.append(part_tfs)
+        pos_starts.append(starts)
+        pos_lengths.append(lengths)
+        pos_chunks.append(bytes(postings.pos_bytes))
+        base += len(postings.pos_bytes)
+    doc_ids = np.concatenate(doc_ids)
+    merged = PostingList()
+    if not len(doc_ids):
+        return merged
+    order = np.argsort(doc_ids, kind='stable')
+    doc_ids, tfs = doc_ids[order], np.concatenate(tfs)[order]
+    pos_starts, pos_lengths = np.concatenate(pos_starts)[order], np.concatenate(pos_lengths)[order]
+
+    doc_bytes, doc_starts = encode_varints(np.diff(doc_ids, prepend=0))
+    merged.doc_bytes = bytearray(doc_bytes)
+    merged.tfs.frombytes(tfs.astype(np.uint32).tobytes())
+    if len(doc_ids) > BLOCK_SIZE:
+        merged.skip_offsets = array('I', doc_starts[BLOCK_SIZE::BLOCK_SIZE].astype(np.uint32).tobytes())
+        merged.skip_docs = array('I', doc_ids[BLOCK_SIZE - 1:-1:BLOCK_SIZE].astype(np.uint32).tobytes())
+    merged.last_doc = int(doc_ids[-1])
+    merged.max_tf = int(tfs.max())
+    merged.min_length = int(np.frombuffer(doc_lengths, dtype=np.uint32)[doc_ids].min())
+    if not store_positions:
+        return merged
+    # 每个 posting 的位置字节各自独立，按新顺序拼接即可
+    new_offsets = np.cumsum(pos_lengths) - pos_lengths
+    gather = np.repeat(pos_starts - new_offsets, pos_lengths) + np.arange(int(pos_lengths.sum()))
+    merged.pos_bytes = bytearray(np.frombuffer(b''.join(pos_chunks), dtype=np.uint8)[gather].tobytes())
+    merged.pos_offsets.frombytes(new_offsets.astype(np.uint32).tobytes())
+    return merged
+
+
+# --------- 倒排表游标 ---------
+# 供 document-at-a-time 算法使用，每次只解码当前所在的块
+class PostingCursor:
+    __slots__ = ('postings', 'block', 'block_docs', 'block_start', 'i', 'doc')
+
+    def __init__(self, postings):
+        self.postings = postings
+        self.block = -1
+        self.block_docs = []
+        self.block_start = 0
+        self.i = 0
+        self.doc = END_OF_POSTINGS
+        if len(postings):
+            self._load(0)
+
+    def _load(self, block):
+        self.block = block
+        self.block_docs = self.postings.block_doc_ids(block).tolist()
+        self.block_start = block * BLOCK_SIZE
+        self.i = 0
+        self.doc = self.block_docs[0]
+
+    def tf(self):
+        return self.postings.tfs[self.block_start + self.i]
+
+    def next(self):
+        self.i += 1
+        if self.i < len(self.block_docs):
+            self.doc = self.block_docs[self.i]
+        elif self.block + 1 < self.postings.num_blocks():
+            self._load(self.block + 1)
+        else:
+            self.doc = END_OF_POSTINGS
+
+    # 移动到第一个 doc_id >= target 的位置。目标不在当前块时，
+    # 在跳表上从当前块开始做 galloping 搜索（步长倍增后再二分），只解码目标所在的块
+    def advance(self, target):
+        if self.doc >= target:
+            return
+        if target > self.postings.last_doc:
+            self.doc = END_OF_POSTINGS
+            return
+        skip_docs = self.postings.skip_docs
+        if self.block < len(skip_docs) and skip_docs[self.block] < target:
+            low = self.block + 1
+            bound = low
+            step = 1
+            while bound < len(skip_docs) and skip_docs[bound] < target:
+                low = bound + 1
+                bound += step
+                step *= 2
+            self._load(bisect_left(skip_docs, target, low, min(bound, len(skip_docs))))
+        self.i = bisect_left(self.block_docs, target, self.i)
+        self.doc = self.block_docs[self.i]
+
+
+# --------- 批量查询的解码缓存 ---------
+# 包装一个倒排表，第一次整表解码后缓存 doc_id 与词频，之后的查找直接在数组上二分
+class DecodedPostings:
+    __slots__ = ('postings', '_doc_ids', '_tfs')
+
+    def __init__(self, postings):
+        self.postings = postings
+        self._doc_ids = None
+        self._tfs = None
+
+    def __len__(self):
+        return len(self.postings)
+
+    def __getattr__(self, name):
+        return getattr(self.postings, name)
+
+    def doc_ids(self):
+        if self._doc_ids is None:
+            self._doc_ids = self.postings.doc_ids()
+            self._doc_ids.flags.writeable = False
+        return self._doc_ids
+
+    def tf_array(self):
+        if self._tfs is None:
+            self._tfs = self.postings.tf_array()
+            self._tfs.flags.writeable = False
+        return self._tfs
+
+    # 还没有整表解码时按块查找，只解码命中的块
+    def lookup(self, doc_ids):
+        if self._doc_ids is None:
+            return self.postings.lookup(doc_ids)
+        all_docs = self._doc_ids
+        tfs = np.zeros(len(doc_ids), dtype=np.int64)
+        if not len(doc_ids) or not len(all_docs):
+            return tfs
+        positions = np.minimum(np.searchsorted(all_docs, doc_ids), len(all_docs) - 1)
+        hit = all_docs[positions] == doc_ids
+        tfs[hit] = self.tf_array()[positions[hit]]
+        return tfs
+
+    def __iter__(self):
+        return iter(self.postings)
+
+
+# 词典的包装，同一个词项总是返回同一个带缓存的倒排表
+class DecodedTerms(Mapping):
+    def __init__(self, terms):
+        self.terms = terms
+        self._decoded = {}
+
+    def __getitem__(self, term):
+        decoded = self._decoded.get(term)
+        if decoded is None:
+            decoded = self._decoded[term] = DecodedPostings(self.terms[term])
+        return decoded
+
+    def __contains__(self, term):
+        return term in self._decoded or term in self.terms
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
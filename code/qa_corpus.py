@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+from collections.abc import Sequence
+
+import numpy as np
+
+# --------- 编译语料格式 ---------
+# 把 [TEXT]/[QUESTION]/[ANSWER] 标记的问答文本一次性编译成一个二进制文件，之后各脚本按偏移表直接读取，
+# 不再逐行扫描原始文本。文件依次为：
+#   文件头   (magic, 版本号, 负载 crc32, 负载长度)
+#   字符串区 所有文本、问题、答案的 UTF-8 字节，按解析顺序首尾相接
+#   文档块表 定长条目 (文本偏移, 文本长度, 第一个问答的下标, 问答数, 原文偏移, 原文长度)
+#   问答表   定长条目 (问题偏移, 问题长度, 答案偏移, 答案长度, 所属文档块)
+#   元信息   文档块数、问答数、字符串区长度与源文件 hash，放在文件末尾，写完字符串区后才知道
+# 偏移均相对于字符串区的起点。原文是 [TEXT] 行连同其后到第一个 [QUESTION] 之前的续行（以空格连接），
+# 供评估脚本使用；检索用的文本与 iter_blocks 一致，不含续行。没有续行时原文与文本指向同一段字节
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIIQ')
+META = struct.Struct('<QQQ32s')
+CORPUS_MAGIC = b'QACORPUS'
+
+BLOCK_ENTRY = np.dtype([
+    ('text_offset', '<u8'),
+    ('text_length', '<u4'),
+    ('qa_start', '<u4'),
+    ('qa_count', '<u4'),
+    ('source_offset', '<u8'),
+    ('source_length', '<u4'),
+])
+QA_ENTRY = np.dtype([
+    ('question_offset', '<u8'),
+    ('question_length', '<u4'),
+    ('answer_offset', '<u8'),
+    ('answer_length', '<u4'),
+    ('block', '<u4'),
+])
+
+
+# --------- 解析 ---------
+# 逐行解析，每读完一个文档块就产出一个，不把整个文件读进内存；lines 可以是打开的文件或任意按行迭代的对象。
+# source_text=True 时文档块另带 "source_text"：[TEXT] 行连同其后到第一个 [QUESTION] 之前的各行（以空格连接），
+# 与 model_evaluate.read_test_answer 按原始文本读出的一致
+def iter_blocks(lines, source_text=False):
+    current_text = ""
+    current_source = ""
+    # 位于 [TEXT] 之后、第一个 [QUESTION] 之前，其余各行都是文本的续行
+    in_text = False
+    qa_list = []
+    current_question, current_answer = None, None
+    # 为每个文档块分配 ID
+    block_id = 0
+
+    def block():
+        result = {"text": current_text.strip(), "qas": qa_list, "id": block_id}
+        if source_text:
+            result["source_text"] = current_source
+        return result
+
+    for line in lines:
+        line = line.strip()
+        if line.startswith("[QUESTION]"):
+            in_text = False
+        elif in_text:
+            current_source += " " + line
+        if line.startswith("[TEXT]"):
+            if current_text and qa_list:
+                yield block()
+                block_id += 1
+            current_text = line.replace("[TEXT]", "").strip()
+            if not in_text:
+                current_source = current_text
+            in_text = True
+            qa_list = []
+        elif line.startswith("[QUESTION]"):
+            current_question = line.replace("[QUESTION]", "").strip()
+        elif line.startswith("[ANSWER]"):
+            current_answer = line.replace("[ANSWER]", "").strip()
+            if current_question and current_answer:
+                qa_list.append({
+                    "question": current_question,
+                    "answer": current_answer
+                })
+                current_question, current_answer = None, None
+
+    # 最后一组
+    if current_text and qa_list:
+        yield block()
+
+
+# --------- 编译 ---------
+# 边解析边写入字符串区，内存中只保留两张定长表；文档块的划分与 iter_blocks 完全一致。返回 (文档块数, 问答数)
+def compile_corpus(lines, path, source_hash=''):
+    return write_corpus(iter_blocks(lines, source_text=True), path, source_hash)
+
+
+# 把已经解析好的文档块（text / qas，可选 source_text）按顺序写成编译语料，文档块的 ID 即其在语料中的下标
+def write_corpus(blocks, path, source_hash=''):
+    block_table = bytearray()
+    qa_table = bytearray()
+    num_blocks = num_qas = 0
+    arena_length = 0
+    crc = 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        def write(chunk):
+            nonlocal crc
+            f.write(chunk)
+            crc = zlib.crc32(chunk, crc)
+
+        def put(string):
+            nonlocal arena_length
+            data = string.encode('utf-8')
+            write(data)
+            arena_length += len(data)
+            return arena_length - len(data), len(data)
+
+        f.write(HEADER.pack(CORPUS_MAGIC, FORMAT_VERSION, 0, 0))
+        for block in blocks:
+            qa_entries = np.zeros(len(block['qas']), dtype=QA_ENTRY)
+            for i, qa in enumerate(block['qas']):
+                qa_entries[i] = put(qa['question']) + put(qa['answer']) + (num_blocks,)
+            text = put(block['text'])
+            source = block.get('source_text', block['text'])
+            source = text if source == block['text'] else put(source)
+            block_table += np.array([text + (num_qas, len(qa_entries)) + source], dtype=BLOCK_ENTRY).tobytes()
+            qa_table += qa_entries.tobytes()
+            num_blocks += 1
+            num_qas += len(qa_entries)
+        # 两张表按 8 字节对齐
+        write(b'\0' * (-arena_length % 8))
+        write(bytes(block_table))
+        write(bytes(qa_table))
+        write(META.pack(num_blocks, num_qas, arena_length, source_hash.encode('ascii')))
+        length = f.tell() - HEADER.size
+        f.seek(0)
+        f.write(HEADER.pack(CORPUS_MAGIC, FORMAT_VERSION, crc, length))
+    os.replace(tmp_path, path)
+    return num_blocks, num_qas
+
+
+def compile_file(source_path, path):
+    digest = hashlib.md5()
+    with open(source_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    with open(source_path, 'r', encoding='utf-8') as f:
+        return compile_corpus(f, path, digest.hexdigest())
+
+
+# --------- 读取 ---------
+def is_compiled_corpus(path):
+    with open(path, 'rb') as f:
+        return f.read(len(CORPUS_MAGIC)) == CORPUS_MAGIC
+
+
+# 只读语料，按下标返回与 iter_blocks 产出格式相同的文档块，可以直接代替文档块列表传给检索函数。
+# buffer 可以是 mmap，也可以是内存中的字节串；*_bytes 方法返回指向字符串区的 memoryview，不复制数据
+class CompiledCorpus(Sequence):
+    def __init__(self, buffer, name='<memory>', verify=True, path=None):
+        if len(buffer) < HEADER.size + META.size:
+            raise ValueError(f"语料文件已损坏（长度不足）: {name}")
+        magic, version, crc, length = HEADER.unpack_from(buffer, 0)
+        if magic != CORPUS_MAGIC:
+            raise ValueError(f"不是编译好的语料文件: {name}")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"语料文件版本 {version} 与当前版本 {FORMAT_VERSION} 不一致，需要重新编译: {name}")
+        if len(buffer) != HEADER.size + length:
+            raise ValueError(f"语料文件已损坏（长度不符）: {name}")
+        if verify and zlib.crc32(memoryview(buffer)[HEADER.size:]) != crc:
+            raise ValueError(f"语料文件已损坏（校验和不符）: {name}")
+        num_blocks, num_qas, arena_length, source_hash = META.unpack_from(buffer, len(buffer) - META.size)
+        blocks_offset = HEADER.size + arena_length + (-arena_length % 8)
+        self.buffer = buffer
+        self.path = path
+        self.source_hash = source_hash.rstrip(b'\0').decode('ascii')
+        self.arena = memoryview(buffer)[HEADER.size:HEADER.size + arena_length]
+        self.blocks = np.frombuffer(buffer, dtype=BLOCK_ENTRY, count=num_blocks, offset=blocks_offset)
+        self.qas = np.frombuffer(buffer, dtype=QA_ENTRY, count=num_qas,
+                                 offset=blocks_offset + self.blocks.nbytes)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def num_qas(self):
+        return len(self.qas)
+
+    def _string(self, offset, length):
+        offset = int(offset)
+        return self.arena[offset:offset + int(length)]
+
+    def text_bytes(self, i):
+        entry = self.blocks[i]
+        return self._string(entry['text_offset'], entry['text_length'])
+
+    def question_bytes(self, j):
+        entry = self.qas[j]
+        return self._string(entry['question_offset'], entry['question_length'])
+
+    def answer_bytes(self, j):
+        entry = self.qas[j]
+        return self._string(entry['answer_offset'], entry['answer_length'])
+
+    def source_text_bytes(self, i):
+        entry = self.blocks[i]
+        return self._string(entry['source_offset'], entry['source_length'])
+
+    def text(self, i):
+        return str(self.text_bytes(i), 'utf-8')
+
+    # [TEXT] 行连同续行的原文（见 iter_blocks 的 source_text）
+    def source_text(self, i):
+        return str(self.source_text_bytes(i), 'utf-8')
+
+    def question(self, j):
+        return str(self.question_bytes(j), 'utf-8')
+
+    def answer(self, j):
+        return str(self.answer_bytes(j), 'utf-8')
+
+    # 文档块 i 的问答在问答表中的下标范围
+    def qa_range(self, i):
+        entry = self.blocks[i]
+        return range(int(entry['qa_start']), int(entry['qa_start']) + int(entry['qa_count']))
+
+    def qa_block(self, j):
+        return int(self.qas[j]['block'])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        # 检索函数用 faiss 返回的 numpy 整数做下标
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("文档块下标越界")
+        return {
+            "text": self.text(i),
+            "qas": [{"question": self.question(j), "answer": self.answer(j)} for j in self.qa_range(i)],
+            "id": i
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # 按问答逐条产出 (问题, 答案, 所属文档块的文本)
+    def iter_qa(self):
+        for i in range(len(self)):
+            text = self.text(i)
+            for j in self.qa_range(i):
+                yield self.question(j), self.answer(j), text
+
+    # pickle 时只记录文件路径（内存中的语料记录全部字节），检索包里不再另存一份文档块
+    def __reduce__(self):
+        if self.path is not None:
+            return open_corpus, (self.path,)
+        return CompiledCorpus, (bytes(self.buffer),)
+
+    def close(self):
+        # 先释放所有 numpy / memoryview 视图，底层 mmap 才能关闭
+        self.blocks = self.qas = None
+        self.arena.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# 以 mmap 方式打开编译好的语料，文本只在访问时才从页缓存中读出
+def open_corpus(path, verify=True):
+    path = os.path.abspath(path)
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return CompiledCorpus(mm, path, verify, path)
+    except ValueError:
+        mm.close()
+        raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把 [TEXT]/[QUESTION]/[ANSWER] 问答文本编译成二进制语料")
+    parser.add_argument('source', help="问答文本，例如 qa_data.txt")
+    parser.add_argument('output', help="输出文件，例如 qa_data.corpus")
+    args = parser.parse_args()
+    num_blocks, num_qas = compile_file(args.source, args.output)
+    print(f"✅ 已编译 {num_blocks} 个文档块、{num_qas} 条问答: {args.output}")
@@ -1,7 +1,13 @@
 import random
 
+from qa_corpus import is_compiled_corpus, open_corpus
+
 
 def read_qa_data(file_path):
+    # 编译好的语料按偏移表直接读取，不再扫描原始文本
+    if is_compiled_corpus(file_path):
+        with open_corpus(file_path) as corpus:
+            return list(corpus.iter_qa())
     with open(file_path, 'r', encoding='utf-8') as file:
         content = file.read()
     texts = content.split('[TEXT]')[1:]
@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 多语言 MiniLM-L12 交叉编码器，只有 1 亿多参数，CPU 上 20 个候选一次前向在百毫秒量级
+DEFAULT_RERANKER = 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1'
+
+# 每批前向都在这把锁上串行（分词器不能被多个线程同时使用）。每次重排在自己的线程里逐批执行，
+# 超时的重排在当前这一批结束后退出，后面的调用最多只需等一个批次
+_predict_lock = threading.Lock()
+
+
+# --------- 交叉编码器 ---------
+# 与 encoder.load_model 一样推迟导入 sentence_transformers；重排只在 CPU 上做
+def load_reranker(model_name=DEFAULT_RERANKER, max_length=512):
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name, max_length=max_length, device='cpu')
+
+
+# 在后台线程加载并预热一次（第一次前向要初始化算子，比之后慢得多，不能算在某个查询的预算里），返回 Future
+def load_reranker_in_background(model_name=DEFAULT_RERANKER, max_length=512):
+    def load():
+        reranker = load_reranker(model_name, max_length)
+        reranker.predict([("预热", "预热")], show_progress_bar=False)
+        return reranker
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(load)
+    executor.shutdown(wait=False)
+    return future
+
+
+# --------- 限时重排 ---------
+# 用交叉编码器给前 top_n 个候选的 (query, text(候选)) 重新打分，返回 (重排后的候选, 已重排的个数, 状态)。
+# 候选按 batch_size 分批依次前向，超过 budget 秒（None 为不限时）时不再等待：已打分的候选按新分数排在前面，
+# 其余候选保持原顺序接在后面，最差情况就是原来的检索结果。keep 不为空时只返回前 keep 个。
+# 状态为 'full'（全部重排）、'partial'（预算用完时只重排了前几批）或 'skipped'（一批也没来得及重排）。
+# 一次前向无法中途打断，超时时正在进行的那一批仍会跑完，batch_size 决定超时后多占用的 CPU 与下一次调用的等待
+def rerank(query, candidates, reranker, text=str, top_n=20, keep=None, budget=0.3, batch_size=8):
+    candidates = list(candidates)
+    head = candidates[:top_n]
+    if not head:
+        return candidates[:keep], 0, 'full'
+    pairs = [(query, text(candidate)) for candidate in head]
+    scores = []
+    errors = []
+    lock = threading.Lock()
+    stop = threading.Event()
+    done = threading.Event()
+
+    def run():
+        try:
+            for start in range(0, len(pairs), batch_size):
+                with _predict_lock:
+                    if stop.is_set():
+                        return
+                    batch = reranker.predict(pairs[start:start + batch_size], batch_size=batch_size,
+                                             show_progress_bar=False)
+                with lock:
+                    scores.extend(float(score) for score in batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    done.wait(budget)
+    stop.set()
+    if errors:
+        raise errors[0]
+    with lock:
+        scored = list(scores)
+    # 分数相同时保持原来的名次
+    order = sorted(range(len(scored)), key=lambda i: (-scored[i], i))
+    results = [head[i] for i in order] + head[len(scored):] + candidates[top_n:]
+    status = 'full' if len(scored) == len(head) else 'partial' if scored else 'skipped'
+    return results[:keep], len(scored), status
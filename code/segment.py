@@ -0,0 +1,264 @@
+import mmap
+import os
+import struct
+import zlib
+from collections.abc import Mapping
+
+import numpy as np
+
+from postings import BLOCK_SIZE, PostingList
+
+# --------- 段文件格式 ---------
+# 一个段是一个目录，包含三个文件：
+#   terms.bin    词典：元信息 + 按 UTF-8 字节序排好的定长词条表 + 词项字符串区
+#   postings.bin 所有词项的倒排表，按词条表中的偏移定位
+#   doclens.bin  以 doc_id 为下标的 uint32 文档长度数组，已删除的文档记为 0xFFFFFFFF
+# 每个文件以 (magic, 版本号, 负载 crc32, 负载长度) 开头，词典的元信息里还记录了
+# 另外两个文件的 crc32，用来发现来自不同批次的文件混在一起的情况
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQ')
+META = struct.Struct('<QQQQII32s')
+TERMS_MAGIC = b'IIDXTERM'
+POSTINGS_MAGIC = b'IIDXPOST'
+DOCLENS_MAGIC = b'IIDXDLEN'
+
+TERM_ENTRY = np.dtype([
+    ('term_offset', '<u8'),
+    ('term_length', '<u4'),
+    ('df', '<u4'),
+    ('max_tf', '<u4'),
+    ('min_length', '<u4'),
+    ('last_doc', '<u4'),
+    ('doc_bytes', '<u4'),
+    ('pos_bytes', '<u8'),
+    ('postings_offset', '<u8'),
+])
+
+
+def _padding(length):
+    return -length % 4
+
+
+# --------- 写入 ---------
+def _write_file(path, magic, chunks):
+    crc = 0
+    length = 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(magic, FORMAT_VERSION, 0, 0))
+        for chunk in chunks:
+            f.write(chunk)
+            crc = zlib.crc32(chunk, crc)
+            length += len(chunk)
+        f.seek(0)
+        f.write(HEADER.pack(magic, FORMAT_VERSION, crc, length))
+    os.replace(tmp_path, path)
+    return crc
+
+
+def _file_image(magic, chunks):
+    payload = b''.join(chunks)
+    return HEADER.pack(magic, FORMAT_VERSION, zlib.crc32(payload), len(payload)) + payload
+
+
+def _posting_chunks(postings):
+    num_skips = len(postings.skip_docs)
+    chunks = [bytes(postings.doc_bytes), b'\0' * _padding(len(postings.doc_bytes)),
+              bytes(postings.tfs), bytes(postings.pos_offsets)]
+    if num_skips:
+        chunks += [bytes(postings.skip_docs), bytes(postings.skip_offsets)]
+    chunks += [bytes(postings.pos_bytes), b'\0' * _padding(len(postings.pos_bytes))]
+    return chunks
+
+
+# 返回 (词条表, 词项字符串区, 倒排表字节流)。词条表在倒排表字节流消费完之后才填满
+def _segment_parts(index):
+    terms = sorted(index.index.keys(), key=lambda term: term.encode('utf-8'))
+    entries = np.zeros(len(terms), dtype=TERM_ENTRY)
+    arena = bytearray()
+
+    def postings_chunks():
+        offset = 0
+        for i, term in enumerate(terms):
+            postings = index.index[term]
+            encoded = term.encode('utf-8')
+            entry = entries[i]
+            entry['term_offset'] = len(arena)
+            entry['term_length'] = len(encoded)
+            entry['df'] = len(postings)
+            entry['max_tf'] = postings.max_tf
+            entry['min_length'] = postings.min_length
+            entry['last_doc'] = postings.last_doc
+            entry['doc_bytes'] = len(postings.doc_bytes)
+            entry['pos_bytes'] = len(postings.pos_bytes)
+            entry['postings_offset'] = offset
+            arena.extend(encoded)
+            for chunk in _posting_chunks(postings):
+                offset += len(chunk)
+                yield chunk
+
+    return entries, arena, postings_chunks()
+
+
+def _meta_chunk(index, num_terms, postings_crc, doclens_crc, source_hash):
+    return META.pack(index.doc_id_counter, index.doc_count, index.total_length, num_terms,
+                     postings_crc, doclens_crc, source_hash.encode('ascii'))
+
+
+def write_segment(path, index, source_hash=''):
+    os.makedirs(path, exist_ok=True)
+    entries, arena, postings_chunks = _segment_parts(index)
+    postings_crc = _write_file(os.path.join(path, 'postings.bin'), POSTINGS_MAGIC, postings_chunks)
+    doclens_crc = _write_file(os.path.join(path, 'doclens.bin'), DOCLENS_MAGIC,
+                              [np.asarray(index.doc_lengths, dtype='<u4').tobytes()])
+    meta = _meta_chunk(index, len(entries), postings_crc, doclens_crc, source_hash)
+    # 词典最后写入，作为整个段写完的标志
+    _write_file(os.path.join(path, 'terms.bin'), TERMS_MAGIC, [meta, entries.tobytes(), bytes(arena)])
+
+
+# 把段的三个文件打包成内存中的字节串，供进程间传递
+def pack_segment(index, source_hash=''):
+    entries, arena, postings_chunks = _segment_parts(index)
+    postings = _file_image(POSTINGS_MAGIC, postings_chunks)
+    doclens = _file_image(DOCLENS_MAGIC, [np.asarray(index.doc_lengths, dtype='<u4').tobytes()])
+    meta = _meta_chunk(index, len(entries), HEADER.unpack_from(postings)[2], HEADER.unpack_from(doclens)[2],
+                       source_hash)
+    return _file_image(TERMS_MAGIC, [meta, entries.tobytes(), bytes(arena)]), postings, doclens
+
+
+# --------- 读取 ---------
+def _check_header(buffer, magic, verify, name):
+    if len(buffer) < HEADER.size:
+        raise ValueError(f"段文件已损坏（长度不足）: {name}")
+    file_magic, version, crc, length = HEADER.unpack_from(buffer, 0)
+    if file_magic != magic:
+        raise ValueError(f"不是倒排索引段文件: {name}")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"段文件版本 {version} 与当前版本 {FORMAT_VERSION} 不一致，需要重建: {name}")
+    if len(buffer) != HEADER.size + length:
+        raise ValueError(f"段文件已损坏（长度不符）: {name}")
+    if verify and zlib.crc32(memoryview(buffer)[HEADER.size:]) != crc:
+        raise ValueError(f"段文件已损坏（校验和不符）: {name}")
+    return crc
+
+
+# 段的只读词典，按需二分查找词项，不把全部词项载入内存。
+# 三个缓冲区可以是 mmap，也可以是内存中的字节串
+class SegmentTerms(Mapping):
+    def __init__(self, terms_buffer, postings_buffer, num_terms):
+        entries_offset = HEADER.size + META.size
+        self.entries = np.frombuffer(terms_buffer, dtype=TERM_ENTRY, count=num_terms, offset=entries_offset)
+        self.arena = memoryview(terms_buffer)[entries_offset + self.entries.nbytes:]
+        self.postings = memoryview(postings_buffer)[HEADER.size:]
+
+    def _term_bytes(self, i):
+        entry = self.entries[i]
+        start = int(entry['term_offset'])
+        return bytes(self.arena[start:start + int(entry['term_length'])])
+
+    def _find(self, term):
+        key = term.encode('utf-8')
+        low, high = 0, len(self.entries)
+        while low < high:
+            mid = (low + high) // 2
+            if self._term_bytes(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.entries) and self._term_bytes(low) == key:
+            return low
+        return -1
+
+    def _postings(self, i):
+        entry = self.entries[i]
+        df = int(entry['df'])
+        num_skips = (df - 1) // BLOCK_SIZE
+        offset = int(entry['postings_offset'])
+        doc_bytes = int(entry['doc_bytes'])
+
+        def take(length):
+            nonlocal offset
+            view = self.postings[offset:offset + length]
+            offset += length
+            return view
+
+        postings = PostingList.__new__(PostingList)
+        postings.doc_bytes = take(doc_bytes)
+        take(_padding(doc_bytes))
+        postings.tfs = take(4 * df).cast('I')
+        # 每个 posting 至少有一个位置，位置字节为空说明建索引时没有保存位置
+        postings.pos_offsets = take(4 * df if entry['pos_bytes'] else 0).cast('I')
+        postings.skip_docs = take(4 * num_skips).cast('I') if num_skips else ()
+        postings.skip_offsets = take(4 * num_skips).cast('I') if num_skips else ()
+        postings.pos_bytes = take(int(entry['pos_bytes']))
+        postings.last_doc = int(entry['last_doc'])
+        postings.max_tf = int(entry['max_tf'])
+        postings.min_length = int(entry['min_length'])
+        return postings
+
+    def __getitem__(self, term):
+        i = self._find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self._postings(i)
+
+    def __contains__(self, term):
+        return self._find(term) >= 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for i in range(len(self.entries)):
+            yield self._term_bytes(i).decode('utf-8')
+
+    # 顺序遍历时不必对每个词再做一次二分查找
+    def items(self):
+        for i in range(len(self.entries)):
+            yield self._term_bytes(i).decode('utf-8'), self._postings(i)
+
+    def release(self):
+        # 先释放所有 numpy / memoryview 视图，底层 mmap 才能关闭
+        self.entries = None
+        self.arena.release()
+        self.postings.release()
+
+
+# 返回 (词典, 文档长度数组, 元信息)
+def read_segment(terms_buffer, postings_buffer, doclens_buffer, verify=True, name='<memory>'):
+    _check_header(terms_buffer, TERMS_MAGIC, verify, name)
+    postings_crc = _check_header(postings_buffer, POSTINGS_MAGIC, verify, name)
+    doclens_crc = _check_header(doclens_buffer, DOCLENS_MAGIC, verify, name)
+    (doc_id_counter, doc_count, total_length, num_terms,
+     expected_postings_crc, expected_doclens_crc, source_hash) = META.unpack_from(terms_buffer, HEADER.size)
+    if (expected_postings_crc, expected_doclens_crc) != (postings_crc, doclens_crc):
+        raise ValueError(f"段文件不属于同一次写入，需要重建: {name}")
+
+    doc_lengths = memoryview(doclens_buffer)[HEADER.size:].cast('I')
+    meta = {
+        'doc_id_counter': doc_id_counter,
+        'doc_count': doc_count,
+        'total_length': total_length,
+        'source_hash': source_hash.rstrip(b'\0').decode('ascii'),
+    }
+    terms = SegmentTerms(terms_buffer, postings_buffer, num_terms)
+    meta['store_positions'] = not num_terms or bool(terms.entries['pos_bytes'].any())
+    return terms, doc_lengths, meta
+
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# 以 mmap 方式打开段目录，返回值同 read_segment，元信息中另带需要关闭的 mmap 列表
+def open_segment(path, verify=True):
+    mapped = [_map_file(os.path.join(path, name)) for name in ('terms.bin', 'postings.bin', 'doclens.bin')]
+    try:
+        terms, doc_lengths, meta = read_segment(*mapped, verify=verify, name=path)
+    except ValueError:
+        for mm in mapped:
+            mm.close()
+        raise
+    meta['mapped'] = mapped
+    return terms, doc_lengths, meta
@@ -1,130 +1,159 @@
 import streamlit as st
 import os
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
 from openai import OpenAI
 import hashlib
+import codecs
+import time
+
+from embedding_cache import QueryCache
+from encoder import DEFAULT_MODEL, load_model_in_background
+from qa_corpus import CORPUS_MAGIC, CompiledCorpus
+from reranker import load_reranker_in_background
+from vector_store import BundleCache, bundle_nbytes, load_bundle, save_bundle
+# 向量缓存、索引类型等建索引逻辑以及检索、重排与命令行版共用
+from 向量构建 import build_combined_index_streaming, iter_blocks, rerank_blocks, retrieve_combined_blocks
+
+# 每个上传文件的检索包保存在以文件 hash 命名的子目录中
+BUNDLE_DIR = 'vector_bundles'
+# 进程内所有会话共享的检索包缓存上限（按检索包文件大小估计），超出时淘汰最久未用的检索包
+BUNDLE_CACHE_BYTES = 2 << 30
+# True 时先检索 RERANK_TOP_N 个候选，用本地交叉编码器限时重排（超过 RERANK_BUDGET 秒时未打分的保持检索顺序），
+# 只把前 CONTEXT_BLOCKS 个交给大模型；重排模型还没加载完时直接用检索结果
+USE_RERANKER = False
+RERANK_TOP_N = 20
+RERANK_BUDGET = 0.3
+CONTEXT_BLOCKS = 3 if USE_RERANKER else 5
 
 # --------- 解析并组合 TEXT + QAs ---------
-def parse_and_merge_blocks(file_obj):
-    blocks = []
-    current_text = ""
-    qa_list = []
-    current_question, current_answer = None, None
-
-    lines = file_obj.read().decode("utf-8").splitlines()
-
-    for line in lines:
-        line = line.strip()
-        if line.startswith("[TEXT]"):
-            if current_text and qa_list:
-                blocks.append({
-                    "text": current_text.strip(),
-                    "qas": qa_list
-                })
-            current_text = line.replace("[TEXT]", "").strip()
-            qa_list = []
-        elif line.startswith("[QUESTION]"):
-            current_question = line.replace("[QUESTION]", "").strip()
-        elif line.startswith("[ANSWER]"):
-            current_answer = line.replace("[ANSWER]", "").strip()
-            if current_question and current_answer:
-                qa_list.append({
-                    "question": current_question,
-                    "answer": current_answer
-                })
-                current_question, current_answer = None, None
-
-    if current_text and qa_list:
-        blocks.append({
-            "text": current_text.strip(),
-            "qas": qa_list
-        })
-
-    return blocks
+# 按行解码上传的文件，边读边产出文档块，不把整个文件解码成一个字符串
+def iter_uploaded_blocks(file_obj):
+    file_obj.seek(0)
+    return iter_blocks(codecs.iterdecode(file_obj, "utf-8"))
+
+# 上传的是 qa_corpus.py 编译好的语料时直接按偏移表读取，不再逐行解析
+def open_uploaded_corpus(file_obj):
+    file_obj.seek(0)
+    if file_obj.read(len(CORPUS_MAGIC)) != CORPUS_MAGIC:
+        return None
+    return CompiledCorpus(file_obj.getvalue(), file_obj.name)
 
 # --------- 计算文件hash用于判断是否是新文件 ---------
 def compute_file_hash(file_obj):
     file_obj.seek(0)
-    file_bytes = file_obj.read()
+    digest = hashlib.md5()
+    for chunk in iter(lambda: file_obj.read(1 << 20), b''):
+        digest.update(chunk)
     file_obj.seek(0)
-    return hashlib.md5(file_bytes).hexdigest()
-
-# --------- 构建向量索引 ---------
-def build_combined_index(blocks, model_name='paraphrase-multilingual-MiniLM-L12-v2'):
-    model = SentenceTransformer(model_name)
-    combined_texts = []
-
-    for block in blocks:
-        combined = block['text']
-        for qa in block['qas']:
-            combined += f"。问题：{qa['question']} 答案：{qa['answer']}"
-        combined_texts.append(combined)
-
-    embeddings = model.encode(combined_texts, convert_to_numpy=True)
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dim)
-    index.add(embeddings)
-
-    return index, model
-
-# --------- 相似度检索 ---------
-def retrieve_combined_blocks(query, model, index, blocks, top_k=5):
-    query_vec = model.encode([query], convert_to_numpy=True)
-    distances, indices = index.search(query_vec, top_k)
-
-    results = []
-    for i, idx in enumerate(indices[0]):
-        block = blocks[idx]
-        similarity = 1 / (1 + distances[0][i])
-        results.append((similarity, block['text'], block['qas']))
-
-    return results
+    return digest.hexdigest()
+
+# --------- 进程内共享的模型与检索包 ---------
+# 同一进程中的所有会话共用一份模型权重（重排模型同样），第一次调用时在后台开始加载，返回 Future
+@st.cache_resource
+def get_model():
+    return load_model_in_background(DEFAULT_MODEL)
+
+@st.cache_resource
+def get_reranker():
+    return load_reranker_in_background()
+
+@st.cache_resource
+def get_bundle_cache():
+    return BundleCache(BUNDLE_CACHE_BYTES)
+
+# 按文件 hash 取 (索引, 文档块)：先查共享缓存，再打开磁盘上的检索包，都没有时才解析并编码。
+# 多个会话同时上传同一文件时只构建一次；被淘汰后再次检索时从磁盘重新打开
+def get_bundle(file_obj, file_hash):
+    def load():
+        bundle_path = os.path.join(BUNDLE_DIR, file_hash)
+        try:
+            index, blocks, _ = load_bundle(bundle_path, DEFAULT_MODEL, file_hash)
+        except (OSError, ValueError):
+            corpus = open_uploaded_corpus(file_obj)
+            if corpus is not None:
+                blocks = corpus
+                index, _, _ = build_combined_index_streaming(corpus, DEFAULT_MODEL, model=get_model().result(),
+                                                             keep_blocks=False)
+            else:
+                # 边解析边分块编码，大文件也不会一次性占用大量内存
+                index, _, blocks = build_combined_index_streaming(iter_uploaded_blocks(file_obj), DEFAULT_MODEL,
+                                                                  model=get_model().result())
+            # 共享格式：向量与文档块以只读 mmap 打开，同一台机器上的多个 Streamlit 进程共用一份内存
+            save_bundle(bundle_path, index, blocks, DEFAULT_MODEL, file_hash, shared=True)
+            index, blocks, _ = load_bundle(bundle_path, DEFAULT_MODEL, file_hash)
+        return (index, blocks), bundle_nbytes(bundle_path)
+
+    return get_bundle_cache().get(file_hash, load)
 
 # --------- 调用大模型 ---------
-def ask_doubao(context, user_question):
+# 流式生成，边收边产出回答文本片段。stats 不为空时在生成结束后写入：
+#   ttft 首个 token 的延迟，total 总耗时（秒），tokens 生成的 token 数，tokens_per_sec 首个 token 之后的生成速度
+def ask_doubao(context, user_question, stats=None):
     client = OpenAI(
         base_url="",
         api_key=""
     )
 
-    completion = client.chat.completions.create(
+    start = time.perf_counter()
+    stream = client.chat.completions.create(
         model="doubao-pro-256k-241115",
         messages=[
             {"role": "system", "content": "你是人工智能助手，只能基于提供的上下文回答问题。如果上下文中没有相关信息，请直接回答：'我无法回答该问题，因为提供的内容中没有相关信息。'"},
             {"role": "user", "content": f"已知内容如下：\n{context}\n\n请基于上述内容回答：{user_question}"},
         ],
+        stream=True,
+        # 最后一个数据块带上 usage，按服务端统计的 token 数计算速度
+        stream_options={"include_usage": True},
     )
-    return completion.choices[0].message.content
+    first_token = None
+    num_chunks = 0
+    completion_tokens = None
+    for chunk in stream:
+        if getattr(chunk, 'usage', None) is not None:
+            completion_tokens = chunk.usage.completion_tokens
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if first_token is None:
+                first_token = time.perf_counter()
+            num_chunks += 1
+            yield delta
+    end = time.perf_counter()
+
+    if stats is not None and first_token is not None:
+        # 服务端没有返回 usage 时按数据块数估计，每个数据块通常是一个 token
+        tokens = completion_tokens or num_chunks
+        stats.update(ttft=first_token - start, total=end - start, tokens=tokens,
+                     tokens_per_sec=(tokens - 1) / (end - first_token) if end > first_token else 0.0)
 
 # --------- 初始化 Streamlit 状态 ---------
 st.set_page_config(page_title="问答助手", layout="wide")
 st.title("📘 文本问答智能助手")
 
-if 'blocks' not in st.session_state:
-    st.session_state.blocks = None
-if 'index' not in st.session_state:
-    st.session_state.index = None
-if 'model' not in st.session_state:
-    st.session_state.model = None
+# 页面打开时就在后台开始加载模型（整个进程只加载一次）
+get_model()
+if USE_RERANKER:
+    get_reranker()
+
+# 会话中只记录当前文件的 hash，模型与索引在进程内共享
 if 'file_hash' not in st.session_state:
     st.session_state.file_hash = None
+if 'query_cache' not in st.session_state:
+    st.session_state.query_cache = QueryCache()
+# 每次回答的首字延迟与生成速度
+if 'generation_stats' not in st.session_state:
+    st.session_state.generation_stats = []
 
 # --------- 上传文件并缓存处理结果 ---------
-uploaded_file = st.file_uploader("请上传包含 [TEXT]/[QUESTION]/[ANSWER] 标记的文本文件", type=["txt"])
+uploaded_file = st.file_uploader("请上传包含 [TEXT]/[QUESTION]/[ANSWER] 标记的文本文件或编译好的语料",
+                                 type=["txt", "corpus"])
 
 if uploaded_file:
     current_hash = compute_file_hash(uploaded_file)
 
     if st.session_state.file_hash != current_hash:
         with st.spinner("⏳ 正在解析文件并构建索引..."):
-            blocks = parse_and_merge_blocks(uploaded_file)
-            index, model = build_combined_index(blocks)
-
-            st.session_state.blocks = blocks
-            st.session_state.index = index
-            st.session_state.model = model
+            _, blocks = get_bundle(uploaded_file, current_hash)
             st.session_state.file_hash = current_hash
 
         st.success(f"✅ 成功载入 {len(blocks)} 个文档块。可以开始提问了！")
@@ -132,23 +161,39 @@ if uploaded_file:
         st.info("📁 文件未更改，使用已缓存的模型和索引。")
 
 # --------- 提问 & 显示结果 ---------
-if st.session_state.blocks and st.session_state.index and st.session_state.model:
+if uploaded_file and st.session_state.file_hash:
     user_question = st.text_input("💬 输入你的问题：")
 
     if user_question:
         with st.spinner("🔍 正在检索相关内容..."):
+            index, blocks = get_bundle(uploaded_file, st.session_state.file_hash)
+            # 文档块数少于 top_k 时 faiss 以 -1 补位，retrieve_combined_blocks 会跳过这些位置；
+            # 传入 QueryCache 时重复的问题不再重新编码
             results = retrieve_combined_blocks(
                 user_question,
-                st.session_state.model,
-                st.session_state.index,
-                st.session_state.blocks,
-                top_k=5
+                get_model().result(),
+                index,
+                blocks,
+                top_k=RERANK_TOP_N if USE_RERANKER else CONTEXT_BLOCKS,
+                cache=st.session_state.query_cache
             )
+            rerank_status = None
+            if USE_RERANKER and get_reranker().done():
+                results, rerank_status = rerank_blocks(user_question, results, get_reranker().result(),
+                                                       keep=CONTEXT_BLOCKS, top_n=RERANK_TOP_N,
+                                                       budget=RERANK_BUDGET)
+            elif USE_RERANKER:
+                rerank_status = 'loading'
 
         # 拼接上下文内容
         all_context_parts = []
-        st.subheader("📚 匹配的文本段落（Top 5）")
-        for i, (score, text, qas) in enumerate(results[:5], 1):
+        st.subheader(f"📚 匹配的文本段落（Top {CONTEXT_BLOCKS}）")
+        if rerank_status == 'loading':
+            st.caption("重排模型仍在加载，本次按向量检索顺序")
+        elif rerank_status in ('partial', 'skipped'):
+            st.caption(f"重排超过 {RERANK_BUDGET} 秒，{'只重排了部分候选' if rerank_status == 'partial' else '本次未重排'}，"
+                       "其余按向量检索顺序")
+        for i, (score, _, text, qas) in enumerate(results[:CONTEXT_BLOCKS], 1):
             st.markdown(f"**{i}. 匹配度：{score:.4f}**")
             st.markdown(f"📘 {text}")
             context_part = f"段落 {i}：{text}"
@@ -158,8 +203,20 @@ if st.session_state.blocks and st.session_state.index and st.session_state.model
 
         full_context = "\n\n".join(all_context_parts)
 
-        with st.spinner("🤖 正在向大模型请求答案..."):
-            response = ask_doubao(full_context, user_question)
-
         st.subheader("🧠 大模型回答")
-        st.markdown(response)
+        answer = st.empty()
+        stats = {}
+        deltas = ask_doubao(full_context, user_question, stats)
+        # 只在等待第一个 token 时显示加载提示，之后边生成边显示
+        with st.spinner("🤖 正在向大模型请求答案..."):
+            response = next(deltas, "")
+        answer.markdown(response + "▌")
+        for delta in deltas:
+            response += delta
+            answer.markdown(response + "▌")
+        answer.markdown(response)
+
+        if stats:
+            st.session_state.generation_stats.append(dict(stats, question=user_question))
+            st.caption(f"首字延迟 {stats['ttft']:.2f} 秒 · 总耗时 {stats['total']:.2f} 秒 · "
+                       f"{stats['tokens']} tokens · {stats['tokens_per_sec']:.1f} tokens/秒")
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import faiss
+
+from ann_index import shareable_index
+from qa_corpus import open_corpus, write_corpus
+
+# --------- 检索包格式 ---------
+# 一个检索包是一个目录，包含三个文件：
+#   index.faiss   faiss.write_index 写出的向量索引
+#   blocks.pkl    文档块列表（text / qas / id）
+#   manifest.json 格式版本、模型名、索引类型与参数、向量维度、文档块数与源文件 hash
+# manifest 最后写入，作为整个包写完的标志；源文件未变化时直接打开，不再解析与编码。
+# 共享格式（shared=True）把向量存成 fp16 的 flat 索引（见 ann_index.shareable_index），文档块存成编译语料
+# corpus.bin（见 qa_corpus.py）代替 blocks.pkl；打开时两者都以只读 mmap 映射，同一台机器上的多个 worker 共用一份内存
+BUNDLE_VERSION = 1
+CORPUS_FILE = 'corpus.bin'
+# IO_FLAG_MMAP_IFC 让 flat 类索引直接在映射的文件上检索（IO_FLAG_MMAP 仍会复制一份），faiss 1.11 起才有这个标志，
+# 更早的版本为 None
+MMAP_IFC_FLAG = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+
+
+def file_hash(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _replace_file(path, write):
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _dump_pickle(obj, path):
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def save_bundle(path, index, blocks, model_name, source_hash='', index_type='flat', index_params=None,
+                shared=False):
+    os.makedirs(path, exist_ok=True)
+    if shared:
+        index = shareable_index(index)
+    _replace_file(os.path.join(path, 'index.faiss'), lambda tmp_path: faiss.write_index(index, tmp_path))
+    if shared:
+        write_corpus(blocks, os.path.join(path, CORPUS_FILE))
+    else:
+        _replace_file(os.path.join(path, 'blocks.pkl'), lambda tmp_path: _dump_pickle(blocks, tmp_path))
+    manifest = {
+        'version': BUNDLE_VERSION,
+        'model_name': model_name,
+        'index_type': index_type,
+        'index_params': index_params or {},
+        'dim': index.d,
+        'num_blocks': len(blocks),
+        'source_hash': source_hash,
+        'storage': 'shared' if shared else 'faiss',
+    }
+
+    def write_manifest(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+
+    _replace_file(os.path.join(path, 'manifest.json'), write_manifest)
+
+
+# 共享格式的检索包无法原地映射时，每个 worker 都会各自复制一份向量，发出警告而不是悄悄退回
+def _read_index(path, mmap, shared=False):
+    if mmap:
+        if shared and MMAP_IFC_FLAG is None:
+            warnings.warn(f"faiss {faiss.__version__} 没有 IO_FLAG_MMAP_IFC（需要 1.11 及以上），"
+                          f"共享检索包的向量会在每个进程中各复制一份: {path}", RuntimeWarning, stacklevel=3)
+        flag = faiss.IO_FLAG_MMAP if MMAP_IFC_FLAG is None else MMAP_IFC_FLAG
+        try:
+            # 支持 mmap 的索引类型直接映射文件，不支持的平台退回普通读取。映射打开的索引是只读的，
+            # 不能再 add / remove_ids（需要修改时用 mmap=False 打开）
+            return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            if shared:
+                warnings.warn(f"共享检索包无法以 mmap 打开（{e}），退回普通读取，向量会在每个进程中各复制一份: {path}",
+                              RuntimeWarning, stacklevel=3)
+    return faiss.read_index(path)
+
+
+# 返回 (向量索引, 文档块列表, manifest)。包不存在时抛 OSError，版本、模型、索引类型与参数或源文件不符时抛 ValueError
+def load_bundle(path, model_name=None, source_hash=None, index_type=None, index_params=None, mmap=True):
+    with open(os.path.join(path, 'manifest.json'), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != BUNDLE_VERSION:
+        raise ValueError(f"检索包版本 {manifest.get('version')} 与当前版本 {BUNDLE_VERSION} 不一致，需要重建: {path}")
+    if model_name is not None and manifest['model_name'] != model_name:
+        raise ValueError(f"检索包由模型 {manifest['model_name']} 构建，与 {model_name} 不一致: {path}")
+    if index_type is not None and manifest.get('index_type', 'flat') != index_type:
+        raise ValueError(f"检索包的索引类型 {manifest.get('index_type', 'flat')} 与 {index_type} 不一致: {path}")
+    if index_params is not None and manifest.get('index_params', {}) != index_params:
+        raise ValueError(f"检索包的索引参数 {manifest.get('index_params', {})} 与 {index_params} 不一致: {path}")
+    if source_hash is not None and manifest['source_hash'] != source_hash:
+        raise ValueError(f"源文件已变化: {path}")
+    index = _read_index(os.path.join(path, 'index.faiss'), mmap, manifest.get('storage') == 'shared')
+    if manifest.get('storage') == 'shared':
+        blocks = open_corpus(os.path.join(path, CORPUS_FILE))
+    else:
+        with open(os.path.join(path, 'blocks.pkl'), 'rb') as f:
+            blocks = pickle.load(f)
+    if index.d != manifest['dim'] or index.ntotal != len(blocks) or len(blocks) != manifest['num_blocks']:
+        raise ValueError(f"检索包已损坏（索引与文档块数量不符）: {path}")
+    return index, blocks, manifest
+
+
+# 检索包各文件的总大小，作为载入后占用内存的估计
+def bundle_nbytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+               if os.path.isfile(os.path.join(path, name)))
+
+
+# --------- 进程内共享的检索包缓存 ---------
+# 按 key（例如源文件 hash）缓存 load() 返回的 (值, 估计字节数)，总字节数超过 max_bytes 时淘汰最久未用的条目
+# （至少保留最新的一个）。多个线程同时请求同一个 key 时只调用一次 load()，其余线程等待其结果
+class BundleCache:
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            future = self._loading.get(key)
+            loading = future is None
+            if loading:
+                future = self._loading[key] = Future()
+                self.misses += 1
+        if not loading:
+            return future.result()
+
+        try:
+            value, nbytes = load()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[key]
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_bytes
+        future.set_result(value)
+        return value
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.nbytes}
@@ -1,118 +1,876 @@
+import hashlib
+import heapq
+import copy
 import math
-from collections import defaultdict
-import jieba
+import multiprocessing
 import os
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice, repeat
+import jieba
+import numpy as np
 from openai import OpenAI
 
+from incremental import DELETED_LENGTH, LiveTerms, MergePolicy, Segment, merge_segments
+from postings import END_OF_POSTINGS, DecodedTerms, PostingCursor
+from segment import open_segment, pack_segment, read_segment, write_segment
+
+# 邻近度加分时参与重排的结果数为 k 的多少倍
+PROXIMITY_DEPTH = 10
 
+
+# --------- 分词服务 ---------
+# 全局共享一个实例：词典只加载一次，查询分词结果放在 LRU 缓存里，重复的热门查询不再切词
 class Preprocessor:
-    def preprocess(self, text):
+    def __init__(self, cache_size=4096, cache_dir=None):
+        # jieba 把解析好的词典序列化到 cache_dir（默认系统临时目录），下次启动直接反序列化
+        if cache_dir:
+            jieba.dt.tmp_dir = cache_dir
+        self._warm_up_thread = None
+        self._cached_tokens = lru_cache(maxsize=cache_size)(self._tokens)
+
+    # 预先加载词典，避免把几秒的冷启动算进第一次查询；background=True 时在后台线程加载，
+    # 加载完成前到来的分词请求会在 jieba 内部的锁上等待
+    def warm_up(self, background=False):
+        if jieba.dt.initialized:
+            return
+        if not background:
+            jieba.initialize()
+        elif self._warm_up_thread is None:
+            self._warm_up_thread = threading.Thread(target=jieba.initialize, daemon=True)
+            self._warm_up_thread.start()
+
+    @staticmethod
+    def _tokens(text):
         words = jieba.lcut_for_search(text)
-        return [word.strip() for word in words if word.strip()]
+        return tuple(word.strip() for word in words if word.strip())
+
+    # 文档分词，不经过缓存
+    def preprocess(self, text):
+        return list(self._tokens(text))
+
+    # 查询分词，结果按原文缓存
+    def preprocess_query(self, text):
+        return list(self._cached_tokens(text))
+
+    # 批量分词，批内重复的文本只切一次；cached=True 时同时读写查询缓存
+    def preprocess_many(self, texts, cached=False):
+        tokenize = self._cached_tokens if cached else self._tokens
+        results = {}
+        for text in texts:
+            if text not in results:
+                results[text] = tokenize(text)
+        return [list(results[text]) for text in texts]
+
+    def cache_info(self):
+        return self._cached_tokens.cache_info()
 
+    def clear_cache(self):
+        self._cached_tokens.cache_clear()
 
+
+preprocessor = Preprocessor()
+
+
+# --------- 并发 ---------
+# 写入（增删改、合并）在 _lock 下串行进行；查询不加锁，开始时取一次 _lock 下发布的只读快照，
+# 快照固定了查询视图、文档数、总长度、文档长度与 doc_id 上界，写入方不再修改快照引用的任何倒排表与数组：
+#   增量段的倒排表在发布时冻结出副本（见 Segment.freeze）；
+#   文档长度与 live_gens 数组预留容量，新文档只写在所有快照的 doc_id 上界之后，容量不够时重新分配再换上；
+#   修改已有文档前先复制这两个数组
 class InvertedIndex:
-    def __init__(self):
-        self.index = defaultdict(list)
+    def __init__(self, k1=1.2, b=0.75, merge_policy=None, background_merge=True, store_positions=True):
+        # term -> PostingList，posting 以压缩数组形式存放。只有一个段且没有删除时直接指向该段的词典，
+        # 否则是把各段合并起来、去掉已删除文档的只读视图
+        self.index = {}
         self.doc_id_counter = 0
-        self.doc_lengths = defaultdict(int)
+        # 以 doc_id 为下标的文档长度数组（含预留容量，有效部分见 doc_lengths），已删除的文档记为 DELETED_LENGTH
+        self._doc_lengths = np.zeros(0, dtype=np.uint32)
         self.doc_count = 0
+        self.total_length = 0
+        # BM25 参数
+        self.k1 = k1
+        self.b = b
+        self.source_hash = ''
+        # 是否保存词位置。位置只用于短语查询与邻近度加分，不需要时关闭可省下大部分倒排表内存
+        self.store_positions = store_positions
+        # 增量更新：新文档写入末尾的增量段，按合并策略封存并在后台线程合并
+        self.merge_policy = merge_policy or MergePolicy()
+        self.background_merge = background_merge
+        self.segments = []
+        # 以 doc_id 为下标，记录文档最新版本所在段的 generation，0 表示已删除
+        self.live_gens = np.zeros(0, dtype=np.uint32)
+        self._generation = 0
+        self._lock = threading.RLock()
+        self._merge_thread = None
+        # 从磁盘打开的段：(词典, 文档长度视图, mmap 列表)，关闭索引时释放
+        self._mapped_segments = []
+        # 最近一次发布的查询快照；_shared 为 True 时文档长度与 live_gens 数组仍被快照引用
+        self._snapshot = None
+        self._shared = False
+        self._refresh()
 
+    @property
+    def doc_lengths(self):
+        return self._doc_lengths[:self.doc_id_counter]
+
+    # 查询用的快照，对快照本身调用时返回自身
+    def _view(self):
+        snapshot = self._snapshot
+        return self if snapshot is None else snapshot
+
+    # 追加一篇新文档，返回其 doc_id
     def add_document(self, content):
+        with self._lock:
+            doc_id = self._add_document(content)
+            self._after_write()
+        return doc_id
+
+    # 用新内容替换已有文档，doc_id 保持不变；旧版本在原来的段里变成墓碑
+    def update_document(self, doc_id, content):
+        self.update_documents([(doc_id, content)])
+
+    # 批量更新，按 doc_id 升序写入，一批更新最多只需另起一个增量段
+    def update_documents(self, items):
+        with self._lock:
+            for doc_id, content in sorted(items, key=lambda item: item[0]):
+                self._remove_document(doc_id)
+                self._index_document(doc_id, content)
+            self._after_write()
+
+    def delete_document(self, doc_id):
+        with self._lock:
+            self._remove_document(doc_id)
+            self._after_write()
+
+    def build_index(self, documents):
+        with self._lock:
+            for doc in documents:
+                self._add_document(doc)
+            self._after_write()
+
+    # 文档写完后才增加 doc_id_counter，分词出错时不会留下只建了一半索引的文档
+    def _add_document(self, content):
         doc_id = self.doc_id_counter
+        self._index_document(doc_id, content)
         self.doc_id_counter += 1
-        terms = Preprocessor().preprocess(content)
+        return doc_id
+
+    def _index_document(self, doc_id, content):
+        terms = preprocessor.preprocess(content)
         term_positions = defaultdict(list)
         for position, term in enumerate(terms):
             term_positions[term].append(position)
 
+        self._reserve(doc_id + 1)
+        delta = self._delta_segment(doc_id)
         for term, positions in term_positions.items():
-            self.index[term].append({'doc_id': doc_id, 'positions': positions})
+            delta.terms[term].append(doc_id, positions, len(terms), self.store_positions)
+        delta.dirty.update(term_positions)
+        delta.num_docs += 1
+        delta.live_docs += 1
+        delta.last_doc = doc_id
 
-        self.doc_lengths[doc_id] = len(terms)
+        self.live_gens[doc_id] = delta.generation
+        self._doc_lengths[doc_id] = len(terms)
         self.doc_count += 1
+        self.total_length += len(terms)
 
-    def build_index(self, documents):
-        for doc in documents:
-            self.add_document(doc)
+    def _remove_document(self, doc_id):
+        if not 0 <= doc_id < self.doc_id_counter or not self.live_gens[doc_id]:
+            raise KeyError(f"文档不存在或已删除: {doc_id}")
+        self._copy_on_write()
+        generation = self.live_gens[doc_id]
+        for segment in self.segments:
+            if segment.generation == generation:
+                segment.live_docs -= 1
+        self.live_gens[doc_id] = 0
+        self.doc_count -= 1
+        self.total_length -= int(self._doc_lengths[doc_id])
+        self._doc_lengths[doc_id] = DELETED_LENGTH
 
-    def query(self, query_terms):
-        results = None
-        for term in query_terms:
+    # --------- 段管理 ---------
+    def _next_generation(self):
+        self._generation += 1
+        return self._generation
+
+    # 返回可以追加 doc_id 的增量段。增量段的倒排表要求 doc_id 递增，
+    # 更新较早的文档时先封存当前增量段，再另起一个
+    def _delta_segment(self, doc_id):
+        delta = self.segments[-1] if self.segments and not self.segments[-1].sealed else None
+        if delta is not None and doc_id <= delta.last_doc:
+            delta.sealed = True
+            delta = None
+        if delta is None:
+            delta = Segment(self._next_generation())
+            self.segments.append(delta)
+        return delta
+
+    # 保证 doc_id < size 的位置可写。从磁盘打开的文档长度数组是只读的 mmap 视图，第一次写入时复制到内存
+    def _reserve(self, size):
+        if len(self.live_gens) < size:
+            self.live_gens = _grow(self.live_gens, size)
+        if len(self._doc_lengths) < size or not self._doc_lengths.flags.writeable:
+            self._doc_lengths = _grow(self._doc_lengths, size)
+
+    # 修改已有文档的 live_gens 与文档长度之前调用，已发布的快照继续使用旧数组
+    def _copy_on_write(self):
+        if self._shared or not self._doc_lengths.flags.writeable:
+            self.live_gens = self.live_gens.copy()
+            self._doc_lengths = self._doc_lengths.copy()
+            self._shared = False
+
+    def _after_write(self):
+        delta = self.segments[-1] if self.segments and not self.segments[-1].sealed else None
+        if delta is not None and self.merge_policy.should_seal(delta):
+            delta.sealed = True
+        self._refresh()
+        self._maybe_merge()
+
+    # 换上新的查询视图并发布快照，调用方需持有 _lock；全部文档都已删除的封存段直接丢弃
+    def _refresh(self):
+        self.segments = [segment for segment in self.segments if segment.live_docs or not segment.sealed]
+        frozen = [segment.freeze() for segment in self.segments]
+        if not frozen:
+            self.index = {}
+        elif len(frozen) == 1 and frozen[0].live_docs == frozen[0].num_docs:
+            self.index = frozen[0].terms
+        else:
+            self.index = LiveTerms(frozen, self.live_gens, self.doc_lengths)
+        # 浅拷贝即可：快照之后只会被读取，写入方只会重新绑定或原地追加快照看不到的部分
+        snapshot = copy.copy(self)
+        snapshot.segments = frozen
+        snapshot._snapshot = None
+        self._snapshot = snapshot
+        self._shared = True
+
+    def _maybe_merge(self):
+        if self._merge_thread is not None:
+            return
+        segments = self.merge_policy.find_merge(self.segments)
+        if segments:
+            self._start_merge(segments)
+
+    def _start_merge(self, segments):
+        # 合并基于当前状态的快照进行，期间的写入与查询照常进行
+        live_gens = self.live_gens[:self.doc_id_counter].copy()
+        doc_lengths = self.doc_lengths.copy()
+        args = (segments, self._next_generation(), live_gens, doc_lengths)
+        if self.background_merge:
+            self._merge_thread = threading.Thread(target=self._run_merge, args=args, daemon=True)
+            self._merge_thread.start()
+        else:
+            self._merge_thread = threading.current_thread()
+            self._run_merge(*args)
+
+    def _run_merge(self, segments, generation, live_gens, doc_lengths):
+        merged = merge_segments(segments, generation, live_gens, doc_lengths)
+        with self._lock:
+            # 合并期间被更新或删除的文档，其 generation 已不再指向参与合并的段。
+            # 复制一份再修改，正在使用旧视图的查询不受影响
+            moved = np.isin(self.live_gens, [segment.generation for segment in segments])
+            self.live_gens = self.live_gens.copy()
+            self.live_gens[moved] = generation
+            merged.live_docs = int(moved.sum())
+            # 增量段始终留在最后
+            self.segments = [segment for segment in self.segments if segment not in segments]
+            position = len(self.segments) - (1 if self.segments and not self.segments[-1].sealed else 0)
+            self.segments.insert(position, merged)
+            self._merge_thread = None
+            self._refresh()
+            self._maybe_merge()
+
+    def wait_for_merges(self):
+        while True:
+            with self._lock:
+                thread = self._merge_thread
+            if thread is None or thread is threading.current_thread():
+                return
+            thread.join()
+
+    # 把所有段合并成一个并清除墓碑，查询不再需要按词合并各段
+    def force_merge(self):
+        self.wait_for_merges()
+        with self._lock:
+            for segment in self.segments:
+                segment.sealed = True
+            if len(self.segments) > 1 or (self.segments and self.segments[0].live_docs < self.segments[0].num_docs):
+                background_merge, self.background_merge = self.background_merge, False
+                try:
+                    self._start_merge(list(self.segments))
+                finally:
+                    self.background_merge = background_merge
+            self._refresh()
+
+    # --------- 多进程并行建索引 ---------
+    # documents 可以是文件对象等任意可迭代对象，按 shard_size 行切分成分片，
+    # 各进程独立分词并构建分片内的倒排表，主进程按分片顺序合并，doc_id 与串行构建完全一致
+    def build_index_parallel(self, documents, workers=None, shard_size=2000):
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            self.build_index(documents)
+            return
+        # fork 出的子进程直接继承已加载的 jieba 词典
+        preprocessor.warm_up()
+        documents = iter(documents)
+        with self._lock, ProcessPoolExecutor(max_workers=workers) as executor:
+            # 限制在途分片数，避免一次性把整个输入读进内存
+            pending = deque()
+            while True:
+                while len(pending) < 2 * workers:
+                    shard = list(islice(documents, shard_size))
+                    if not shard:
+                        break
+                    pending.append(executor.submit(_build_shard, shard, self.store_positions))
+                if not pending:
+                    break
+                shard = InvertedIndex._from_segment(*read_segment(*pending.popleft().result(), verify=False))
+                self._merge_index(shard)
+                shard.close()
+            self._after_write()
+
+    # 把另一个索引的文档接在当前索引之后，对方的 doc_id 整体平移 doc_id_counter
+    def merge(self, other):
+        with self._lock:
+            self._merge_index(other)
+            self._after_write()
+
+    def _merge_index(self, other):
+        doc_offset = self.doc_id_counter
+        end = doc_offset + other.doc_id_counter
+        self._reserve(end)
+        delta = self._delta_segment(doc_offset)
+        for term, postings in other.index.items():
+            delta.terms[term].extend(postings, doc_offset)
+            delta.dirty.add(term)
+        other_lengths = np.asarray(other.doc_lengths, dtype=np.uint32)
+        self._doc_lengths[doc_offset:end] = other_lengths
+        self.live_gens[doc_offset:end][other_lengths != DELETED_LENGTH] = delta.generation
+        self.doc_id_counter = end
+        delta.num_docs += other.doc_count
+        delta.live_docs += other.doc_count
+        delta.last_doc = self.doc_id_counter - 1
+        self.doc_count += other.doc_count
+        self.total_length += other.total_length
+
+    # --------- 段文件持久化 ---------
+    # source_hash 记录构建索引所用语料的哈希，用于判断磁盘上的段是否已过期。保存前先把所有段合并成一个
+    def save(self, path, source_hash=''):
+        self.force_merge()
+        write_segment(path, self._view(), source_hash or self.source_hash)
+
+    # 以 mmap 方式打开段，启动时不需要重新分词建索引，多个进程可以共享同一份页缓存。
+    # 打开后仍可增删改文档，修改写入内存中的增量段
+    @classmethod
+    def open(cls, path, verify=True, k1=1.2, b=0.75, merge_policy=None, background_merge=True):
+        terms, doc_lengths, meta = open_segment(path, verify)
+        return cls._from_segment(terms, doc_lengths, meta, k1, b, merge_policy, background_merge)
+
+    @classmethod
+    def _from_segment(cls, terms, doc_lengths, meta, k1=1.2, b=0.75, merge_policy=None, background_merge=True):
+        index = cls(k1, b, merge_policy, background_merge, meta['store_positions'])
+        # 只读视图，第一次写入时才复制（见 _reserve / _copy_on_write）
+        index._doc_lengths = np.frombuffer(doc_lengths, dtype=np.uint32)
+        index.doc_id_counter = meta['doc_id_counter']
+        index.doc_count = meta['doc_count']
+        index.total_length = meta['total_length']
+        index.source_hash = meta['source_hash']
+        segment = Segment(index._next_generation(), terms, meta['doc_count'])
+        index.segments = [segment]
+        deleted = np.frombuffer(doc_lengths, dtype=np.uint32) == DELETED_LENGTH
+        index.live_gens = np.where(deleted, 0, segment.generation).astype(np.uint32)
+        index._mapped_segments.append((terms, doc_lengths, meta.get('mapped', [])))
+        index._refresh()
+        return index
+
+    def close(self):
+        self.wait_for_merges()
+        with self._lock:
+            if not self._mapped_segments:
+                return
+            # 先丢掉所有指向 mmap 的倒排表视图与快照，mmap 才能关闭；此时不能还有查询在进行
+            self.segments = []
+            self.index = {}
+            self._snapshot = None
+            self._doc_lengths = self._doc_lengths[:0].copy()
+            for terms, doc_lengths, mapped in self._mapped_segments:
+                doc_lengths.release()
+                terms.release()
+                for mm in mapped:
+                    mm.close()
+            self._mapped_segments = []
+
+    def query(self, query_terms, mode='and', min_should_match=1, slop=0):
+        return self._view()._query(query_terms, mode, min_should_match, slop)
+
+    def _query(self, query_terms, mode='and', min_should_match=1, slop=0):
+        if mode == 'and':
+            return self._intersect(query_terms).tolist()
+        if mode == 'phrase':
+            return self._match_phrase(query_terms, slop).tolist()
+        if mode != 'or':
+            raise ValueError(f"未知的查询模式: {mode}")
+        counts = np.zeros(self.doc_id_counter, dtype=np.int32)
+        for term in set(query_terms):
             if term in self.index:
-                current_docs = {entry['doc_id'] for entry in self.index[term]}
-                if results is None:
-                    results = current_docs
-                else:
-                    results &= current_docs
-            else:
-                return []
-        return sorted(results) if results else []
-
-    def rank(self, query):
-        query_terms = Preprocessor().preprocess(query)
-        relevant_docs = self.query(query_terms)
-        scores = {}
-        for doc_id in relevant_docs:
-            score = 0
-            doc_length = self.doc_lengths.get(doc_id, 1)
+                counts[self.index[term].doc_ids()] += 1
+        return np.flatnonzero(counts >= max(min_should_match, 1)).tolist()
+
+    # AND 求交：从最短的倒排表开始，其余词借助跳表只解码包含候选 doc 的块
+    def _intersect(self, query_terms):
+        terms = set(query_terms)
+        if not terms or any(term not in self.index for term in terms):
+            return np.zeros(0, dtype=np.int64)
+        postings_lists = sorted((self.index[term] for term in terms), key=len)
+        candidates = postings_lists[0].doc_ids()
+        for postings in postings_lists[1:]:
+            if not len(candidates):
+                break
+            candidates = candidates[postings.lookup(candidates) > 0]
+        return candidates
+
+    # mode='and' 要求匹配全部查询词；mode='or' 要求至少匹配 min_should_match 个不同的查询词；
+    # mode='phrase' 要求查询词按原顺序相邻出现，slop 为相邻两词之间允许多隔的词数。
+    # pruning 可选 'maxscore'、'wand' 或 None（穷举）；verify=True 时用穷举结果校验剪枝结果。
+    # proximity > 0 时取前 k * PROXIMITY_DEPTH 个结果，按相邻查询词在文档中的最近距离加分后重排
+    def rank(self, query, k=None, scoring='tfidf', mode='and', min_should_match=1,
+             pruning='maxscore', verify=False, slop=0, proximity=0.0):
+        return self._view()._rank_terms(preprocessor.preprocess_query(query), k, scoring, mode, min_should_match,
+                                        pruning, verify, slop, proximity)
+
+    def _rank_terms(self, query_terms, k=None, scoring='tfidf', mode='and', min_should_match=1,
+                    pruning='maxscore', verify=False, slop=0, proximity=0.0):
+        if not proximity:
+            return self._rank(query_terms, k, scoring, mode, min_should_match, pruning, verify, slop)
+        self._require_positions()
+        depth = None if k is None else k * PROXIMITY_DEPTH
+        res = self._rank(query_terms, depth, scoring, mode, min_should_match, pruning, verify, slop)
+        return self._rerank_by_proximity(query_terms, res, k, proximity)
+
+    # --------- 批量查询 ---------
+    # 一次分词全部查询，按最长倒排表所属的词把查询排序后切成批，同一批内共享解码结果，
+    # 每个倒排表每批只解码一次。workers > 1 时各批分给多个进程（需要 fork，子进程直接继承索引）。
+    # 其余参数与 rank 相同，结果顺序与 queries 一致
+    def rank_many(self, queries, k=None, workers=1, batch_size=256, **rank_args):
+        view = self._view()
+        queries_terms = preprocessor.preprocess_many(queries, cached=True)
+        order = sorted(range(len(queries)), key=lambda i: view._batch_key(queries_terms[i]))
+        batches = [[(i, queries_terms[i]) for i in order[start:start + batch_size]]
+                   for start in range(0, len(order), batch_size)]
+        results = [None] * len(queries)
+        if workers == 1:
+            batch_results = (_rank_batch(view, batch, k, rank_args) for batch in batches)
+            for batch_result in batch_results:
+                for i, res in batch_result:
+                    results[i] = res
+            return results
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_init_rank_worker, initargs=(view,)) as executor:
+            for batch_result in executor.map(_rank_worker_batch, batches, repeat(k), repeat(rank_args)):
+                for i, res in batch_result:
+                    results[i] = res
+        return results
+
+    # 倒排表最长（解码最贵）的词排在前面，共享这些词的查询会落在同一批
+    def _batch_key(self, query_terms):
+        terms = {term for term in query_terms if term in self.index}
+        return sorted(terms, key=lambda term: (-len(self.index[term]), term))
+
+    def _rank(self, query_terms, k, scoring, mode, min_should_match, pruning, verify, slop):
+        if scoring not in ('tfidf', 'bm25'):
+            raise ValueError(f"未知的打分方式: {scoring}")
+        if mode == 'and':
+            return self._rank_conjunctive(query_terms, k, scoring, self._intersect(query_terms))
+        if mode == 'phrase':
+            return self._rank_conjunctive(query_terms, k, scoring, self._match_phrase(query_terms, slop))
+        if mode != 'or':
+            raise ValueError(f"未知的查询模式: {mode}")
+        min_should_match = max(min_should_match, 1)
+        if scoring == 'tfidf':
+            return self._rank_tfidf(query_terms, k, min_should_match)
+
+        terms = [(term, self.index[term], weight * self._bm25_idf(len(self.index[term])))
+                 for term, weight in Counter(query_terms).items() if term in self.index]
+        if len(terms) < min_should_match:
+            return []
+        if k is None or pruning is None:
+            return self._rank_bm25_exhaustive(terms, k, min_should_match)
+        if pruning == 'wand':
+            res = self._rank_bm25_wand(terms, k, min_should_match)
+        elif pruning == 'maxscore':
+            res = self._rank_bm25_maxscore(terms, k, min_should_match)
+        else:
+            raise ValueError(f"未知的剪枝方式: {pruning}")
+        if verify:
+            self._check_topk(res, self._rank_bm25_exhaustive(terms, k, min_should_match))
+        return res
+
+    # AND / 短语模式：先得到候选文档，再只查找候选文档所在的块计算得分
+    def _rank_conjunctive(self, query_terms, k, scoring, candidates):
+        if not len(candidates):
+            return []
+        tfs = {term: self.index[term].lookup(candidates) for term in set(query_terms)}
+        doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)[candidates]
+        scores = np.zeros(len(candidates))
+        if scoring == 'tfidf':
             for term in query_terms:
-                if term in query_terms:
-                    posting = [entry for entry in self.index[term] if entry['doc_id'] == doc_id]
-                    #print(posting)
-                    if posting:
-                        tf = len(posting[0]['positions'])
-                        idf = math.log(self.doc_count / (1+len(self.index[term])))
-                        score += tf * idf
-                        #print(tf, idf, score, self.doc_count)
-            scores[doc_id] = score/doc_length
-        return sorted(scores.items(), reverse=True, key=lambda x: x[1])
-
-
-test_documents = []
-top_n = 1
-
-with open('processed_data.txt', 'r', encoding='utf-8') as f:
-    data = f.readlines()
-    print(data)
-    for line in data:
-        test_documents.append(line)
-#print(test_documents)
-
-que_txt = open('./test_word.txt', 'r', encoding='utf-8')
-que_lis = que_txt.readlines()
-index = InvertedIndex()
-index.build_index(test_documents)
-total = 0
-correct = 0
-for que in que_lis:
-    total += 1
-    print('Q:', que, '\n')
-    question = que.strip('\n')
-    query = question
-    res = index.rank(query)
-
-    final_res = res[0:top_n]
-    final_text = []
-    for single in final_res:
-        idx = single[0]
-        print(test_documents[idx], 'idx: ', idx)
-        if (idx + 1) == total:
-            correct += 1
-        final_text.append(test_documents[idx])
-print(correct/float(total))
-    #client = OpenAI(
-        # 从环境变量中读取您的方舟API Key
-    #    api_key=os.environ.get("ARK_API_KEY"),
-    #    base_url="https://ark.cn-beijing.volces.com/api/v3",
-    #    )
-    #completion = client.chat.completions.create(
-        # 将推理接入点 <Model>替换为 Model ID
-    #    model="doubao-1-5-pro-32k-250115",
-    #    messages=[
-    #        {"role": "system", "content": "根据以下知识回答用户的问题。问题与知识无关时要拒绝回答。如果用户只提供关键词，"
-    #                                      "尝试猜测用户要询问的问题。知识如下: {}".format(final_text)},
-    #        {"role": "user", "content": "{}".format(question)}
-    #    ]
-    #)
-    #print(completion.choices[0].message)
+                idf = math.log(self.doc_count / (1 + len(self.index[term])))
+                scores += tfs[term] * idf
+            scores = scores / doc_lengths
+        else:
+            norms = self._bm25_norm(doc_lengths.astype(np.float64))
+            for term, weight in Counter(query_terms).items():
+                scores += self._bm25_score(weight * self._bm25_idf(len(self.index[term])), tfs[term], norms)
+        # 稳定排序，同分时保持 doc_id 升序，与原先 sorted(..., reverse=True) 的结果一致
+        order = np.argsort(-scores, kind='stable')[:k]
+        return [(int(candidates[i]), float(scores[i])) for i in order]
+
+    def _rank_tfidf(self, query_terms, k, min_should_match):
+        # term-at-a-time：每个词的倒排表只遍历一次，得分累加到以 doc_id 为下标的数组中
+        scores = np.zeros(self.doc_id_counter)
+        matched = np.zeros(self.doc_id_counter, dtype=np.int32)
+        contributions = {}
+        for term in query_terms:
+            if term not in self.index:
+                continue
+            if term not in contributions:
+                postings = self.index[term]
+                doc_ids = postings.doc_ids()
+                idf = math.log(self.doc_count / (1 + len(postings)))
+                contributions[term] = (doc_ids, postings.tf_array() * idf)
+                matched[doc_ids] += 1
+            doc_ids, weights = contributions[term]
+            scores[doc_ids] += weights
+
+        relevant_docs = np.flatnonzero(matched >= min_should_match)
+        doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)[relevant_docs]
+        final_scores = scores[relevant_docs] / doc_lengths
+        order = np.argsort(-final_scores, kind='stable')[:k]
+        return [(int(relevant_docs[i]), float(final_scores[i])) for i in order]
+
+    # --------- 短语与邻近度 ---------
+    def _require_positions(self):
+        if not self.store_positions:
+            raise ValueError("索引没有保存词位置，不支持短语查询与邻近度加分")
+
+    # 把 doc_ids（升序，且都包含该词）中该词的每次出现编码成 doc_id << 32 | position，结果有序
+    def _position_keys(self, term, doc_ids):
+        postings = self.index[term]
+        positions, counts = postings.positions_at(np.searchsorted(postings.doc_ids(), doc_ids))
+        return (np.repeat(doc_ids, counts) << 32) | positions
+
+    # 位置求交：依次处理查询词，只保留前一个词之后 1 到 slop + 1 个位置内出现的位置，
+    # 每处理一个词就缩小候选文档，后面的词只需解码剩余候选文档的位置
+    def _match_phrase(self, query_terms, slop=0):
+        self._require_positions()
+        candidates = self._intersect(query_terms)
+        keys = None
+        for term in query_terms:
+            if not len(candidates):
+                break
+            term_keys = self._position_keys(term, candidates)
+            if keys is not None:
+                # 前一个词在本位置之前最近的一次出现，不在同一文档时差值远大于 slop
+                previous = np.searchsorted(keys, term_keys) - 1
+                gaps = term_keys - keys[np.maximum(previous, 0)]
+                term_keys = term_keys[(previous >= 0) & (gaps <= slop + 1)]
+            keys = term_keys
+            candidates = np.unique(keys >> 32)
+        return candidates
+
+    # 相邻的两个不同查询词在文档中的最近距离为 d 时加 weight / d²
+    def _rerank_by_proximity(self, query_terms, results, k, weight):
+        if not results:
+            return results
+        doc_ids = np.array([doc_id for doc_id, score in results], dtype=np.int64)
+        order = np.argsort(doc_ids)
+        docs = doc_ids[order]
+        boosts = np.zeros(len(docs))
+        terms = [term for term in query_terms if term in self.index]
+        for first, second in zip(terms, terms[1:]):
+            if first == second:
+                continue
+            both = docs[(self.index[first].lookup(docs) > 0) & (self.index[second].lookup(docs) > 0)]
+            if not len(both):
+                continue
+            first_keys = self._position_keys(first, both)
+            second_keys = self._position_keys(second, both)
+            # 每次出现只需看另一个词在它左右两侧最近的出现
+            right = np.searchsorted(first_keys, second_keys)
+            left = first_keys[np.maximum(right - 1, 0)]
+            right = first_keys[np.minimum(right, len(first_keys) - 1)]
+            distances = np.minimum(np.abs(second_keys - left), np.abs(right - second_keys)).astype(np.float64)
+            min_distances = np.full(len(both), np.inf)
+            np.minimum.at(min_distances, np.searchsorted(both, second_keys >> 32), distances)
+            boosts[np.searchsorted(docs, both)] += 1.0 / min_distances ** 2
+        scores = np.array([score for doc_id, score in results])
+        scores[order] += weight * boosts
+        top = np.argsort(-scores, kind='stable')[:k]
+        return [(int(doc_ids[i]), float(scores[i])) for i in top]
+
+    # --------- BM25 ---------
+    def _bm25_idf(self, df):
+        return math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+
+    def _bm25_norm(self, doc_length):
+        avg_length = self.total_length / self.doc_count
+        return self.k1 * (1 - self.b + self.b * doc_length / avg_length)
+
+    # 单个词对文档的得分，tf/norm 既可以是标量也可以是数组
+    def _bm25_score(self, weight, tf, norm):
+        return weight * (tf * (self.k1 + 1) / (tf + norm))
+
+    # 词得分随 tf 增大、随文档长度减小而单调增加，取最大词频与最短文档即为上界
+    def _bm25_upper_bound(self, postings, weight):
+        return self._bm25_score(weight, postings.max_tf, self._bm25_norm(postings.min_length))
+
+    @staticmethod
+    def _kth_largest(values, k):
+        return np.partition(values, len(values) - k)[len(values) - k] if len(values) >= k else 0.0
+
+    @staticmethod
+    def _topk_result(heap):
+        return [(-neg_doc, score) for score, neg_doc in sorted(heap, key=lambda x: (-x[0], -x[1]))]
+
+    # 维护大小为 k 的最小堆，同分时 doc_id 小的优先，与穷举排序一致
+    @staticmethod
+    def _push_topk(heap, k, doc_id, score):
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -doc_id))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, -doc_id))
+        return heap[0][0] if len(heap) == k else -math.inf
+
+    # 按查询词顺序累加，保证与穷举打分的浮点结果完全一致
+    def _score_doc(self, terms, cursors, doc_id):
+        norm = self._bm25_norm(self.doc_lengths[doc_id])
+        score = 0.0
+        for (term, postings, weight), cursor in zip(terms, cursors):
+            if cursor.doc == doc_id:
+                score += self._bm25_score(weight, cursor.tf(), norm)
+        return score
+
+    def _rank_bm25_exhaustive(self, terms, k, min_should_match):
+        scores = np.zeros(self.doc_id_counter)
+        matched = np.zeros(self.doc_id_counter, dtype=np.int32)
+        doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)
+        for term, postings, weight in terms:
+            doc_ids = postings.doc_ids()
+            norms = self._bm25_norm(doc_lengths[doc_ids].astype(np.float64))
+            scores[doc_ids] += self._bm25_score(weight, postings.tf_array(), norms)
+            matched[doc_ids] += 1
+        relevant_docs = np.flatnonzero(matched >= min_should_match)
+        final_scores = scores[relevant_docs]
+        order = np.argsort(-final_scores, kind='stable')[:k]
+        return [(int(relevant_docs[i]), float(final_scores[i])) for i in order]
+
+    # WAND：按当前 doc_id 排序游标，累加上界找到第一个可能超过堆阈值的 pivot，
+    # pivot 之前的游标直接跳到 pivot，跳过不可能进入 top-k 的文档。
+    # 有 min_should_match 时 pivot 至少是第 min_should_match 个游标
+    def _rank_bm25_wand(self, terms, k, min_should_match):
+        cursors = [PostingCursor(postings) for term, postings, weight in terms]
+        upper_bounds = {id(cursor): self._bm25_upper_bound(postings, weight)
+                        for cursor, (term, postings, weight) in zip(cursors, terms)}
+        heap = []
+        threshold = -math.inf
+        while True:
+            ordered = sorted(cursors, key=lambda c: c.doc)
+            bound = 0.0
+            pivot = None
+            for i, cursor in enumerate(ordered):
+                if cursor.doc == END_OF_POSTINGS:
+                    break
+                bound += upper_bounds[id(cursor)]
+                if bound > threshold and i + 1 >= min_should_match:
+                    pivot = i
+                    break
+            if pivot is None:
+                break
+            pivot_doc = ordered[pivot].doc
+            if ordered[0].doc == pivot_doc:
+                score = self._score_doc(terms, cursors, pivot_doc)
+                threshold = self._push_topk(heap, k, pivot_doc, score)
+                for cursor in ordered:
+                    if cursor.doc != pivot_doc:
+                        break
+                    cursor.next()
+            else:
+                for cursor in ordered[:pivot]:
+                    cursor.advance(pivot_doc)
+        return self._topk_result(heap)
+
+    # MaxScore：按上界从高到低逐词处理。剩余词的上界之和低于当前第 k 名的分数后，
+    # 新文档不可能再进入 top-k，此后只对候选文档查找剩余词的倒排表（只解码命中的块），
+    # 并淘汰加上剩余上界也追不上第 k 名、或剩余词数不够 min_should_match 的候选
+    def _rank_bm25_maxscore(self, terms, k, min_should_match):
+        doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)
+        upper_bounds = [self._bm25_upper_bound(postings, weight) for term, postings, weight in terms]
+        order = sorted(range(len(terms)), key=lambda i: -upper_bounds[i])
+        scores = np.zeros(self.doc_id_counter)
+        counts = np.zeros(self.doc_id_counter, dtype=np.int32)
+        # 第 k 名分数的下界：任意 k 个满足 min_should_match 的文档，其当前部分得分都不超过最终的第 k 名
+        threshold = 0.0
+        candidates = None
+        contributions = [None] * len(terms)
+        for step, i in enumerate(order):
+            term, postings, weight = terms[i]
+            remaining = sum(upper_bounds[j] for j in order[step:])
+            remaining_terms = len(order) - step
+            if candidates is None and (threshold > remaining or remaining_terms < min_should_match):
+                candidates = np.flatnonzero(counts)
+                partial, matched = scores[candidates], counts[candidates]
+            if candidates is None:
+                doc_ids, tfs = postings.doc_ids(), postings.tf_array()
+            else:
+                threshold = max(threshold, self._kth_largest(partial[matched >= min_should_match], k))
+                keep = (partial + remaining >= threshold) & (matched + remaining_terms >= min_should_match)
+                candidates, partial, matched = candidates[keep], partial[keep], matched[keep]
+                tfs = postings.lookup(candidates)
+                doc_ids, tfs = candidates[tfs > 0], tfs[tfs > 0]
+            term_scores = self._bm25_score(weight, tfs, self._bm25_norm(doc_lengths[doc_ids].astype(np.float64)))
+            contributions[i] = (doc_ids, term_scores)
+            if candidates is None:
+                scores[doc_ids] += term_scores
+                counts[doc_ids] += 1
+                touched = scores[doc_ids][counts[doc_ids] >= min_should_match]
+                threshold = max(threshold, self._kth_largest(touched, k))
+            else:
+                positions = np.searchsorted(candidates, doc_ids)
+                partial[positions] += term_scores
+                matched[positions] += 1
+        if candidates is None:
+            candidates = np.flatnonzero(counts)
+            partial, matched = scores[candidates], counts[candidates]
+        qualified = matched >= min_should_match
+        candidates, partial = candidates[qualified], partial[qualified]
+
+        # 累加顺序与穷举不同，先按部分和取出可能进入 top-k 的文档，
+        # 再按查询词原始顺序重新累加，保证与穷举打分的浮点结果完全一致
+        if len(partial) > k:
+            shortlist = candidates[partial >= self._kth_largest(partial, k) * (1 - 1e-9)]
+        else:
+            shortlist = candidates
+        final_scores = np.zeros(len(shortlist))
+        for doc_ids, term_scores in contributions:
+            if not len(doc_ids):
+                continue
+            positions = np.minimum(np.searchsorted(doc_ids, shortlist), len(doc_ids) - 1)
+            hit = doc_ids[positions] == shortlist
+            final_scores[hit] += term_scores[positions[hit]]
+        top = np.argsort(-final_scores, kind='stable')[:k]
+        return [(int(shortlist[i]), float(final_scores[i])) for i in top]
+
+    @staticmethod
+    def _check_topk(pruned, exhaustive):
+        pruned_scores = [score for doc_id, score in pruned]
+        exhaustive_scores = [score for doc_id, score in exhaustive]
+        if not np.allclose(pruned_scores, exhaustive_scores, rtol=1e-9, atol=0):
+            raise RuntimeError(f"剪枝结果与穷举结果不一致: {pruned} != {exhaustive}")
+        # 边界分数上可能有并列，只比较严格高于第 k 名分数的文档
+        if exhaustive_scores:
+            cutoff = exhaustive_scores[-1]
+            if {d for d, s in pruned if s > cutoff} != {d for d, s in exhaustive if s > cutoff}:
+                raise RuntimeError(f"剪枝结果与穷举结果不一致: {pruned} != {exhaustive}")
+
+
+# 重新分配更大的数组再换上，旧数组原样留给仍在使用它的查询快照
+def _grow(values, size):
+    grown = np.zeros(max(size, 2 * len(values)), dtype=values.dtype)
+    grown[:len(values)] = values
+    return grown
+
+
+# 批内共用一份带解码缓存的词典；浅拷贝索引对象，不影响其它线程上的查询
+def _rank_batch(index, batch, k, rank_args):
+    batch_index = copy.copy(index)
+    batch_index.index = DecodedTerms(index.index)
+    return [(i, batch_index._rank_terms(query_terms, k, **rank_args)) for i, query_terms in batch]
+
+
+_worker_index = None
+
+
+def _init_rank_worker(index):
+    global _worker_index
+    _worker_index = index
+
+
+def _rank_worker_batch(batch, k, rank_args):
+    return _rank_batch(_worker_index, batch, k, rank_args)
+
+
+def _build_shard(documents, store_positions):
+    shard = InvertedIndex(store_positions=store_positions)
+    shard.build_index(documents)
+    # 以段文件的字节形式传回主进程，比逐个 pickle 倒排表对象快得多
+    return pack_segment(shard)
+
+
+if __name__ == "__main__":
+    # 读语料、打开索引的同时在后台加载 jieba 词典
+    preprocessor.warm_up(background=True)
+    test_documents = []
+    top_n = 1
+    # 'and' 要求匹配全部查询词；关键词查询经 jieba 切分后常有子词不在语料中，用 'or' 避免返回空结果
+    query_mode = 'or'
+    # 索引段目录，语料未变化时直接打开，不再重新分词建索引
+    index_path = 'processed_data.idx'
+
+    with open('processed_data.txt', 'rb') as f:
+        data_hash = hashlib.md5(f.read()).hexdigest()
+    with open('processed_data.txt', 'r', encoding='utf-8') as f:
+        data = f.readlines()
+        print(data)
+        for line in data:
+            test_documents.append(line)
+    #print(test_documents)
+
+    que_txt = open('./test_word.txt', 'r', encoding='utf-8')
+    que_lis = que_txt.readlines()
+    try:
+        index = InvertedIndex.open(index_path)
+        if index.source_hash != data_hash:
+            raise ValueError("语料已变化")
+    except (OSError, ValueError) as e:
+        print(f"重建倒排索引: {e}")
+        index = InvertedIndex()
+        index.build_index(test_documents)
+        index.save(index_path, data_hash)
+    total = 0
+    correct = 0
+    # 一次性批量检索全部问题，共享分词与倒排表解码
+    all_res = index.rank_many([que.strip('\n') for que in que_lis], top_n, mode=query_mode)
+    for que, res in zip(que_lis, all_res):
+        total += 1
+        print('Q:', que, '\n')
+        question = que.strip('\n')
+        query = question
+        if not res:
+            print('未检索到匹配文档')
+
+        final_res = res[0:top_n]
+        final_text = []
+        for single in final_res:
+            idx = single[0]
+            print(test_documents[idx], 'idx: ', idx)
+            if (idx + 1) == total:
+                correct += 1
+            final_text.append(test_documents[idx])
+    print(correct/float(total))
+        #client = OpenAI(
+            # 从环境变量中读取您的方舟API Key
+        #    api_key=os.environ.get("ARK_API_KEY"),
+        #    base_url="https://ark.cn-beijing.volces.com/api/v3",
+        #    )
+        #completion = client.chat.completions.create(
+            # 将推理接入点 <Model>替换为 Model ID
+        #    model="doubao-1-5-pro-32k-250115",
+        #    messages=[
+        #        {"role": "system", "content": "根据以下知识回答用户的问题。问题与知识无关时要拒绝回答。如果用户只提供关键词，"
+        #                                      "尝试猜测用户要询问的问题。知识如下: {}".format(final_text)},
+        #        {"role": "user", "content": "{}".format(question)}
+        #    ]
+        #)
+        #print(completion.choices[0].message)
@@ -1,88 +1,263 @@
-import faiss
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+from ann_index import build_ann_index, make_index, search, train_index, with_ids
+from embedding_cache import QueryCache, encode_with_cache, normalize_query, open_cache
+from encoder import DEFAULT_MODEL, load_model, load_model_in_background, model_key
+from qa_corpus import is_compiled_corpus, iter_blocks, open_corpus
+from reranker import load_reranker_in_background, rerank
+from vector_store import file_hash
 
 
 # --------- Step 1: 读取并组合 TEXT + QAs ---------
+# 解析逻辑在 qa_corpus.iter_blocks 中，与编译语料共用；编译好的语料用 qa_corpus.open_corpus 打开，
+# 返回的 CompiledCorpus 可以直接当作文档块列表使用
 def parse_and_merge_blocks(filepath):
-    blocks = []
-    current_text = ""
-    qa_list = []
-    current_question, current_answer = None, None
-
     with open(filepath, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    for line in lines:
-        line = line.strip()
-        if line.startswith("[TEXT]"):
-            if current_text and qa_list:
-                blocks.append({
-                    "text": current_text.strip(),
-                    "qas": qa_list
-                })
-            current_text = line.replace("[TEXT]", "").strip()
-            qa_list = []
-        elif line.startswith("[QUESTION]"):
-            current_question = line.replace("[QUESTION]", "").strip()
-        elif line.startswith("[ANSWER]"):
-            current_answer = line.replace("[ANSWER]", "").strip()
-            if current_question and current_answer:
-                qa_list.append({
-                    "question": current_question,
-                    "answer": current_answer
-                })
-                current_question, current_answer = None, None
-
-    # 最后一组
-    if current_text and qa_list:
-        blocks.append({
-            "text": current_text.strip(),
-            "qas": qa_list
-        })
-
-    # 为每个文档块分配 ID
-    for i, block in enumerate(blocks):
-        block["id"] = i
-
-    return blocks
+        return list(iter_blocks(f))
 
 
 # --------- Step 2: 构建向量索引，合并 text + qa 内容 ---------
-def build_combined_index(blocks, model_name='paraphrase-multilingual-MiniLM-L12-v2'):
-    model = SentenceTransformer(model_name)
+def combine_block_text(block):
+    combined = block['text']
+    for qa in block['qas']:
+        combined += f"。问题：{qa['question']} 答案：{qa['answer']}"
+    return combined
 
-    combined_texts = []
-    for block in blocks:
-        combined = block['text']
-        for qa in block['qas']:
-            combined += f"。问题：{qa['question']} 答案：{qa['answer']}"
-        combined_texts.append(combined)
 
-    embeddings = model.encode(combined_texts, convert_to_numpy=True)
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dim)
-    index.add(embeddings)
+# 向量按 (模型名, 组合文本) 缓存在 cache_dir 中，重建时只编码新增或修改过的文档块；cache_dir=None 时不使用缓存。
+# index_type 可选 'flat' / 'ivf' / 'hnsw' / 'ivfpq'，index_params 为 nlist、hnsw_m、pq_m 等建索引参数，
+# 其中 storage='fp16' / 'int8' 以标量量化存储向量，pca_dim 先做 PCA 降维，用来压缩索引内存。
+# backend 为编码后端（见 encoder.py），已加载好的模型可以通过 model 传入，此时 backend 需与之一致
+def build_combined_index(blocks, model_name=DEFAULT_MODEL,
+                         cache_dir='embedding_cache', cache_max_bytes=1 << 30, model=None,
+                         index_type='flat', index_params=None, backend='torch'):
+    if model is None:
+        model = load_model(model_name, backend)
+
+    combined_texts = [combine_block_text(block) for block in blocks]
+
+    if cache_dir:
+        cache = open_cache(cache_dir, cache_max_bytes)
+        embeddings = encode_with_cache(model, combined_texts, cache, model_key(model_name, backend))
+    else:
+        embeddings = model.encode(combined_texts, convert_to_numpy=True)
+    index = build_ann_index(embeddings, index_type, **(index_params or {}))
 
     return index, model
 
 
+# 分块构建：blocks 可以是 iter_blocks 返回的生成器，每凑够 chunk_size 个文档块就编码一次并加入索引，
+# 内存中只保留一个分块的文本与向量，语料再大峰值内存也基本不变。不需要训练的索引（flat / hnsw，float32 或 fp16
+# 存储且不做 PCA）在第一个分块就建好；需要训练的索引先缓存前 train_size 个向量，训练后再继续加入，
+# 此时 nlist 默认按这批向量的数量估计，语料远大于 train_size 时应在 index_params 中指定。
+# 返回 (向量索引, 模型, 文档块列表)，keep_blocks=False 时不保留文档块（例如文档块另存在编译好的语料文件中）。
+# use_ids=True 时以文档块的 id 作为向量 id（见 ann_index.with_ids），检索结果中的下标即为文档块 id
+def build_combined_index_streaming(blocks, model_name=DEFAULT_MODEL,
+                                   cache_dir='embedding_cache', cache_max_bytes=1 << 30, model=None,
+                                   index_type='flat', index_params=None, backend='torch',
+                                   chunk_size=1024, train_size=100000, keep_blocks=True, use_ids=False):
+    if model is None:
+        model = load_model(model_name, backend)
+    cache = open_cache(cache_dir, cache_max_bytes) if cache_dir else None
+    kept = []
+    index = None
+    pending = []
+
+    def encode(chunk):
+        texts = [combine_block_text(block) for block in chunk]
+        if cache is not None:
+            # 各分块的条目随向量追加到缓存日志，淘汰、压缩与条目表重写在全部分块完成（或中断）后统一做一次
+            return encode_with_cache(model, texts, cache, model_key(model_name, backend), flush=False)
+        return model.encode(texts, convert_to_numpy=True)
+
+    def add(embeddings, ids):
+        if use_ids:
+            index.add_with_ids(embeddings, ids)
+        else:
+            index.add(embeddings)
+
+    def flush_pending():
+        nonlocal index, pending
+        embeddings = np.vstack([part for part, _ in pending])
+        ids = np.concatenate([part for _, part in pending])
+        pending = []
+        index = make_index(index_type, embeddings.shape[1], len(embeddings), **(index_params or {}))
+        if use_ids:
+            index = with_ids(index)
+        train_index(index, embeddings, train_size)
+        add(embeddings, ids)
+
+    try:
+        for chunk in _chunks(blocks, chunk_size):
+            embeddings = encode(chunk)
+            ids = np.array([block['id'] for block in chunk], dtype=np.int64)
+            if keep_blocks:
+                kept.extend(chunk)
+            if index is None and not pending:
+                first = make_index(index_type, embeddings.shape[1], train_size, **(index_params or {}))
+                if first.is_trained:
+                    index = with_ids(first) if use_ids else first
+            if index is not None:
+                add(embeddings, ids)
+                continue
+            pending.append((embeddings, ids))
+            if sum(len(part) for part, _ in pending) >= train_size:
+                flush_pending()
+    finally:
+        if cache is not None:
+            cache.flush()
+    if index is None:
+        if not pending:
+            raise ValueError("语料中没有文档块")
+        flush_pending()
+    return index, model, kept
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 # --------- Step 3: 检索函数 ---------
-def retrieve_combined_blocks(query, model, index, blocks, top_k=5):
-    query_vec = model.encode([query], convert_to_numpy=True)
-    distances, indices = index.search(query_vec, top_k)
+# nprobe（IVF 类索引）与 ef_search（HNSW）在查询时调整召回率与延迟的取舍。
+# 传入 QueryCache 时重复的查询不再重新编码（开启结果缓存时直接返回上次的 top-k）
+def retrieve_combined_blocks(query, model, index, blocks, top_k=5, nprobe=None, ef_search=None, cache=None):
+    if cache is None:
+        query_vec = model.encode([query], convert_to_numpy=True)
+    else:
+        key = (normalize_query(query), top_k, nprobe, ef_search)
+        results = cache.get_results(index, key)
+        if results is not None:
+            return list(results)
+        query_vec = cache.encode(model, query)
+    distances, indices = search(index, query_vec, top_k, nprobe, ef_search)
+    results = _collect_blocks(blocks, distances[0], indices[0])
+
+    if cache is not None:
+        cache.put_results(index, key, tuple(results))
+    return results
+
 
+def _collect_blocks(blocks, distances, indices):
     results = []
-    for i, idx in enumerate(indices[0]):
+    for distance, idx in zip(distances, indices):
+        # 近似索引找不到足够的候选时以 -1 补位
+        if idx < 0:
+            continue
         block = blocks[idx]
-        similarity = 1 / (1 + distances[0][i])
+        similarity = 1 / (1 + distance)
         results.append((similarity, block["id"], block['text'], block['qas']))
+    return results
+
+
+# 用交叉编码器（见 reranker.py）对检索结果限时重排，只保留前 keep 个交给大模型；
+# results 为 retrieve_combined_blocks / retrieve_hybrid 的结果，检索时 top_k 取 top_n 以上才有候选可重排。
+# 分数仍为检索时的分数，超过 budget 秒时未打分的候选保持检索顺序。返回 (结果, 状态)，状态见 reranker.rerank
+def rerank_blocks(query, results, reranker, keep=5, top_n=20, budget=0.3, batch_size=8):
+    def text(result):
+        return combine_block_text({'text': result[2], 'qas': result[3]})
 
+    reranked, _, status = rerank(query, results, reranker, text, top_n, keep, budget, batch_size)
+    return reranked, status
+
+
+# 批量检索：每 batch_size 个查询一起编码、一起检索，返回与 queries 对应的结果列表
+def retrieve_many(queries, model, index, blocks, top_k=5, batch_size=64, nprobe=None, ef_search=None, cache=None):
+    results = []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        if cache is None:
+            query_vecs = model.encode(batch, batch_size=batch_size, convert_to_numpy=True)
+        else:
+            query_vecs = cache.encode_many(model, batch, batch_size)
+        distances, indices = search(index, query_vecs, top_k, nprobe, ef_search)
+        results.extend(_collect_blocks(blocks, distances[i], indices[i]) for i in range(len(batch)))
     return results
 
 
+# --------- Step 3.2: 动态微批 ---------
+# 并发请求先进入队列，后台线程收到第一个请求后最多再等 max_wait 秒、凑够 max_batch 个，
+# 合并成一次 retrieve_many，多个请求共用一次模型前向与一次向量检索。
+# 低并发时等待会增加单次延迟，此时可设 max_wait=0，只合并处理上一批期间排队的请求
+class MicroBatcher:
+    def __init__(self, model, index, blocks, max_batch=32, max_wait=0.005, **search_args):
+        self.model = model
+        self.index = index
+        self.blocks = blocks
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.search_args = search_args
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, query, top_k=5):
+        future = Future()
+        self._queue.put((query, top_k, future))
+        return future
+
+    def retrieve(self, query, top_k=5):
+        return self.submit(query, top_k).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                # 超过等待时间后仍会取走已经排队的请求；max_wait=0 时不等待，只合并已排队的请求
+                timeout = deadline - time.perf_counter()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch):
+        self.batches += 1
+        self.requests += len(batch)
+        try:
+            # 各请求的 top_k 可以不同，按最大的检索后再截断
+            results = retrieve_many([query for query, _, _ in batch], self.model, self.index, self.blocks,
+                                    max(top_k for _, top_k, _ in batch), len(batch), **self.search_args)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, top_k, future), result in zip(batch, results):
+            future.set_result(result[:top_k])
+
+
 # --------- Step 3.5: 通过 ID 查找指定文档 ---------
+# blocks 为 BlockIndex.blocks 这样以稳定 ID 为键的字典时按键查找，否则按下标
 def retrieve_block_by_id(block_id, blocks):
+    if isinstance(blocks, dict):
+        return blocks.get(block_id)
     if 0 <= block_id < len(blocks):
         return blocks[block_id]
     else:
@@ -91,11 +266,62 @@ def retrieve_block_by_id(block_id, blocks):
 
 # --------- Step 4: 主程序交互 ---------
 if __name__ == "__main__":
-    blocks = parse_and_merge_blocks(r"C:\Users\wdg\Desktop\qa_data(1).txt")  # 修改路径
+    # 可以是问答文本，也可以是 qa_corpus.py 编译好的语料（python qa_corpus.py qa_data.txt qa_data.corpus）
+    source_path = r"C:\Users\wdg\Desktop\qa_data(1).txt"  # 修改路径
+    # 检索包目录，源文件未变化时直接打开，不再解析与编码
+    bundle_path = 'qa_data.vec'
+    # 文档块在几万以内时精确检索就足够快，更大的语料可改用 'ivf' / 'hnsw' / 'ivfpq'
+    index_type = 'flat'
+    # 同一台机器加载多份语料、内存吃紧时可用 {'storage': 'fp16'} 或 {'storage': 'int8', 'pca_dim': 192} 等压缩向量，
+    # 每个向量的内存与召回率损失见 bench_vector_index.py storage
+    index_params = {}
+    # CPU 上可改用 'onnx' / 'onnx-int8' / 'torch-int8' 降低单次查询的编码延迟，向量偏差见 bench_vector_index.py encoder
+    encoder_backend = 'torch'
+    # 'hybrid' 时同时用倒排索引做关键词检索，与向量检索的结果融合
+    retrieval_mode = 'dense'
+    # True 时先检索前 20 个候选，再用本地交叉编码器限时重排，只显示前 5 个
+    use_reranker = False
+    rerank_depth = 20 if use_reranker else 5
+    # 打开检索包的同时在后台加载模型
+    model_future = load_model_in_background(DEFAULT_MODEL, encoder_backend)
+    if use_reranker:
+        reranker_future = load_reranker_in_background()
+    source_hash = file_hash(source_path)
+
+    # 向量以内容生成的稳定 ID 存储，源文件修改后只编码新增或修改过的文档块
+    from block_index import BlockIndex
+    store = None
+    try:
+        store = BlockIndex.open(bundle_path, model_key(DEFAULT_MODEL, encoder_backend), index_type, index_params)
+        print(f"✅ 已打开检索包，共 {len(store.blocks)} 个文档块。")
+    except (OSError, ValueError) as e:
+        print(f"重建向量索引: {e}")
+    if store is None or store.source_hash != source_hash:
+        compiled = is_compiled_corpus(source_path)
+        with open_corpus(source_path) if compiled else open(source_path, 'r', encoding='utf-8') as source:
+            source_blocks = source if compiled else iter_blocks(source)
+            if store is None:
+                print("⏳ 正在边读取边构建全文+问答组合索引...")
+                store = BlockIndex.build(bundle_path, source_blocks, model_future.result(), DEFAULT_MODEL,
+                                         encoder_backend, source_hash, index_type, index_params)
+                print(f"✅ 共载入 {len(store.blocks)} 个文档块。")
+            else:
+                print("⏳ 源文件已变化，只编码新增或修改过的文档块...")
+                added, updated, deleted = store.sync(source_blocks, model_future.result(), source_hash)
+                print(f"✅ 新增 {added}、修改 {updated}、删除 {deleted} 个文档块，共 {len(store.blocks)} 个。")
 
-    print(f"✅ 共载入 {len(blocks)} 个文档块。正在构建全文+问答组合索引...")
+    if retrieval_mode == 'hybrid':
+        from hybrid_retriever import open_lexical_index, retrieve_hybrid
+        from 倒排索引构建 import preprocessor
+        preprocessor.warm_up(background=True)
+        # 关键词索引保存在检索包目录下，lexical_ids[doc_id] 为对应的文档块 ID；
+        # 文档块有增删改时只对变化的文档块重新分词
+        lexical_index, lexical_ids = open_lexical_index(os.path.join(bundle_path, 'lexical.idx'), store.blocks,
+                                                        store.fingerprint())
 
-    index, model = build_combined_index(blocks)
+    # 重复提问直接命中缓存；增删文档块后结果缓存自动失效
+    query_cache = QueryCache(result_size=1024)
+    store.query_cache = query_cache
 
     print("\n🧠 输入你的问题（输入 q 退出），输入 id:xxx 来通过 ID 查找文档：")
     while True:
@@ -105,7 +331,7 @@ if __name__ == "__main__":
         elif user_input.startswith("id:"):
             try:
                 block_id = int(user_input.split(":")[1])
-                block = retrieve_block_by_id(block_id, blocks)
+                block = retrieve_block_by_id(block_id, store.blocks)
                 if block:
                     print(f"\n📘 文档 ID: {block_id} 的内容：")
                     print(f"📘 文本内容：\n{block['text']}")
@@ -119,7 +345,17 @@ if __name__ == "__main__":
             except ValueError:
                 print("❌ 输入的 ID 格式不正确，请输入 id:数字。")
         else:
-            results = retrieve_combined_blocks(user_input, model, index, blocks, top_k=5)
+            if retrieval_mode == 'hybrid':
+                results = retrieve_hybrid(user_input, model_future.result(), store.index, lexical_index, store.blocks,
+                                          top_k=rerank_depth, cache=query_cache, lexical_ids=lexical_ids)
+            else:
+                results = retrieve_combined_blocks(user_input, model_future.result(), store.index, store.blocks,
+                                                   top_k=rerank_depth, cache=query_cache)
+            if use_reranker:
+                results, rerank_status = rerank_blocks(user_input, results, reranker_future.result(), keep=5,
+                                                       top_n=rerank_depth)
+                if rerank_status != 'full':
+                    print(f"⏱️ 重排超时（{rerank_status}），部分候选保持检索顺序")
 
             print("\n🔍 匹配度最高的前 5 个文档块：\n")
             for i, (score, block_id, text, qas) in enumerate(results, 1):